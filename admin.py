@@ -0,0 +1,35 @@
+from aiogram import Router
+from aiogram.filters import Command
+from aiogram.types import Message
+from aiogram.enums import ParseMode
+from aiogram.fsm.context import FSMContext
+
+from config import ADMIN_IDS
+from usage import ledger
+from history import describe_session, history_stats
+
+# Служебные команды администраторов. Роутер подключается раньше игрового,
+# чтобы команды не перехватывались хендлерами диалога.
+router = Router()
+
+
+@router.message(Command("usage"))
+async def cmd_usage(message: Message):
+    """Расход токенов: итоги за сегодня, топ игроков, среднее на ход."""
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        return
+    await ledger.refresh()
+    await message.answer(ledger.report(), parse_mode=ParseMode.HTML)
+
+
+@router.message(Command("history"))
+async def cmd_history(message: Message, state: FSMContext):
+    """Вес истории своей сессии (байты, токены) до и после сворачивания механики."""
+    if message.from_user is None or message.from_user.id not in ADMIN_IDS:
+        return
+    report = history_stats.report()
+    await message.answer(
+        describe_session(await state.get_data()) + "\n\n"
+        f"Все сессии с запуска: свёрнуто {report['compacted']} ответов, "
+        f"−{report['bytes_saved']} байт, −{report['tokens_saved']} токенов"
+    )
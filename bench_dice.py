@@ -0,0 +1,103 @@
+"""
+Токены на раунд боя: мастер бросает кости сам (прежний промпт) против локальных
+бросков dice.py, когда модель получает готовые результаты в блоке [БРОСКИ].
+
+Это иллюстрация, а не замер: оба ответа мастера написаны вручную (один и тот же
+раунд — атака игрока, ответ врага, статус — в двух форматах), настоящие ответы
+модели могут быть длиннее или короче. Оценка токенов — локальная, как в
+context_builder. Отдельно показана цена лишнего хода, когда мастер просит игрока
+бросить самому или пересчитывает. Время броска — настоящий замер dice.combat_rolls.
+
+    python bench_dice.py [--repeat 5000] [--context 9000]
+"""
+import sys
+import random
+import timeit
+import argparse
+
+from context_builder import estimate_tokens, MESSAGE_OVERHEAD_TOKENS
+from dice import combat_rolls
+
+CHARACTER = {
+    "char_class": "Воин",
+    "stats": {"Сила": 16, "Ловкость": 14, "Телосложение": 15, "Интеллект": 10, "Мудрость": 12, "Харизма": 8},
+    "game_state": {"level": 3},
+}
+ACTION = "Бью ближайшего орка длинным мечом."
+
+NARRATIVE = (
+    "Клинок описывает дугу и врезается орку в плечо; тот ревёт и отшатывается, "
+    "но второй уже заходит слева, занося тяжёлый тесак."
+)
+
+# Мастер бросает сам: каждая кость, модификаторы и арифметика — в выходных токенах
+ROUND_BEFORE = NARRATIVE + """
+
+🎲 Атака: [14] + 3 (СИЛ) + 2 (мастерство) = 19 vs AC 13 → попадание
+🎲 Урон: 1к8 [6] + 3 (СИЛ) = 9 рубящего
+Орк-1: ❤️ 15 → 6
+
+🎲 Атака орка-2: [11] + 5 = 16 vs AC 16 → попадание
+🎲 Урон: 1к12 [7] + 3 = 10 рубящего
+🎲 Спасбросок ТЕЛ (концентрация не требуется) — пропуск
+
+**Торвин**: ❤️ 28 → 18/28 | 🔮 — | 🏹 —
+**Enemies**: 1.Орк-1 ❤️6/15 | 2.Орк-2 ❤️15/15 | Distances: 1.5m
+
+Твой ход. Движение + Действие + Бонусное?
+1. Добить раненого орка
+2. Отступить к двери
+3. Толкнуть орка-2 щитом
+4. Свой вариант"""
+
+# Броски уже сделаны локально: модель называет только итог
+ROUND_AFTER = NARRATIVE + """
+
+🎲 19 — попадание, 9 рубящего. Орк-1: ❤️ 15 → 6
+Орк-2: 🎲 16 — попадание, 10 рубящего.
+
+**Торвин**: ❤️ 28 → 18/28 | 🔮 — | 🏹 —
+**Enemies**: 1.Орк-1 ❤️6/15 | 2.Орк-2 ❤️15/15 | Distances: 1.5m
+
+Твой ход. Движение + Действие + Бонусное?
+1. Добить раненого орка
+2. Отступить к двери
+3. Толкнуть орка-2 щитом
+4. Свой вариант"""
+
+# Лишний ход: «брось d20 сам» или исправление ошибки в арифметике
+CLARIFY_REPLY = "Сделай бросок атаки: 🎲 d20 + 5. Напиши результат."
+CLARIFY_ACTION = "17"
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Токены на раунд боя с локальными бросками и без")
+    parser.add_argument("--repeat", type=int, default=5000)
+    parser.add_argument("--context", type=int, default=9000, help="входных токенов в обычном запросе хода")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    rolls = combat_rolls(CHARACTER, ACTION, rng)
+    tray = estimate_tokens("\n\n" + rolls)
+    before_out = estimate_tokens(ROUND_BEFORE)
+    after_out = estimate_tokens(ROUND_AFTER)
+
+    print(f"Блок бросков:\n{rolls}\n")
+    print("Иллюстрация на одном раунде, написанном вручную в двух форматах, — не замер ответов модели")
+    print(f"{'':>16} {'вход':>8} {'выход':>8}")
+    print(f"{'мастер бросает':>16} {args.context:>8} {before_out:>8}")
+    print(f"{'локально':>16} {args.context + tray:>8} {after_out:>8}")
+    saved = before_out - after_out
+    print(f"Выход: −{saved} токенов на раунд ({saved / before_out:.0%}), вход: +{tray}")
+
+    clarify = args.context + MESSAGE_OVERHEAD_TOKENS + estimate_tokens(CLARIFY_ACTION)
+    print(f"Каждый лишний ход на переспрос броска: ~{clarify} входных + "
+          f"~{estimate_tokens(CLARIFY_REPLY)} выходных токенов — с локальными бросками его нет")
+
+    seconds = timeit.timeit(lambda: combat_rolls(CHARACTER, ACTION, rng), number=args.repeat)
+    print(f"Бросок на ход: {seconds / args.repeat * 1e6:.1f} мкс")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Вес истории диалога до и после сворачивания механики (history.compact_history).
+
+Сессия синтетическая: десять ходов в формате ответов мастера из prompt.txt —
+сцены с вариантами, добыча с XP и инвентарём, статус, раунды боя. В ответах
+есть и то, что сворачиваться не должно: реплики NPC (в том числе латиницей)
+и эмодзи внутри повествования. Цифры — для этой выборки, а не для живых сессий;
+живые показывает /history у администратора.
+
+    python bench_history.py [--repeat 2000] [--show]
+"""
+import sys
+import timeit
+import argparse
+
+from history import Turn, compact_history, footprint
+
+SCENE = """Дождь стучит по черепице таверны «Хромой гусь». Хозяин, Бренн, протирает кружку и кивает на лестницу 🕯️ — там, наверху, тебя ждёт заказчик.
+
+Бренн: «Второй этаж, дверь в конце. И не шуми, он не любит гостей».
+
+📍 Таверна «Хромой гусь» | 📅 День {day} | ⏰ Вечер
+❤️ 24/28 | 🔮 2/3 | 📦 Inventory: 14/36
+
+1. Подняться к заказчику
+2. Расспросить Бренна о заказчике
+3. Заказать ужин и осмотреться
+4. Свой вариант"""
+
+LOOT = """Сундук поддаётся с третьей попытки. Внутри — свёрток промасленной ткани и кошель, туго набитый монетами.
+
+🎁 LOOT: Кинжал +1 (1к4+1 колющий, лёгкий), Зелье лечения (2к4+2)
+💰 Wallet: 🟡{gold} | ⚪12 | 📦 Inventory: 16/36
+🎓 XP: Торвин: +50 → {xp}/900
+TOTAL XP: Торвин: {xp}/900
+
+Стражник у ворот кричит: Guard: "Halt! Who goes there?"
+
+1. Спрятать находку и выйти
+2. Окликнуть стражника
+3. Уйти через окно
+4. Свой вариант"""
+
+COMBAT = """Клинок описывает дугу и врезается орку в плечо; тот ревёт и отшатывается, но второй уже заходит слева, занося тяжёлый тесак.
+
+🎲 Атака: [14] + 3 (СИЛ) + 2 (мастерство) = 19 vs AC 13 → попадание
+🎲 Урон: 1к8 [6] + 3 (СИЛ) = 9 рубящего
+Орк-1: ❤️ 15 → 6
+🎲 Атака орка-2: [11] + 5 = 16 vs AC 16 → попадание
+🎲 Урон: 1к12 [7] + 3 = 10 рубящего
+
+**Торвин**: ❤️ 28 → {hp}/28 | 🔮 — | 🏹 —
+**Enemies**: 1.Орк-1 ❤️6/15 | 2.Орк-2 ❤️15/15 | Distances: 1.5m
+
+Твой ход. Движение + Действие + Бонусное?
+1. Добить раненого орка
+2. Отступить к двери
+3. Толкнуть орка-2 щитом
+4. Свой вариант"""
+
+
+def make_session(turns: int = 10) -> list:
+    history = []
+    for index in range(turns):
+        history.append(Turn("user", f"Выбираю вариант {index % 3 + 1}."))
+        kind = index % 3
+        if kind == 0:
+            reply = SCENE.format(day=index + 1)
+        elif kind == 1:
+            reply = LOOT.format(gold=40 + index * 5, xp=300 + index * 50)
+        else:
+            reply = COMBAT.format(hp=28 - index)
+        history.append(Turn("assistant", reply))
+    return history
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Вес истории до и после сворачивания механики")
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=10, help="ходов в синтетической сессии")
+    parser.add_argument("--show", action="store_true", help="показать свёрнутые ответы")
+    args = parser.parse_args()
+
+    history = make_session(args.turns)
+    compacted, delta = compact_history(history)
+    before = footprint(history)
+    after = footprint(compacted)
+
+    print(f"Синтетическая сессия: {before['messages']} реплик, свёрнуто ответов мастера: {delta[0]}")
+    print(f"Байт: {before['bytes_dict']} → {after['bytes']} "
+          f"(только сворачивание, в формате dict: → {after['bytes_dict']})")
+    print(f"Токенов за запрос: {before['tokens']} → {after['tokens']}")
+
+    seconds = timeit.timeit(lambda: compact_history(compacted), number=args.repeat)
+    print(f"Повторный проход по уже свёрнутой истории: {seconds / args.repeat * 1e3:.3f} мс")
+
+    if args.show:
+        for turn in compacted:
+            if turn.role == "assistant":
+                print("\n" + "─" * 40 + "\n" + turn.content)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
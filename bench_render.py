@@ -0,0 +1,94 @@
+"""
+Микро-бенчмарк рендера ответа мастера: прежний markdown_to_html (несколько
+проходов regex и плейсхолдеры) против однопроходного render.markdown_to_html
+и нарезки split_html.
+
+    python bench_render.py [--repeat 2000]
+"""
+import re
+import sys
+import timeit
+import argparse
+
+from render import markdown_to_html, split_html, TELEGRAM_TEXT_LIMIT
+
+
+def legacy_markdown_to_html(text: str) -> str:
+    """Прежняя реализация из handlers.py — только для сравнения."""
+    if not text:
+        return text
+
+    html_tags = []
+    tag_pattern = r'<[^>]+>'
+
+    def replace_tag(match):
+        html_tags.append(match.group(0))
+        return f"__HTML_TAG_{len(html_tags)-1}__"
+
+    text = re.sub(tag_pattern, replace_tag, text)
+    text = (
+        text.replace("&", "&amp;")
+            .replace("<", "&lt;")
+            .replace(">", "&gt;")
+    )
+    for i, tag in enumerate(html_tags):
+        placeholder = f"__HTML_TAG_{i}__"
+        if placeholder in text:
+            text = text.replace(placeholder, tag)
+
+    text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
+    text = re.sub(r'(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<i>\1</i>', text)
+
+    lines = text.split('\n')
+    result_lines = []
+    for line in lines:
+        if re.match(r'^\s*-\s+', line):
+            line = re.sub(r'^\s*-\s+', '• ', line)
+        result_lines.append(line)
+    return '\n'.join(result_lines)
+
+
+def sample_reply(paragraphs: int = 12) -> str:
+    """Ответ размером с 2000-токенный ответ мастера: повествование, механика, варианты."""
+    paragraph = (
+        "**Таверна «Ржавый якорь»** встречает тебя запахом *жареного лука* и мокрой шерсти. "
+        "Трактирщик — дварф с <b>седой</b> бородой — кивает на свободный стол & ворчит о погоде. "
+        "У очага двое наёмников спорят о цене за голову тролля: 50 < 70, но *риск* выше."
+    )
+    mechanics = (
+        "- ❤️ HP 12/12 | 🔮 Слоты 2/2\n"
+        "- 💰 🟡 7 | 📦 Inventory 5/36\n"
+        "- 📅 DAY 1 | 📍 Таверна"
+    )
+    options = "1. **Подсесть** к наёмникам\n2. Расспросить трактирщика\n3. Выйти под дождь\n4. Свой вариант"
+    return "\n\n".join([paragraph] * paragraphs + [mechanics, options])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк markdown_to_html")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    text = sample_reply()
+    long_text = sample_reply(paragraphs=40)
+    print(f"Ответ: {len(text)} символов; длинный ответ: {len(long_text)} символов")
+
+    for name, func in (("прежний", legacy_markdown_to_html), ("однопроходный", markdown_to_html)):
+        seconds = timeit.timeit(lambda: func(text), number=args.repeat)
+        print(f"{name:>14}: {seconds / args.repeat * 1e6:8.1f} мкс/ответ")
+
+    seconds = timeit.timeit(lambda: split_html(markdown_to_html(long_text)), number=max(1, args.repeat // 10))
+    chunks = split_html(markdown_to_html(long_text))
+    print(f"{'рендер+нарезка':>14}: {seconds / max(1, args.repeat // 10) * 1e6:8.1f} мкс/длинный ответ "
+          f"→ {len(chunks)} сообщ. ({', '.join(str(len(c)) for c in chunks)} симв., лимит {TELEGRAM_TEXT_LIMIT})")
+
+    # Одиночное «<» прежняя версия принимала за начало тега (и ломала разметку),
+    # поэтому результаты сравниваем на тексте без него
+    plain = text.replace(" < ", " ")
+    same = legacy_markdown_to_html(plain) == markdown_to_html(plain)
+    print(f"Результат совпадает с прежним (без одиночных «<»): {'да' if same else 'нет'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,138 @@
+import os
+import re
+import time
+import logging
+from dataclasses import dataclass
+from typing import Optional
+
+from config import CATALOG_RELOAD_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Базовая директория проекта (где лежат weapons.txt, spells.txt, equipment.txt, wallets.txt)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CATALOG_FILES = {
+    "weapons": os.path.join(BASE_DIR, "weapons.txt"),
+    "spells": os.path.join(BASE_DIR, "spells.txt"),
+    "equipment": os.path.join(BASE_DIR, "equipment.txt"),
+    "wallets": os.path.join(BASE_DIR, "wallets.txt"),
+}
+
+# Кости в русской нотации: 1к8, 2к6, 1к4+1, 1к8+ХАР
+_DICE_RE = re.compile(r"(\d*к\d+(?:\s*[+−-]\s*(?:\d+|[А-ЯЁ]{3}))?)\s*([а-яё]+)?")
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    """Одна строка каталога в разобранном виде."""
+    raw: str
+    name: str
+    dice: Optional[str]
+    damage_type: Optional[str]
+    properties: tuple
+
+
+def parse_entry(line: str) -> CatalogEntry:
+    """
+    Разбирает строку вида "Двуручный меч — 2к6 рубящий, двуручное".
+    Строки без " — " (кошели) целиком считаются названием, свойства — через запятую.
+    """
+    if " — " in line:
+        name, details = line.split(" — ", 1)
+    else:
+        name, details = line, ""
+
+    dice = damage_type = None
+    match = _DICE_RE.search(details)
+    if match:
+        dice = match.group(1).replace(" ", "")
+        damage_type = match.group(2)
+
+    parts = details if details else line
+    properties = tuple(
+        part.strip()
+        for chunk in parts.split("|")
+        for part in chunk.split(",")
+        if part.strip()
+    )
+    return CatalogEntry(line, name.strip(), dice, damage_type, properties)
+
+
+def parse_catalog_file(path: str) -> dict:
+    """Разбирает файл с секциями "## Класс" в словарь {класс: (CatalogEntry, ...)}."""
+    with open(path, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    index = {}
+    current = None
+    for line in content.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith("##"):
+            current = stripped.lstrip("#").strip()
+            index.setdefault(current, [])
+        elif current is not None and stripped and not stripped.startswith("#"):
+            index[current].append(parse_entry(stripped))
+    return {name: tuple(entries) for name, entries in index.items()}
+
+
+class Catalog:
+    """
+    Каталог оружия, заклинаний, снаряжения и кошелей.
+
+    Файлы разбираются один раз; поиск по классу — обращение к словарю.
+    Не чаще раза в CATALOG_RELOAD_INTERVAL секунд сверяется mtime файлов:
+    изменённый файл разбирается заново, и индекс подменяется целиком.
+    """
+
+    def __init__(self, files: dict, reload_interval: float = CATALOG_RELOAD_INTERVAL):
+        self.files = files
+        self.reload_interval = reload_interval
+        self._index = {}
+        self._mtimes = {}
+        self._checked_at = 0.0
+        self.reload()
+
+    def reload(self, force: bool = True) -> None:
+        index = dict(self._index)
+        mtimes = dict(self._mtimes)
+        for kind, path in self.files.items():
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError as e:
+                logger.warning("Файл каталога %s недоступен: %s", path, e)
+                index.setdefault(kind, {})
+                continue
+            if not force and mtimes.get(kind) == mtime:
+                continue
+            try:
+                index[kind] = parse_catalog_file(path)
+                mtimes[kind] = mtime
+            except Exception as e:
+                logger.exception("Ошибка загрузки данных из %s: %s", path, e)
+                index.setdefault(kind, {})
+        # Подмена одной операцией: читатели видят либо старый, либо новый индекс
+        self._index, self._mtimes = index, mtimes
+        self._checked_at = time.monotonic()
+
+    def _maybe_reload(self) -> None:
+        if time.monotonic() - self._checked_at >= self.reload_interval:
+            self.reload(force=False)
+
+    def entries(self, kind: str, class_name: str) -> tuple:
+        """Записи каталога kind ("weapons", "spells", "equipment", "wallets") для класса."""
+        self._maybe_reload()
+        return self._index.get(kind, {}).get(class_name, ())
+
+    def find(self, kind: str, name: str) -> Optional[CatalogEntry]:
+        """Ищет запись по названию во всех классах (без учёта регистра)."""
+        self._maybe_reload()
+        needle = name.strip().lower()
+        for entries in self._index.get(kind, {}).values():
+            for entry in entries:
+                if entry.name.lower() == needle:
+                    return entry
+        return None
+
+
+catalog = Catalog(CATALOG_FILES)
@@ -4,11 +4,13 @@ from dotenv import load_dotenv
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
-# OpenAI/OpenRouter токен (не используется, заменен на Yandex GPT)
+# OpenAI/OpenRouter токен (резервный OpenAI-совместимый провайдер, см. OPENAI_API_KEY)
 AI_TOKEN = os.getenv('AI_TOKEN', '')
 
 # Telegram Bot Token
 TG_TOKEN = os.getenv('TG_TOKEN', '')
+# Свой сервер Bot API (telegram-bot-api) или локальная заглушка; пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
 
 # Yandex GPT настройки
 # ВАЖНО: Для работы API ключа необходимо:
@@ -21,4 +23,159 @@ YANDEX_API_KEY = os.getenv('YANDEX_API_KEY', '')
 # Формат: gpt://<folder-id>/<model-name>
 # folder-id - ID каталога в Yandex Cloud (можно найти в консоли)
 # model-name: yandexgpt-lite, yandexgpt, yandexgpt-pro
-YANDEX_MODEL_URI = os.getenv('YANDEX_MODEL_URI', 'gpt://b1gdoose5habmm2ishlb/qwen3-235b-a22b-fp8/latest')
\ No newline at end of file
+YANDEX_MODEL_URI = os.getenv('YANDEX_MODEL_URI', 'gpt://b1gdoose5habmm2ishlb/qwen3-235b-a22b-fp8/latest')
+# Адрес completion API (переопределяется для локальной заглушки в нагрузочном прогоне)
+YANDEX_API_URL = os.getenv('YANDEX_API_URL', 'https://llm.api.cloud.yandex.net/foundationModels/v1/completion')
+
+# Общий HTTP-пул для запросов к Yandex GPT
+# Максимум соединений всего и на один хост
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', '100'))
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', '20'))
+# Сколько секунд держать простаивающее keep-alive соединение
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', '60'))
+# Время жизни DNS-кэша (секунды)
+HTTP_DNS_TTL = int(os.getenv('HTTP_DNS_TTL', '300'))
+# Сжимать тело запроса gzip (промпт ~29 КБ); включайте, только если сервер принимает Content-Encoding: gzip
+HTTP_GZIP_REQUESTS = os.getenv('HTTP_GZIP_REQUESTS', '0') == '1'
+
+# Потоковый режим: ответ мастера появляется постепенно, редактируя одно сообщение
+YANDEX_STREAMING = os.getenv('YANDEX_STREAMING', '0') == '1'
+# Минимальный интервал между правками сообщения (Telegram: ~1 правка в секунду на чат)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+# Хранилище FSM: sqlite (по умолчанию, переживает перезапуск), memory или redis (нужен пакет redis)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+# Адрес Redis для STORAGE_BACKEND=redis — общее состояние воркеров на нескольких машинах
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+STORAGE_PATH = os.getenv('STORAGE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fsm.sqlite3'))
+# Как часто (секунды) сбрасывать накопленные изменения на диск
+STORAGE_FLUSH_INTERVAL = float(os.getenv('STORAGE_FLUSH_INTERVAL', '0.5'))
+# Сколько записей держать в памяти (чистые записи сверх лимита вытесняются)
+STORAGE_CACHE_SIZE = int(os.getenv('STORAGE_CACHE_SIZE', '5000'))
+
+# Летопись кампании: ходы, выпавшие из окна истории, сворачиваются в краткое содержание
+# Сколько вытесненных реплик копить перед одним фоновым запросом суммаризации
+SUMMARY_BATCH_MESSAGES = int(os.getenv('SUMMARY_BATCH_MESSAGES', '6'))
+# Максимальная длина летописи (символы)
+SUMMARY_MAX_CHARS = int(os.getenv('SUMMARY_MAX_CHARS', '2500'))
+# Предел очереди несвёрнутых реплик (если суммаризатор недоступен)
+SUMMARY_MAX_PENDING = int(os.getenv('SUMMARY_MAX_PENDING', '40'))
+# Сколько последних ответов мастера хранить целиком; в более старых механические
+# блоки (LOOT, XP, STATUS, таблицы торговли) сворачиваются в одну строку
+HISTORY_FULL_REPLIES = int(os.getenv('HISTORY_FULL_REPLIES', '2'))
+
+# Бюджет входных токенов на запрос: системный промпт + летопись + последние ходы
+INPUT_TOKEN_BUDGET = int(os.getenv('INPUT_TOKEN_BUDGET', '16000'))
+# Максимум токенов в ответе мастера
+YANDEX_MAX_TOKENS = int(os.getenv('YANDEX_MAX_TOKENS', '2000'))
+# Уточнять локальную оценку токенов через эндпоинт tokenize (результаты кэшируются по хэшу текста)
+TOKENIZE_CALIBRATION = os.getenv('TOKENIZE_CALIBRATION', '0') == '1'
+
+# Статус/инвентарь/заклинания рисуются локально, пока с последней синхронизации
+# листа персонажа прошло не больше стольких ходов; дальше — запрос к мастеру
+SHEET_MAX_STALE_TURNS = int(os.getenv('SHEET_MAX_STALE_TURNS', '3'))
+
+# Как часто (секунды) проверять, не изменились ли weapons/spells/equipment/wallets.txt
+CATALOG_RELOAD_INTERVAL = float(os.getenv('CATALOG_RELOAD_INTERVAL', '5'))
+
+# Планировщик запросов к LLM: одновременно выполняемые запросы и лимит оценочных токенов в минуту (0 — без лимита)
+LLM_MAX_IN_FLIGHT = int(os.getenv('LLM_MAX_IN_FLIGHT', '8'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '0'))
+
+# Стартовая сцена генерируется заранее, пока игрок выбирает предысторию.
+# Цена: лишний запрос к LLM на каждую смену имени/расы/класса (в том числе у тех,
+# кто бросил создание персонажа) плюс фоновое пополнение пула вступлений —
+# поэтому по умолчанию выключено
+OPENING_SPECULATION = os.getenv('OPENING_SPECULATION', '0') == '1'
+# Через сколько секунд забыть предварительную сцену, если создание персонажа так и не закончили
+OPENING_PENDING_TTL = float(os.getenv('OPENING_PENDING_TTL', '900'))
+# Сколько обезличенных вступлений держать про запас на каждую пару раса/класс
+OPENING_POOL_SIZE = int(os.getenv('OPENING_POOL_SIZE', '1'))
+# Сколько секунд ждать незавершённую предварительную генерацию в конце создания персонажа
+OPENING_WAIT_TIMEOUT = float(os.getenv('OPENING_WAIT_TIMEOUT', '60'))
+
+# Локальные броски (dice.py): в бою к ходу игрока добавляются готовые атаки, урон и спасброски
+LOCAL_DICE = os.getenv('LOCAL_DICE', '1') == '1'
+
+# Кэш ответов на справочные кнопки меню (репутация, задания, слухи, энциклопедия):
+# предел памяти в байтах, 0 — выключен
+MENU_CACHE_MAX_BYTES = int(os.getenv('MENU_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+
+# Фоновые продолжения для вариантов 1/2/3, пока игрок читает сцену: off, one (самый вероятный) или all
+CHOICE_PREFETCH = os.getenv('CHOICE_PREFETCH', 'off')
+# Лимиты расхода на фоновые продолжения, оценочных токенов в сутки: на игрока и всего (0 — без лимита)
+CHOICE_PREFETCH_USER_TOKENS = int(os.getenv('CHOICE_PREFETCH_USER_TOKENS', '60000'))
+CHOICE_PREFETCH_GLOBAL_TOKENS = int(os.getenv('CHOICE_PREFETCH_GLOBAL_TOKENS', '3000000'))
+
+# Режим приёма обновлений: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес бота для регистрации вебхука (пусто — вебхук не регистрируется, удобно для локальной проверки)
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+# Секрет, который Telegram присылает в заголовке X-Telegram-Bot-Api-Secret-Token (обязателен в режиме webhook)
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+# Пул обработки обновлений: число воркеров и предел очереди (сверх него — 503, Telegram повторит)
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '32'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+
+# LLM-провайдеры в порядке предпочтения: yandex, openai (любой OpenAI-совместимый API)
+LLM_PROVIDERS = os.getenv('LLM_PROVIDERS', 'yandex')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL', 'https://api.openai.com/v1')
+OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', AI_TOKEN)
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+# Таймаут одной попытки (секунды); общий дедлайн задаёт вызывающий код
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+# Предел на весь ход (очередь планировщика + генерация), после него запрос отменяется
+GENERATION_TIMEOUT = float(os.getenv('GENERATION_TIMEOUT', '180'))
+# Повторы к одному провайдеру и базовая задержка экспоненциального backoff со случайным джиттером
+LLM_RETRIES = int(os.getenv('LLM_RETRIES', '2'))
+LLM_RETRY_BASE_DELAY = float(os.getenv('LLM_RETRY_BASE_DELAY', '0.5'))
+# Предохранитель: после стольких ошибок подряд провайдер отключается на LLM_BREAKER_COOLDOWN секунд
+LLM_BREAKER_FAILURES = int(os.getenv('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+# Хеджирование: если основной провайдер не ответил за своё p95, дублировать запрос следующему
+LLM_HEDGING = os.getenv('LLM_HEDGING', '0') == '1'
+# Сколько замеров задержки нужно, прежде чем p95 считается надёжным
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', '20'))
+
+# Учёт расхода токенов по игрокам (таблица usage в базе STORAGE_PATH)
+# Дневная квота токенов на игрока (вход + выход, сутки по UTC); 0 — без ограничений
+USER_DAILY_TOKEN_QUOTA = int(os.getenv('USER_DAILY_TOKEN_QUOTA', '0'))
+# Как часто (секунды) сбрасывать учёт на диск и сколько последних дней держать в памяти
+USAGE_FLUSH_INTERVAL = float(os.getenv('USAGE_FLUSH_INTERVAL', '5'))
+USAGE_KEEP_DAYS = int(os.getenv('USAGE_KEEP_DAYS', '7'))
+# Цена 1000 токенов (вход / выход) для отчёта о стоимости, в валюте счёта
+USAGE_PRICE_INPUT_1K = float(os.getenv('USAGE_PRICE_INPUT_1K', '0.4'))
+USAGE_PRICE_OUTPUT_1K = float(os.getenv('USAGE_PRICE_OUTPUT_1K', '0.4'))
+# Telegram ID администраторов через запятую (команда /usage)
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').replace(' ', '').split(',') if x}
+
+# Исходящие сообщения (outbound.py): общий лимит бота, сообщений в секунду (0 — без лимита)
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+# Лимит на личный чат и на группу (сообщений в секунду) и запас для коротких серий сообщений
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_GROUP_RATE = float(os.getenv('OUTBOUND_GROUP_RATE', '0.33'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+# Сколько раз повторять запрос после flood-wait (429 Retry After), прежде чем вернуть ошибку
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# Сохранения кампаний (saves.py): число слотов на игрока и сколько последних реплик истории класть в снимок
+# (более ранние реплики окна уходят в снимке в очередь летописи)
+SAVE_SLOTS = int(os.getenv('SAVE_SLOTS', '3'))
+SAVE_HISTORY_MESSAGES = int(os.getenv('SAVE_HISTORY_MESSAGES', '16'))
+# Файл SQLite со слотами сохранений. По умолчанию — файл базы FSM, в том числе при
+# STORAGE_BACKEND=redis: воркеры одной машины делят его, и перезапуск воркера его не стирает.
+# Если воркеры работают на нескольких машинах, укажите путь на общем постоянном диске.
+# Пусто — сохранения в памяти процесса (только для STORAGE_BACKEND=memory с одним процессом)
+SAVES_PATH = os.getenv('SAVES_PATH', '' if STORAGE_BACKEND == 'memory' else STORAGE_PATH)
+
+# Многопроцессный режим (supervisor.py): число воркеров; больше 1 — run.py запускает супервизор,
+# который раздаёт обновления воркерам по chat_id. Общие лимиты (LLM, исходящие) делятся между воркерами.
+# Только Linux/macOS: на Windows супервизор не запустится, нужен BOT_WORKERS=1
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+# Номер воркера; выставляет супервизор (-1 — обычный одиночный процесс)
+BOT_WORKER_INDEX = int(os.getenv('BOT_WORKER_INDEX', '-1'))
+# Сколько секунд воркер дорабатывает принятые обновления при остановке или перезапуске
+WORKER_STOP_TIMEOUT = float(os.getenv('WORKER_STOP_TIMEOUT', '60'))
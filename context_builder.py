@@ -0,0 +1,199 @@
+import re
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+import aiohttp
+
+from config import (
+    YANDEX_API_KEY,
+    YANDEX_MODEL_URI,
+    INPUT_TOKEN_BUDGET,
+    TOKENIZE_CALIBRATION,
+)
+from http_client import get_http_session, encode_json_body
+
+logger = logging.getLogger(__name__)
+
+# Эндпоинт подсчёта токенов Yandex (используется только для калибровки оценки)
+YANDEX_TOKENIZE_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/tokenize"
+
+# Служебные токены на каждое сообщение (роль, разделители)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Заголовок, с которым летопись подставляется в запрос к мастеру
+SUMMARY_HEADER = "[CAMPAIGN SUMMARY]\nКраткое содержание предыдущих событий кампании:\n"
+
+_CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
+_LATIN_DIGIT_RE = re.compile(r"[A-Za-z0-9]")
+_SPACE_RE = re.compile(r"\s")
+
+
+class TokenCalibration:
+    """
+    Поправочный коэффициент к локальной оценке.
+    Точные значения берутся у эндпоинта tokenize и кэшируются по хэшу текста.
+    """
+
+    def __init__(self, max_cached: int = 2048):
+        self.ratio = 1.0
+        self.samples = 0
+        self.max_cached = max_cached
+        self._exact = OrderedDict()
+        self._in_flight = set()
+
+    def exact(self, text: str):
+        return self._exact.get(_text_hash(text))
+
+    def record(self, text: str, estimate: int, exact: int) -> None:
+        digest = _text_hash(text)
+        self._exact[digest] = exact
+        while len(self._exact) > self.max_cached:
+            self._exact.popitem(last=False)
+        if estimate > 0:
+            # Скользящее среднее, чтобы один необычный текст не перекосил оценку
+            self.samples += 1
+            weight = 1.0 / min(self.samples, 20)
+            self.ratio += (exact / estimate - self.ratio) * weight
+
+
+calibration = TokenCalibration()
+
+
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+# Оценки по sha1 текста: кэш не держит в памяти сами тексты — системные промпты
+# сессий, длинные ответы мастера и летописи
+_ESTIMATE_CACHE_SIZE = 4096
+_estimates = OrderedDict()
+
+
+def _raw_estimate(text: str) -> int:
+    digest = _text_hash(text)
+    cached = _estimates.get(digest)
+    if cached is not None:
+        _estimates.move_to_end(digest)
+        return cached
+    # Кириллица в BPE-словарях дробится сильнее латиницы,
+    # эмодзи и пунктуация чаще всего занимают отдельный токен
+    cyrillic = len(_CYRILLIC_RE.findall(text))
+    latin = len(_LATIN_DIGIT_RE.findall(text))
+    spaces = len(_SPACE_RE.findall(text))
+    other = len(text) - cyrillic - latin - spaces
+    estimate = int(cyrillic / 2.8 + latin / 4.0 + other / 1.5) + 1
+    _estimates[digest] = estimate
+    if len(_estimates) > _ESTIMATE_CACHE_SIZE:
+        _estimates.popitem(last=False)
+    return estimate
+
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов текста (с учётом калибровки, если она была)."""
+    if not text:
+        return 0
+    exact = calibration.exact(text) if TOKENIZE_CALIBRATION else None
+    if exact is not None:
+        return exact
+    return int(_raw_estimate(text) * calibration.ratio)
+
+
+def estimate_message_tokens(message: dict) -> int:
+    return estimate_tokens(message.get("content", message.get("text", ""))) + MESSAGE_OVERHEAD_TOKENS
+
+
+async def _fetch_exact_tokens(text: str) -> None:
+    digest = _text_hash(text)
+    try:
+        body, headers = encode_json_body({"modelUri": YANDEX_MODEL_URI, "text": text})
+        headers["Authorization"] = f"Api-Key {YANDEX_API_KEY}"
+        session = get_http_session()
+        async with session.post(
+            YANDEX_TOKENIZE_URL,
+            headers=headers,
+            data=body,
+            timeout=aiohttp.ClientTimeout(total=15)
+        ) as response:
+            if response.status != 200:
+                logger.debug("tokenize вернул %s", response.status)
+                return
+            result = await response.json()
+        calibration.record(text, _raw_estimate(text), len(result.get("tokens", [])))
+    except Exception as e:
+        logger.debug("Не удалось откалибровать оценку токенов: %s", e)
+    finally:
+        calibration._in_flight.discard(digest)
+
+
+def schedule_calibration(text: str) -> None:
+    """Запускает в фоне точный подсчёт токенов для текста, если его ещё нет в кэше."""
+    if not TOKENIZE_CALIBRATION or not text:
+        return
+    digest = _text_hash(text)
+    if digest in calibration._in_flight or calibration.exact(text) is not None:
+        return
+    calibration._in_flight.add(digest)
+    asyncio.create_task(_fetch_exact_tokens(text))
+
+
+class ContextReport:
+    """Оценка размера одного запроса к LLM."""
+    __slots__ = ("system_tokens", "summary_tokens", "history_tokens", "kept_messages", "dropped_messages", "budget")
+
+    def __init__(self, system_tokens, summary_tokens, history_tokens, kept_messages, dropped_messages, budget):
+        self.system_tokens = system_tokens
+        self.summary_tokens = summary_tokens
+        self.history_tokens = history_tokens
+        self.kept_messages = kept_messages
+        self.dropped_messages = dropped_messages
+        self.budget = budget
+
+    @property
+    def total_tokens(self) -> int:
+        return self.system_tokens + self.summary_tokens + self.history_tokens
+
+    def __str__(self) -> str:
+        return (
+            f"~{self.total_tokens}/{self.budget} токенов "
+            f"(промпт {self.system_tokens}, летопись {self.summary_tokens}, "
+            f"история {self.history_tokens} в {self.kept_messages} сообщ., отброшено {self.dropped_messages})"
+        )
+
+
+def assemble_context(history: list, system_prompt: str, summary: str = "", budget: int = INPUT_TOKEN_BUDGET) -> tuple:
+    """
+    Собирает историю для запроса так, чтобы системный промпт + летопись + последние ходы
+    укладывались в бюджет входных токенов. Старые ходы отбрасываются первыми,
+    последняя реплика игрока остаётся всегда.
+
+    Returns:
+        tuple: (список сообщений для convert_history_to_yandex_format, ContextReport)
+    """
+    system_tokens = estimate_tokens(system_prompt) + MESSAGE_OVERHEAD_TOKENS if system_prompt else 0
+    schedule_calibration(system_prompt)
+
+    summary_message = None
+    summary_tokens = 0
+    if summary:
+        summary_message = {"role": "system", "content": SUMMARY_HEADER + summary}
+        summary_tokens = estimate_message_tokens(summary_message)
+
+    remaining = budget - system_tokens - summary_tokens
+    kept = []
+    history_tokens = 0
+    for msg in reversed(history):
+        cost = estimate_message_tokens(msg)
+        if kept and history_tokens + cost > remaining:
+            break
+        kept.append(msg)
+        history_tokens += cost
+    kept.reverse()
+
+    messages = ([summary_message] if summary_message else []) + kept
+    report = ContextReport(
+        system_tokens, summary_tokens, history_tokens,
+        len(kept), len(history) - len(kept), budget,
+    )
+    return messages, report
@@ -0,0 +1,233 @@
+import re
+import random
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from catalog import catalog
+from game_state import GameState
+
+# Локальные броски костей и механика боя.
+# Мастер больше не бросает кости сам: к ходу игрока в бою добавляется блок
+# [БРОСКИ] с уже посчитанными атаками, уроном и спасбросками по листу персонажа,
+# а модель только описывает результат. Нотация — русская, как в weapons.txt
+# и spells.txt: 1к8, 2к6, 1к4+1, 1к8+ХАР.
+
+# Сокращения характеристик в нотации → названия в листе персонажа
+STAT_ABBREVIATIONS = {
+    "СИЛ": "Сила",
+    "ЛОВ": "Ловкость",
+    "ТЕЛ": "Телосложение",
+    "ИНТ": "Интеллект",
+    "МУД": "Мудрость",
+    "ХАР": "Харизма",
+}
+
+# Владение спасбросками по классам (PHB)
+SAVE_PROFICIENCIES = {
+    "Воин": ("СИЛ", "ТЕЛ"),
+    "Паладин": ("МУД", "ХАР"),
+    "Плут": ("ЛОВ", "ИНТ"),
+    "Волшебник": ("ИНТ", "МУД"),
+    "Жрец": ("МУД", "ХАР"),
+    "Бард": ("ЛОВ", "ХАР"),
+    "Варвар": ("СИЛ", "ТЕЛ"),
+    "Друид": ("ИНТ", "МУД"),
+    "Монах": ("СИЛ", "ЛОВ"),
+    "Следопыт": ("СИЛ", "ЛОВ"),
+    "Чародей": ("ТЕЛ", "ХАР"),
+    "Изобретатель": ("ТЕЛ", "ИНТ"),
+}
+
+# Базовая характеристика заклинаний; у классов без магии заклинаний нет
+SPELLCASTING_STATS = {
+    "Волшебник": "ИНТ",
+    "Изобретатель": "ИНТ",
+    "Жрец": "МУД",
+    "Друид": "МУД",
+    "Следопыт": "МУД",
+    "Бард": "ХАР",
+    "Паладин": "ХАР",
+    "Чародей": "ХАР",
+}
+
+_NOTATION_RE = re.compile(r"(\d*)к(\d+)(?:\s*([+−-])\s*(\d+|[А-ЯЁ]{3}))?")
+_SAVE_RE = re.compile(r"спас\w*\s+([А-ЯЁ]{3})")
+_WORD_RE = re.compile(r"[а-яё]+")
+
+
+@dataclass(frozen=True)
+class Dice:
+    """Разобранная нотация: count к sides + bonus (+ модификатор stat)."""
+    count: int
+    sides: int
+    bonus: int = 0
+    stat: Optional[str] = None
+
+    def __str__(self) -> str:
+        text = f"{self.count}к{self.sides}"
+        if self.stat:
+            text += f"+{self.stat}"
+        if self.bonus:
+            text += f"{self.bonus:+d}"
+        return text
+
+
+@lru_cache(maxsize=256)
+def parse_dice(text: str) -> Optional[Dice]:
+    """ "2к6" → Dice(2, 6); "1к4+ХАР" → Dice(1, 4, stat="ХАР"); без кубов — None."""
+    match = _NOTATION_RE.search(text or "")
+    if not match:
+        return None
+    count, sides, sign, extra = match.groups()
+    bonus, stat = 0, None
+    if extra:
+        if extra.isdigit():
+            bonus = int(extra) * (1 if sign == "+" else -1)
+        elif extra in STAT_ABBREVIATIONS:
+            stat = extra
+    return Dice(int(count or 1), int(sides), bonus, stat)
+
+
+def ability_modifier(score: int) -> int:
+    return (score - 10) // 2
+
+
+def proficiency_bonus(level: int) -> int:
+    return 2 + (max(1, level) - 1) // 4
+
+
+def stat_modifier(stats: dict, abbreviation: str) -> int:
+    return ability_modifier(stats.get(STAT_ABBREVIATIONS[abbreviation], 10))
+
+
+def roll_dice(dice: Dice, stats: dict, rng=random, extra_modifier: int = 0, critical: bool = False) -> int:
+    """Сумма броска; при критическом попадании кубы бросаются дважды."""
+    count = dice.count * 2 if critical else dice.count
+    total = sum(rng.randint(1, dice.sides) for _ in range(count)) + dice.bonus + extra_modifier
+    if dice.stat:
+        total += stat_modifier(stats, dice.stat)
+    return max(0, total)
+
+
+def roll_4d6_drop_lowest(rng=random):
+    rolls = [rng.randint(1, 6) for _ in range(4)]
+    rolls_sorted = sorted(rolls)
+    return sum(rolls_sorted[1:]), rolls, rolls_sorted[0]
+
+
+def _signed(value: int) -> str:
+    return f"{value:+d}"
+
+
+# ---------- Что игрок делает в этом ходу ----------
+
+def chosen_option(reply: str, choice: str) -> str:
+    """Строка варианта N из последней сцены мастера ("1. **Атаковать** орка мечом")."""
+    match = re.search(rf"^[\s*]*{re.escape(choice)}(?:[.)]|️⃣)\s*(.+)$", reply or "", re.M)
+    return match.group(1) if match else ""
+
+
+def _stems(name: str) -> tuple:
+    # Название до "+" ("Длинный лук +20 стрел", "Длинный меч + щит"), основы слов без окончаний
+    words = _WORD_RE.findall(name.split("+", 1)[0].lower())
+    return tuple(word[:max(3, len(word) - 2)] for word in words if len(word) >= 3)
+
+
+def _mentions(action_words: list, name: str) -> bool:
+    stems = _stems(name)
+    return bool(stems) and all(any(word.startswith(stem) for word in action_words) for stem in stems)
+
+
+# ---------- Броски на ход ----------
+
+def _attack_roll(bonus: int, rng) -> tuple:
+    """(натуральный d20, текст) — 20 критическое попадание, 1 автоматический промах."""
+    d20 = rng.randint(1, 20)
+    if d20 == 20:
+        return d20, f"🎲20{_signed(bonus)}={20 + bonus} крит!"
+    if d20 == 1:
+        return d20, "🎲1 промах"
+    return d20, f"🎲{d20}{_signed(bonus)}={d20 + bonus}"
+
+
+def _weapon_line(entry, stats: dict, char_class: str, proficiency: int, rng) -> str:
+    properties = " ".join(entry.properties)
+    strength, dexterity = stat_modifier(stats, "СИЛ"), stat_modifier(stats, "ЛОВ")
+    if "дальность" in properties:
+        modifier = dexterity
+    elif "изящное" in properties or char_class == "Монах":
+        modifier = max(strength, dexterity)
+    else:
+        modifier = strength
+    name = entry.name.split("+", 1)[0].strip()
+    d20, attack = _attack_roll(modifier + proficiency, rng)
+    if d20 == 1:
+        return f"{name}: {attack}"
+    damage = roll_dice(parse_dice(entry.dice), stats, rng, extra_modifier=modifier, critical=d20 == 20)
+    return f"{name}: атака {attack}, урон {damage}"
+
+
+def _spell_line(entry, stats: dict, char_class: str, proficiency: int, rng) -> str:
+    dice = parse_dice(entry.dice)
+    details = entry.raw.split(" — ", 1)[-1]
+    casting = SPELLCASTING_STATS.get(char_class)
+    casting_modifier = stat_modifier(stats, casting) if casting else 0
+    parts = []
+    critical = False
+    if "атака" in details and casting:
+        d20, attack = _attack_roll(casting_modifier + proficiency, rng)
+        if d20 == 1:
+            return f"{entry.name}: {attack}"
+        critical = d20 == 20
+        parts.append(f"атака {attack}")
+    save = _SAVE_RE.search(details)
+    if save and casting:
+        parts.append(f"СЛ {8 + proficiency + casting_modifier} (спас {save.group(1)})")
+    value = roll_dice(dice, stats, rng, critical=critical)
+    healing = "восстанав" in details or (dice.stat and " хп" in details)
+    parts.append(f"лечение {value}" if healing else f"{dice}={value}")
+    return f"{entry.name}: {', '.join(parts)}"
+
+
+def _saves_line(stats: dict, char_class: str, proficiency: int, rng) -> str:
+    # Свой d20 на каждую характеристику: спасброски независимы, как за столом
+    proficient = SAVE_PROFICIENCIES.get(char_class, ())
+    saves = []
+    for abbreviation in STAT_ABBREVIATIONS:
+        d20 = rng.randint(1, 20)
+        bonus = stat_modifier(stats, abbreviation) + (proficiency if abbreviation in proficient else 0)
+        saves.append(f"{abbreviation} 🎲{d20}→{d20 + bonus}")
+    return f"Спасброски: {' '.join(saves)}"
+
+
+def combat_rolls(data: dict, action: str, rng=random, spare_d20: int = 2) -> str:
+    """
+    Блок [БРОСКИ] для хода игрока в бою: атаки и урон оружием и заклинаниями,
+    упомянутыми в action (если ничего не упомянуто — основное оружие класса),
+    спасброски по всем характеристикам и запасные d20 для прочих проверок.
+    """
+    char_class = data.get("char_class", "")
+    stats = data.get("stats") or {}
+    level = GameState.from_dict(data.get("game_state")).level or 1
+    proficiency = proficiency_bonus(level)
+    action_words = _WORD_RE.findall((action or "").lower())
+
+    weapons = [entry for entry in catalog.entries("weapons", char_class) if entry.dice]
+    spells = [entry for entry in catalog.entries("spells", char_class) if entry.dice]
+    lines = []
+    seen = set()
+    for entry in weapons:
+        if entry.name not in seen and _mentions(action_words, entry.name):
+            seen.add(entry.name)
+            lines.append(_weapon_line(entry, stats, char_class, proficiency, rng))
+    for entry in spells:
+        if entry.name not in seen and _mentions(action_words, entry.name):
+            seen.add(entry.name)
+            lines.append(_spell_line(entry, stats, char_class, proficiency, rng))
+    if not lines and weapons:
+        lines.append(_weapon_line(weapons[0], stats, char_class, proficiency, rng))
+    lines.append(_saves_line(stats, char_class, proficiency, rng))
+    if spare_d20:
+        lines.append("Запасные d20: " + ", ".join(str(rng.randint(1, 20)) for _ in range(spare_d20)))
+    return "[БРОСКИ]\n" + "\n".join(lines) + "\n[/БРОСКИ]"
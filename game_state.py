@@ -0,0 +1,163 @@
+import re
+from dataclasses import dataclass, asdict, fields
+from typing import Optional
+
+# Разбор механических строк из ответа мастера (❤️ HP, 🔮 слоты, 🟡 золото,
+# 📦 Inventory X/36, 🎓 XP, 📅 DAY N, 📍 локация) в типизированную запись.
+# Ответ проходится один раз построчно; регулярные выражения без вложенных
+# квантификаторов, поэтому разбор линеен по длине текста.
+
+
+@dataclass
+class GameState:
+    """Текущее механическое состояние персонажа, как его сообщил мастер."""
+    hp: Optional[int] = None
+    hp_max: Optional[int] = None
+    slots: Optional[str] = None
+    gold: Optional[int] = None
+    xp: Optional[int] = None
+    xp_next: Optional[int] = None
+    level: Optional[int] = None
+    day: Optional[int] = None
+    location: Optional[str] = None
+    inventory_used: Optional[int] = None
+    inventory_max: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, data: Optional[dict]) -> "GameState":
+        if not data:
+            return cls()
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in data.items() if k in known})
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+_NUM = r"(\d[\d ]*\d|\d)"
+
+# Строки с чужим HP (враги, спутники) пропускаем, чтобы не спутать с героем
+_FOREIGN_HP_RE = re.compile(r"Enemies|Враг|Противник|👥|Companion|Спутник", re.I)
+_HP_PAIR_RE = re.compile(r"❤️\s*(?:HP\s*)?(\d+)\s*/\s*(\d+)")
+_HP_CHANGE_RE = re.compile(r"❤️\s*(\d+)\s*→\s*(\d+)")
+_HP_MAX_RE = re.compile(r"❤️\s*MAX")
+_HP_WORD_RE = re.compile(r"\bHP\s*:?\s*(\d+)\s*/\s*(\d+)")
+
+_SLOTS_RE = re.compile(r"🔮\s*([^|\n]+)")
+_SLOTS_SKIP_RE = re.compile(r"ALL|unchanged|NOT|\[", re.I)
+
+_BALANCE_RE = re.compile(r"(?:Balance|Баланс)\s*:?\s*🟡\s*" + _NUM + r"\s*→\s*🟡?\s*" + _NUM, re.I)
+_WALLET_RE = re.compile(r"💰[^🟡\n]*🟡\s*" + _NUM)
+_SAVE_GOLD_RE = re.compile(r"📦\s*\d+\s*/\s*\d+\s*:\s*🟡\s*" + _NUM)
+
+_INVENTORY_RE = re.compile(r"(?:Inventory|Инвентарь|Bag|Сумка)\s*:?\s*\(?\s*(\d+)\s*/\s*(\d+)", re.I)
+_INVENTORY_SHORT_RE = re.compile(r"📦\s*(\d+)\s*/\s*(\d+)")
+
+_XP_RE = re.compile(r"XP[^\n]*?" + _NUM + r"\s*/\s*" + _NUM)
+_LEVEL_UP_RE = re.compile(r"\bL(\d+)\s*→\s*L?(\d+)")
+_LEVEL_RE = re.compile(r"\bL(\d+)\b")
+
+_DAY_RE = re.compile(r"(?:📅|═══)\s*(?:DAY|День|ДЕНЬ|Day)\s*(\d+)")
+_LOCATION_RE = re.compile(r"📍\s*([^|\n]+)")
+
+
+def _to_int(text: str) -> int:
+    return int(text.replace(" ", ""))
+
+
+def _clean(text: str) -> str:
+    return text.strip().strip("*_[]").strip()
+
+
+def parse_response(text: str, previous: Optional[GameState] = None) -> tuple:
+    """
+    Обновляет состояние по одному ответу мастера.
+
+    Returns:
+        tuple: (GameState, bool — нашлось ли в ответе хоть одно механическое поле)
+    """
+    state = GameState.from_dict(previous.to_dict()) if previous else GameState()
+    found = False
+
+    for line in (text or "").splitlines():
+        # Быстрый отсев: большинство строк — повествование без механики
+        if not any(marker in line for marker in ("❤", "🔮", "🟡", "📦", "🎒", "XP", "📅", "═══", "📍", "HP", "L")):
+            continue
+
+        if "❤" in line and not _FOREIGN_HP_RE.search(line):
+            match = _HP_PAIR_RE.search(line)
+            if match:
+                state.hp, state.hp_max = int(match.group(1)), int(match.group(2))
+                found = True
+            else:
+                match = _HP_CHANGE_RE.search(line)
+                if match:
+                    state.hp = int(match.group(2))
+                    found = True
+                elif _HP_MAX_RE.search(line) and state.hp_max is not None:
+                    state.hp = state.hp_max
+                    found = True
+        elif "HP" in line and not _FOREIGN_HP_RE.search(line):
+            match = _HP_WORD_RE.search(line)
+            if match:
+                state.hp, state.hp_max = int(match.group(1)), int(match.group(2))
+                found = True
+
+        if "🔮" in line:
+            match = _SLOTS_RE.search(line)
+            if match and not _SLOTS_SKIP_RE.search(match.group(1)) and any(ch.isdigit() for ch in match.group(1)):
+                state.slots = _clean(match.group(1))
+                found = True
+
+        if "🟡" in line and "LOOT" not in line:
+            match = _BALANCE_RE.search(line) or _WALLET_RE.search(line) or _SAVE_GOLD_RE.search(line)
+            if match:
+                state.gold = _to_int(match.groups()[-1])
+                found = True
+
+        if "📦" in line or "🎒" in line:
+            match = _INVENTORY_RE.search(line) or _INVENTORY_SHORT_RE.search(line)
+            if match:
+                state.inventory_used, state.inventory_max = int(match.group(1)), int(match.group(2))
+                found = True
+
+        if "XP" in line:
+            match = _XP_RE.search(line)
+            if match:
+                state.xp, state.xp_next = _to_int(match.group(1)), _to_int(match.group(2))
+                found = True
+
+        match = _LEVEL_UP_RE.search(line)
+        if match:
+            state.level = int(match.group(2))
+            found = True
+        elif "👤" in line or "💾" in line:
+            match = _LEVEL_RE.search(line)
+            if match:
+                state.level = int(match.group(1))
+                found = True
+
+        if "📅" in line or "═══" in line:
+            match = _DAY_RE.search(line)
+            if match:
+                state.day = int(match.group(1))
+                found = True
+
+        if "📍" in line:
+            match = _LOCATION_RE.search(line)
+            if match:
+                location = _clean(match.group(1))
+                if location and not location.startswith("["):
+                    state.location = location
+                    found = True
+
+    return state, found
+
+
+def extract_game_state(previous: Optional[dict], text: str) -> Optional[dict]:
+    """
+    Разбирает ответ мастера поверх сохранённого состояния.
+    Возвращает новый dict для FSM или None, если механики в ответе не было.
+    """
+    state, found = parse_response(text, GameState.from_dict(previous))
+    return state.to_dict() if found else None
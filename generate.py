@@ -1,13 +1,293 @@
 import os
 import sys
+import time
+import random
+import asyncio
+import logging
 
 sys.stdout.reconfigure(encoding="utf-8")
 
 # Базовая директория проекта (где лежит generate.py и prompt.txt)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PROMPT_PATH = os.path.join(BASE_DIR, "prompt.txt")
-# Импортируем функцию генерации из yandex.py вместо OpenAI
-from yandex import ai_generate, BASE_PROMPT
+
+from config import (
+    LLM_PROVIDERS,
+    LLM_TIMEOUT,
+    LLM_RETRIES,
+    LLM_RETRY_BASE_DELAY,
+    LLM_HEDGING,
+    LLM_HEDGE_MIN_SAMPLES,
+)
+from prompts import BASE_PROMPT
+from providers import ProviderError
+from yandex import YandexProvider
+from openai_compat import OpenAICompatProvider
+
+logger = logging.getLogger(__name__)
+
+# Провайдеры по имени; порядок использования задаёт LLM_PROVIDERS
+PROVIDER_CLASSES = {
+    "yandex": YandexProvider,
+    "openai": OpenAICompatProvider,
+}
+
+UNAVAILABLE_TEXT = (
+    "⚠️ <b>Сервис временно недоступен</b>\n\n"
+    "🔴 Серверы генерации сейчас не отвечают.\n\n"
+    "<i>Попробуйте снова через несколько минут.</i>"
+)
+DEADLINE_TEXT = (
+    "⚠️ <b>Превышено время ожидания</b>\n\n"
+    "🔴 Ответ не успел сгенерироваться вовремя.\n\n"
+    "<i>Попробуйте снова через несколько секунд.</i>"
+)
+
+
+def internal_error_text(error: Exception) -> str:
+    return (
+        "⚠️ <b>Внутренняя ошибка</b>\n\n"
+        f"Произошла непредвиденная ошибка: {str(error)}\n\n"
+        "<i>Попробуйте снова. Если проблема сохраняется, обратитесь к администратору.</i>"
+    )
+
+
+class ProviderRouter:
+    """
+    Маршрутизатор запросов по провайдерам.
+
+    - Повторы с джиттером (full jitter), с учётом Retry-After и оставшегося времени до дедлайна.
+    - Предохранитель на каждого провайдера: сбойный провайдер пропускается.
+    - Переключение на следующий провайдер, если текущий исчерпал попытки.
+    - Хеджирование (LLM_HEDGING): если основной провайдер не ответил за своё p95,
+      параллельно уходит запрос к следующему; побеждает первый успешный ответ.
+    """
+
+    def __init__(self, names: list, retries: int = LLM_RETRIES, base_delay: float = LLM_RETRY_BASE_DELAY,
+                 hedging: bool = LLM_HEDGING, hedge_min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        self.providers = []
+        for name in names:
+            cls = PROVIDER_CLASSES.get(name)
+            if cls is None:
+                logger.warning("Неизвестный LLM-провайдер %r пропущен", name)
+                continue
+            self.providers.append(cls())
+        if not self.providers:
+            self.providers.append(YandexProvider())
+        self.retries = retries
+        self.base_delay = base_delay
+        self.hedging = hedging
+        self.hedge_min_samples = hedge_min_samples
+        self.stats = {"failovers": 0, "hedged": 0, "hedge_wins": 0, "deadline_exceeded": 0}
+
+    def _available(self) -> list:
+        configured = [provider for provider in self.providers if provider.configured]
+        # Если ничего не настроено, пусть первый провайдер вернёт свою ошибку (например, 401)
+        return configured or self.providers[:1]
+
+    # ---------- Один провайдер ----------
+
+    async def _attempt(self, provider, history: list, system_prompt: str, deadline: float) -> str:
+        remaining = deadline - asyncio.get_running_loop().time()
+        if remaining <= 0:
+            # allow() мог отдать этому вызову пробный запрос полуоткрытого провайдера — возвращаем
+            provider.breaker.release()
+            self.stats["deadline_exceeded"] += 1
+            raise ProviderError("deadline exceeded", DEADLINE_TEXT, retryable=False)
+        provider.stats["requests"] += 1
+        started = time.monotonic()
+        try:
+            text = await provider.complete(history, system_prompt, min(LLM_TIMEOUT, remaining))
+        except ProviderError:
+            provider.stats["errors"] += 1
+            provider.breaker.record_failure()
+            raise
+        except BaseException:
+            # Отмена или непредвиденная ошибка: результата нет — пробный запрос освобождаем
+            provider.breaker.release()
+            raise
+        provider.breaker.record_success()
+        provider.latency.add(time.monotonic() - started)
+        return text
+
+    async def _backoff(self, provider, error: ProviderError, attempt: int, deadline: float) -> bool:
+        """Ждёт перед повтором. False — повторять не стоит (нет попыток или времени)."""
+        if not error.retryable or attempt >= self.retries:
+            return False
+        delay = error.retry_after if error.retry_after is not None else random.uniform(0, self.base_delay * 2 ** attempt)
+        if asyncio.get_running_loop().time() + delay >= deadline:
+            return False
+        provider.stats["retries"] += 1
+        await asyncio.sleep(delay)
+        return True
+
+    async def _with_retries(self, provider, history: list, system_prompt: str, deadline: float) -> str:
+        attempt = 0
+        while True:
+            if not provider.breaker.allow():
+                raise ProviderError(f"{provider.name}: circuit open", UNAVAILABLE_TEXT, retryable=False)
+            try:
+                return await self._attempt(provider, history, system_prompt, deadline)
+            except ProviderError as e:
+                logger.warning("Провайдер %s, попытка %s: %s", provider.name, attempt + 1, e)
+                if not await self._backoff(provider, e, attempt, deadline):
+                    raise
+            attempt += 1
+
+    async def _failover(self, providers: list, history: list, system_prompt: str, deadline: float) -> str:
+        last_error = None
+        for index, provider in enumerate(providers):
+            if index:
+                self.stats["failovers"] += 1
+            try:
+                return await self._with_retries(provider, history, system_prompt, deadline)
+            except ProviderError as e:
+                last_error = e
+        raise last_error or ProviderError("no providers", UNAVAILABLE_TEXT, retryable=False)
+
+    # ---------- Хеджирование ----------
+
+    async def _hedged(self, providers: list, history: list, system_prompt: str, deadline: float) -> str:
+        primary = providers[0]
+        threshold = primary.latency.percentile(0.95) if len(primary.latency) >= self.hedge_min_samples else None
+        if threshold is None:
+            return await self._failover(providers, history, system_prompt, deadline)
+
+        primary_task = asyncio.create_task(self._with_retries(primary, history, system_prompt, deadline))
+        try:
+            done, _ = await asyncio.wait({primary_task}, timeout=threshold)
+        except asyncio.CancelledError:
+            # Ход отменили, пока ждали основной провайдер — запрос к нему тоже не нужен
+            primary_task.cancel()
+            raise
+        if done and not primary_task.exception():
+            return primary_task.result()
+
+        # Основной провайдер медлит (или уже упал) — запрос уходит к следующим
+        if not done:
+            self.stats["hedged"] += 1
+        backup_task = asyncio.create_task(self._failover(providers[1:], history, system_prompt, deadline))
+        pending = {backup_task} if done else {primary_task, backup_task}
+        last_error = primary_task.exception() if done else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup_task and primary_task not in done:
+                            self.stats["hedge_wins"] += 1
+                        return task.result()
+                    last_error = task.exception()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # ---------- Публичный интерфейс ----------
+
+    async def generate(self, history: list, system_prompt: str, deadline: float = None) -> str:
+        loop = asyncio.get_running_loop()
+        deadline = deadline if deadline is not None else loop.time() + LLM_TIMEOUT
+        providers = self._available()
+        try:
+            if self.hedging and len(providers) > 1:
+                return await self._hedged(providers, history, system_prompt, deadline)
+            return await self._failover(providers, history, system_prompt, deadline)
+        except ProviderError as e:
+            return e.user_text
+        except Exception as e:
+            logger.exception("Неизвестная ошибка при запросе к LLM: %s", e)
+            return internal_error_text(e)
+
+    async def generate_stream(self, history: list, system_prompt: str, deadline: float = None):
+        """
+        Потоковая генерация с теми же повторами и переключением провайдеров.
+        Повтор возможен, только пока игроку ещё ничего не показано; ошибка
+        посреди потока отдаётся последним куском текста. Хеджирования нет.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = deadline if deadline is not None else loop.time() + LLM_TIMEOUT
+        last_error = None
+        for index, provider in enumerate(self._available()):
+            if index:
+                self.stats["failovers"] += 1
+            attempt = 0
+            while True:
+                # Срок проверяется до allow(): иначе пробный запрос полуоткрытого провайдера остался бы занят
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    self.stats["deadline_exceeded"] += 1
+                    yield DEADLINE_TEXT
+                    return
+                if not provider.breaker.allow():
+                    break
+                provider.stats["requests"] += 1
+                started = time.monotonic()
+                yielded = False
+                try:
+                    async for text in provider.stream(history, system_prompt, min(LLM_TIMEOUT, remaining)):
+                        yielded = True
+                        yield text
+                except ProviderError as e:
+                    provider.stats["errors"] += 1
+                    provider.breaker.record_failure()
+                    last_error = e
+                    logger.warning("Провайдер %s (поток), попытка %s: %s", provider.name, attempt + 1, e)
+                    if yielded:
+                        yield e.user_text
+                        return
+                    if not await self._backoff(provider, e, attempt, deadline):
+                        break
+                    attempt += 1
+                    continue
+                except (asyncio.CancelledError, GeneratorExit):
+                    provider.breaker.release()
+                    raise
+                except Exception as e:
+                    provider.breaker.release()
+                    logger.exception("Неизвестная ошибка потоковой генерации: %s", e)
+                    yield internal_error_text(e)
+                    return
+                provider.breaker.record_success()
+                provider.latency.add(time.monotonic() - started)
+                return
+        yield last_error.user_text if last_error else UNAVAILABLE_TEXT
+
+    def report(self) -> dict:
+        return {
+            **self.stats,
+            **{provider.name: provider.report() for provider in self.providers},
+        }
+
+
+router = ProviderRouter([name.strip() for name in LLM_PROVIDERS.split(",") if name.strip()])
+
+
+async def ai_generate(history: list, system_prompt: str = BASE_PROMPT, deadline: float = None) -> str:
+    """
+    Ответ мастера через доступных провайдеров.
+
+    Args:
+        history: Список сообщений в формате [{"role": "user"/"assistant", "content": "..."}]
+        system_prompt: Готовый системный промпт сессии
+        deadline: Момент loop.time(), к которому ответ должен быть готов
+            (по умолчанию — через LLM_TIMEOUT секунд)
+
+    Returns:
+        str: Текст ответа или понятный игроку текст ошибки (начинается с "⚠️")
+    """
+    return await router.generate(history, system_prompt, deadline)
+
+
+async def ai_generate_stream(history: list, system_prompt: str = BASE_PROMPT, deadline: float = None):
+    """Потоковый вариант ai_generate: отдаёт накопленный текст ответа."""
+    async for text in router.generate_stream(history, system_prompt, deadline):
+        yield text
+
+
+def provider_stats() -> dict:
+    return router.report()
+
 
 # Экспортируем для обратной совместимости
-__all__ = ['ai_generate', 'BASE_PROMPT']
\ No newline at end of file
+__all__ = ['ai_generate', 'ai_generate_stream', 'provider_stats', 'BASE_PROMPT']
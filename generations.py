@@ -0,0 +1,156 @@
+import asyncio
+import logging
+from itertools import count
+
+from config import GENERATION_TIMEOUT, YANDEX_MAX_TOKENS
+from context_builder import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Текущая генерация ответа мастера в каждом чате.
+# У чата одновременно не больше одной генерации: новый ход вытесняет прежний,
+# /start и загрузка сохранения отменяют его. Отмена задачи рвёт HTTP-поток к
+# провайдеру (выход из async with), а результат, пришедший после отмены,
+# выбрасывается и не попадает в историю.
+
+
+class GenerationCancelled(Exception):
+    """Генерация отменена или вытеснена более новой — результат не нужен."""
+
+
+class Generation:
+    __slots__ = ("id", "key", "task", "input_tokens", "admitted", "text")
+
+    def __init__(self, generation_id: int, key):
+        self.id = generation_id
+        self.key = key
+        self.task = None
+        self.input_tokens = None
+        self.admitted = False
+        self.text = ""
+
+    def request(self, input_tokens: int) -> None:
+        """Запрос собран: оценка входных токенов."""
+        self.input_tokens = input_tokens
+
+    def admit(self) -> None:
+        """Планировщик выдал слот — запрос ушёл провайдеру."""
+        self.admitted = True
+
+    def progress(self, text: str) -> None:
+        """Накопленный текст потокового ответа."""
+        self.text = text
+
+
+class GenerationRegistry:
+    """Генерации по чатам (StorageKey) с отменой и учётом сэкономленных токенов."""
+
+    def __init__(self, timeout: float = GENERATION_TIMEOUT):
+        self.timeout = timeout
+        self._ids = count(1)
+        self._current = {}
+        # Скользящее среднее длины ответа (токены) — для оценки экономии от отмены
+        self.avg_output = YANDEX_MAX_TOKENS / 2
+        self.reasons = {}
+        self.stats = {
+            "started": 0,
+            "completed": 0,
+            "cancelled": 0,
+            "discarded": 0,     # ответ пришёл, но ход уже отменён — выброшен
+            "tokens_saved": 0,  # оценка: не отправленные и не сгенерированные токены
+        }
+
+    def begin(self, key) -> Generation:
+        """Регистрирует новую генерацию чата; прежняя, если есть, вытесняется."""
+        self.cancel(key, "superseded")
+        generation = Generation(next(self._ids), key)
+        self._current[key] = generation
+        self.stats["started"] += 1
+        return generation
+
+    def is_current(self, generation: Generation) -> bool:
+        return self._current.get(generation.key) is generation
+
+    def _saved_tokens(self, generation: Generation) -> int:
+        if generation.input_tokens is None or generation.task is None or generation.task.done():
+            return 0
+        expected = round(self.avg_output)
+        if not generation.admitted:
+            # Запрос ещё стоял в очереди — не потрачено ничего
+            return generation.input_tokens + expected
+        return max(0, expected - estimate_tokens(generation.text)) if generation.text else expected
+
+    def cancel(self, key, reason: str = "cancelled") -> bool:
+        """Отменяет текущую генерацию чата. True — было что отменять."""
+        generation = self._current.pop(key, None)
+        if generation is None:
+            return False
+        self._stop(generation, reason)
+        return True
+
+    def _stop(self, generation: Generation, reason: str) -> None:
+        saved = self._saved_tokens(generation)
+        self.stats["cancelled"] += 1
+        self.stats["tokens_saved"] += saved
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        if generation.task is not None:
+            generation.task.cancel()
+        logger.info("Генерация #%s чата %s отменена (%s), сэкономлено ~%s токенов",
+                    generation.id, generation.key.chat_id, reason, saved)
+
+    async def run(self, generation: Generation, coro):
+        """
+        Выполняет coro как задачу генерации и возвращает результат.
+        GenerationCancelled — генерацию отменили; asyncio.TimeoutError — не уложились в timeout.
+        После таймаута генерация остаётся текущей: ход завершается сообщением о таймауте
+        через finish(), если его тем временем не вытеснили.
+        """
+        if not self.is_current(generation):
+            coro.close()
+            raise GenerationCancelled(generation.id)
+        generation.task = asyncio.create_task(coro)
+        try:
+            done, _ = await asyncio.wait({generation.task}, timeout=self.timeout)
+        except asyncio.CancelledError:
+            # Отменили сам обработчик (остановка бота) — генерация тоже не нужна
+            if self.is_current(generation):
+                self.cancel(generation.key, "shutdown")
+            raise
+        if not done:
+            if self.is_current(generation):
+                self._stop(generation, "timeout")
+            raise asyncio.TimeoutError()
+        if generation.task.cancelled():
+            raise GenerationCancelled(generation.id)
+        if not self.is_current(generation):
+            # Ответ успел прийти, но ход уже отменён
+            self.stats["discarded"] += 1
+            generation.task.exception()
+            raise GenerationCancelled(generation.id)
+        result = generation.task.result()
+        if isinstance(result, str) and result:
+            self.avg_output += (estimate_tokens(result) - self.avg_output) * 0.1
+        return result
+
+    def finish(self, generation: Generation) -> bool:
+        """
+        Снимает генерацию с учёта перед записью ответа в историю.
+        False — пока ответ готовился к записи, ход отменили: ответ выбрасывается.
+        """
+        if self.is_current(generation):
+            del self._current[generation.key]
+            self.stats["completed"] += 1
+            return True
+        self.stats["discarded"] += 1
+        return False
+
+    def report(self) -> dict:
+        return {
+            **self.stats,
+            "active": len(self._current),
+            "avg_output_tokens": round(self.avg_output),
+            "reasons": dict(self.reasons),
+        }
+
+
+generations = GenerationRegistry()
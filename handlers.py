@@ -1,5 +1,5 @@
 from aiogram import Router, F, types
-from aiogram.filters import CommandStart, Command
+from aiogram.filters import CommandStart, Command, CommandObject
 from aiogram.types import (
     Message,
     InlineKeyboardButton,
@@ -11,6 +11,7 @@ from aiogram.types import (
 from aiogram.enums import ParseMode
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 
 import sys
 import os
@@ -18,22 +19,50 @@ import random
 import asyncio
 import logging
 import re
+import time
+from contextlib import aclosing
+from html import escape
+from typing import Optional
 
 CURRENT_DIR = os.path.dirname(__file__)
-PROMPT_PATH = os.path.join(CURRENT_DIR, "prompt.txt")
 START_SCENE_PATH = os.path.join(CURRENT_DIR, "start_scene.txt")
-WEAPONS_PATH = os.path.join(CURRENT_DIR, "weapons.txt")
-SPELLS_PATH = os.path.join(CURRENT_DIR, "spells.txt")
-EQUIPMENT_PATH = os.path.join(CURRENT_DIR, "equipment.txt")
-WALLETS_PATH = os.path.join(CURRENT_DIR, "wallets.txt")
 
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
-from generate import ai_generate, BASE_PROMPT
+from generate import ai_generate, ai_generate_stream
+from prompts import compose_system_prompt, forget_session, classify_intent, CALLBACK_INTENTS
+from summary import fold_history, forget_session as forget_summary_session
+from history import Turn
+from context_builder import assemble_context
+from sheet import render_sheet, STATUS_FIELDS
+from game_state import extract_game_state, parse_response
+from catalog import catalog
+from scheduler import scheduler
+from opening import openings, build_opening_prompt
+from prefetch import prefetcher, choice_content, CHOICES
+from usage import ledger
+from render import render_reply, TELEGRAM_TEXT_LIMIT
+from outbound import low_priority
+from saves import saves, describe, SnapshotError
+from dice import roll_4d6_drop_lowest, combat_rolls, chosen_option
+from menu_cache import menu_cache, CACHED_INTENTS
+from generations import generations, GenerationCancelled
+from config import YANDEX_STREAMING, STREAM_EDIT_INTERVAL, YANDEX_MAX_TOKENS, LOCAL_DICE
 
 router = Router()
 
 logger = logging.getLogger(__name__)
 
+# Дневная квота токенов игрока исчерпана (см. usage.py)
+QUOTA_EXCEEDED_TEXT = (
+    "🌙 <b>Мастер ушёл отдыхать до завтра</b>\n\n"
+    "На сегодня лимит приключений исчерпан. Твоя история сохранена — "
+    "возвращайся завтра, и она продолжится с того же места.\n\n"
+    "<i>Лист персонажа, инвентарь и заклинания доступны и сейчас.</i>"
+)
+
+# Ход не уложился в GENERATION_TIMEOUT
+TIMEOUT_REPLY = "⚠️ Сервис генерации не отвечает (таймаут)."
+
 class CreateChar(StatesGroup):
     race = State()
     name = State()
@@ -70,71 +99,25 @@ RACE_BONUSES = {
     "Людоящер": {"Телосложение": 2, "Мудрость": 1},
 }
 
-# Функции для загрузки данных из файлов
-def load_class_data(file_path, class_name):
-    """Загружает данные класса из файла (weapons, spells, equipment, wallets)"""
-    try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-        
-        # Находим секцию класса (## Класс)
-        class_section = f"## {class_name}"
-        if class_section not in content:
-            return []
-        
-        # Извлекаем все строки после заголовка класса до следующего заголовка
-        lines = content.split("\n")
-        start_idx = None
-        end_idx = None
-        
-        for i, line in enumerate(lines):
-            if line.strip() == class_section:
-                start_idx = i + 1
-            elif start_idx is not None and line.startswith("##") and i > start_idx:
-                end_idx = i
-                break
-        
-        if start_idx is None:
-            return []
-        
-        if end_idx is None:
-            end_idx = len(lines)
-        
-        # Получаем все строки данных класса (пропускаем пустые и комментарии)
-        items = []
-        for i in range(start_idx, end_idx):
-            line = lines[i].strip()
-            if line and not line.startswith("#"):
-                items.append(line)
-        
-        return items
-    except Exception as e:
-        logger.exception(f"Ошибка загрузки данных из {file_path}: {e}")
-        return []
-
+# Снаряжение, кошели и заклинания берутся из каталога, разобранного при старте (см. catalog.py)
 def generate_random_equipment(char_class: str) -> str:
     """Генерирует случайное снаряжение для класса"""
-    equipment_list = load_class_data(EQUIPMENT_PATH, char_class)
-    return random.choice(equipment_list) if equipment_list else "Базовое снаряжение"
+    equipment_list = catalog.entries("equipment", char_class)
+    return random.choice(equipment_list).raw if equipment_list else "Базовое снаряжение"
 
 def generate_random_wallet(char_class: str) -> str:
     """Генерирует случайный кошель для класса"""
-    wallet_list = load_class_data(WALLETS_PATH, char_class)
-    return random.choice(wallet_list) if wallet_list else "Золотая монета, серебряная монета"
+    wallet_list = catalog.entries("wallets", char_class)
+    return random.choice(wallet_list).raw if wallet_list else "Золотая монета, серебряная монета"
 
 def generate_class_spells(char_class: str) -> str:
     """Генерирует заклинания для класса"""
-    spells_list = load_class_data(SPELLS_PATH, char_class)
+    spells_list = catalog.entries("spells", char_class)
     if not spells_list:
         return "Нет начальных заклинаний"
     
     # Объединяем все заклинания класса в одну строку
-    return " | ".join(spells_list)
-
-def roll_4d6_drop_lowest():
-    rolls = [random.randint(1,6) for _ in range(4)]
-    rolls_sorted = sorted(rolls)
-    return sum(rolls_sorted[1:]), rolls, rolls_sorted[0]
+    return " | ".join(entry.raw for entry in spells_list)
 
 def generate_stats_auto():
     labels = ["Сила","Ловкость","Телосложение","Интеллект","Мудрость","Харизма"]
@@ -167,15 +150,46 @@ def trim_history(history, max_pairs=8):
     return history[-limit:] if len(history) > limit else history
 
 
-async def process_user_turn(message: Message, state: FSMContext, user_content: str):
-    """Добавляет ход игрока, запрашивает ответ ИИ и отдаёт его с кнопками выбора."""
+async def process_user_turn(message: Message, state: FSMContext, user_content: str, intent: str = None):
+    """
+    Добавляет ход игрока, запрашивает ответ ИИ и отдаёт его с кнопками выбора.
+    intent выбирает секции системного промпта; если не задан — определяется по тексту.
+    Справочные запросы меню при неизменном сюжете отдаются из кэша (см. menu_cache.py).
+    """
     data = await state.get_data()
     history = data.get("history", [])
-
-    history.append({"role": "user", "content": user_content})
-    history = trim_history(history, max_pairs=10)
+    last_reply = next((m.get("content", "") for m in reversed(history) if m.get("role") == "assistant"), "")
+    if intent is None:
+        intent = classify_intent(user_content, last_reply)
+
+    story_version = data.get("story_version", 0)
+    cached = menu_cache.get(state.key, intent, story_version)
+    if cached is not None:
+        # Ответ на этот вопрос уже был, и с тех пор в сюжете ничего не произошло.
+        # Как и новый ход, он вытесняет генерацию, которая ещё идёт в этом чате
+        if generations.cancel(state.key, "superseded"):
+            await state.set_state(Gen.history)
+        return await send_final_reply(message, None, cached)
+
+    if ledger.over_quota(state.key.chat_id):
+        return await message.answer(QUOTA_EXCEEDED_TEXT, parse_mode=ParseMode.HTML, reply_markup=make_choice_keyboard())
+
+    # Новый ход вытесняет генерацию, которая ещё идёт в этом чате (например, после кнопки меню)
+    generation = generations.begin(state.key)
+    # Реплика игрока из отменённого хода осталась без ответа — её заменяет новая
+    if history and history[-1].get("role") == "user":
+        history.pop()
+
+    # Продолжение для этого хода могло быть сгенерировано заранее (см. prefetch.py)
+    speculation = prefetcher.claim(state.key, user_content, data.get("turn", 0))
+
+    history.append(Turn("user", user_content))
+    history = await fold_history(history, state, max_pairs=10)
+    if not generations.is_current(generation):
+        return
     await state.update_data(history=history)
     await state.set_state(Gen.wait)
+    request_history = with_combat_rolls(history, data, user_content, last_reply) if intent == "combat" else history
 
     thinking_messages = [
         "🔮 <i>Магический шар показывает варианты...</i>",
@@ -191,20 +205,74 @@ async def process_user_turn(message: Message, state: FSMContext, user_content: s
         "🌟 <i>Призываю силу древних артефактов...</i>",
     ]
 
-    await message.answer(random.choice(thinking_messages), parse_mode=ParseMode.HTML)
+    async def send_thinking():
+        with low_priority():
+            return await message.answer(random.choice(thinking_messages), parse_mode=ParseMode.HTML)
 
-    raw = await safe_ai_generate(history, state, Gen.history)
-    response = raw if raw else "⚠️ Пустой ответ от сервера."
+    response = None
+    thinking_msg = None
+    if speculation is None or not speculation.task.done():
+        thinking_msg = await send_thinking()
+    try:
+        if speculation is not None:
+            response = await generations.run(generation, prefetcher.resolve(speculation))
+        if response is None:
+            # Готовое продолжение оказалось ошибкой — «думаю...» ещё не показывали
+            if thinking_msg is None:
+                thinking_msg = await send_thinking()
+            response = await generate_reply(request_history, state, thinking_msg, generation, intent)
+    except asyncio.TimeoutError:
+        # Готовое продолжение так и не дождались — ход завершается сообщением о таймауте
+        logger.warning("Генерация #%s не дождалась продолжения, подготовленного заранее", generation.id)
+        response = TIMEOUT_REPLY
+    except GenerationCancelled:
+        # Игрок начал заново или сделал другой ход — этот ответ уже никому не нужен
+        return await drop_placeholder(thinking_msg)
 
     # Сохраняем оригинальный ответ (Markdown) в историю
-    history.append({"role": "assistant", "content": response})
-    history = trim_history(history, max_pairs=10)
-    await state.update_data(history=history)
+    history.append(Turn("assistant", response))
+    history = await fold_history(history, state, max_pairs=10)
+    if not generations.finish(generation):
+        return await drop_placeholder(thinking_msg)
+    turn = data.get("turn", 0) + 1
+    if intent in CACHED_INTENTS:
+        if not response.startswith("⚠️"):
+            menu_cache.put(state.key, intent, story_version, response)
+        await state.update_data(history=history, turn=turn)
+    else:
+        # Сюжетный ход: закэшированные справки по меню устарели
+        await state.update_data(history=history, turn=turn, story_version=story_version + 1)
+    await sync_game_state(state, response, turn)
     await state.set_state(Gen.history)
 
     # Отправляем HTML-версию с кнопками выбора
-    response_html = markdown_to_html(response)
-    await message.answer(response_html, parse_mode=ParseMode.HTML, reply_markup=make_choice_keyboard())
+    await send_final_reply(message, thinking_msg, response)
+    prefetcher.start(state.key, history, await state.get_data())
+
+def with_combat_rolls(history: list, data: dict, user_content: str, last_reply: str) -> list:
+    """
+    История для запроса, в которой к ходу игрока добавлен блок [БРОСКИ] (см. dice.py).
+    В сохранённую историю блок не попадает: результат бросков остаётся в ответе мастера.
+    """
+    if not LOCAL_DICE:
+        return history
+    choice = next((c for c in CHOICES if choice_content(c) == user_content), None)
+    action = chosen_option(last_reply, choice) if choice else user_content
+    rolls = combat_rolls(data, action)
+    return history[:-1] + [Turn(history[-1]["role"], f"{history[-1]['content']}\n\n{rolls}")]
+
+async def sync_game_state(state: FSMContext, response: str, turn: int):
+    """Разбирает механические строки ответа мастера и обновляет game_state в FSM."""
+    data = await state.get_data()
+    game_state = extract_game_state(data.get("game_state"), response)
+    if game_state is None:
+        return
+    # Статус снова свежий, только если мастер назвал его цифры (HP, слоты, XP, уровень)
+    reported, _ = parse_response(response)
+    if any(getattr(reported, field) is not None for field in STATUS_FIELDS):
+        await state.update_data(game_state=game_state, sheet_turn=turn)
+    else:
+        await state.update_data(game_state=game_state)
 
 def make_game_keyboard():
     """Создаёт красивую игровую клавиатуру с эмодзи"""
@@ -265,57 +333,6 @@ def make_menu_inline_keyboard():
         ]
     )
 
-def markdown_to_html(text: str) -> str:
-    """
-    Конвертирует Markdown форматирование в HTML для Telegram.
-    Обрабатывает: **жирный**, *курсив*, списки с -, кавычки
-    """
-    if not text:
-        return text
-    
-    # Сначала защищаем уже существующие HTML теги
-    # Временно заменяем их на плейсхолдеры
-    html_tags = []
-    tag_pattern = r'<[^>]+>'
-    
-    def replace_tag(match):
-        html_tags.append(match.group(0))
-        return f"__HTML_TAG_{len(html_tags)-1}__"
-    
-    text = re.sub(tag_pattern, replace_tag, text)
-    
-    # Экранируем специальные символы HTML
-    text = (
-        text.replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-    )
-    
-    # Восстанавливаем HTML теги после экранирования,
-    # чтобы они остались валидным HTML, а не текстом
-    for i, tag in enumerate(html_tags):
-        placeholder = f"__HTML_TAG_{i}__"
-        if placeholder in text:
-            text = text.replace(placeholder, tag)
-    
-    # Конвертируем **жирный текст** в <b>жирный текст</b>
-    text = re.sub(r'\*\*(.+?)\*\*', r'<b>\1</b>', text)
-    
-    # Конвертируем *курсив* в <i>курсив</i>, избегая ** **
-    text = re.sub(r'(?<!\*)\*(?!\*)(.+?)(?<!\*)\*(?!\*)', r'<i>\1</i>', text)
-    
-    # Обрабатываем списки с дефисом в начале строки:
-    # "- пункт" → "• пункт"
-    lines = text.split('\n')
-    result_lines = []
-    for line in lines:
-        if re.match(r'^\s*-\s+', line):
-            line = re.sub(r'^\s*-\s+', '• ', line)
-        result_lines.append(line)
-    text = '\n'.join(result_lines)
-    
-    return text
-
 def validate_text_input(text, min_length=3, max_length=500):
     """
     Валидирует и очищает пользовательский ввод.
@@ -357,23 +374,189 @@ def validate_text_input(text, min_length=3, max_length=500):
     
     return True, cleaned_text, ""
 
-async def safe_ai_generate(history, state: FSMContext, fallback_state, timeout_sec:int=60):
+def build_request_history(history, data: dict, system_prompt: str) -> tuple:
+    """
+    Укладывает летопись и последние ходы в бюджет токенов и логирует оценку запроса.
+    Возвращает (история для запроса, ContextReport).
+    """
+    request_history, report = assemble_context(history, system_prompt, data.get("summary", ""))
+    logger.info("Запрос к LLM: %s", report)
+    return request_history, report
+
+async def safe_ai_generate(history, state: FSMContext, fallback_state, generation, timeout_sec:int=60, intent: str = "story", on_queue=None):
     try:
-        raw = await asyncio.wait_for(ai_generate(history), timeout=timeout_sec)
+        # Системный промпт сессии собирается в памяти и кэшируется до смены персонажа
+        data = await state.get_data()
+        system_prompt = compose_system_prompt(state.key, data, intent)
+        request_history, report = build_request_history(history, data, system_prompt)
+        generation.request(report.total_tokens)
+
+        def factory():
+            generation.admit()
+            # Дедлайн отсчитывается с момента выдачи слота и доходит до повторов у провайдеров
+            return ai_generate(request_history, system_prompt, deadline=asyncio.get_running_loop().time() + timeout_sec)
+
+        # Запрос ждёт слота у глобального планировщика; таймаут считается от начала генерации
+        raw = await scheduler.run(
+            state.key.chat_id,
+            factory,
+            tokens=report.total_tokens + YANDEX_MAX_TOKENS,
+            on_position=on_queue,
+        )
         if raw is None: raise RuntimeError("ai_generate вернул None")
         return raw
     except asyncio.TimeoutError:
         logger.exception("ai_generate timeout")
         await state.set_state(fallback_state)
-        return "⚠️ Сервис генерации не отвечает (таймаут)."
+        return TIMEOUT_REPLY
     except Exception as e:
         logger.exception("Ошибка при вызове ai_generate: %s", e)
         await state.set_state(fallback_state)
         return f"⚠️ Произошла ошибка при генерации: {str(e)}"
 
+def _live_preview(text: str) -> str:
+    """Промежуточный кадр потокового ответа: простой текст без Markdown-звёздочек."""
+    preview = text.replace("**", "").replace("*", "")
+    return preview[:TELEGRAM_TEXT_LIMIT - 2] + " ▌"
+
+async def safe_ai_generate_stream(history, state: FSMContext, fallback_state, live_message: Optional[Message], generation, timeout_sec:int=60, intent: str = "story", on_queue=None):
+    """
+    Потоковая генерация: по мере прихода текста правит live_message (бывшее «думаю...»),
+    не чаще чем раз в STREAM_EDIT_INTERVAL секунд. Возвращает итоговый Markdown-текст.
+    """
+    final_text = ""
+    data = await state.get_data()
+    system_prompt = compose_system_prompt(state.key, data, intent)
+    request_history, report = build_request_history(history, data, system_prompt)
+    generation.request(report.total_tokens)
+
+    async def consume():
+        nonlocal final_text
+        generation.admit()
+        loop = asyncio.get_running_loop()
+        next_edit_at = 0.0
+        shown = ""
+        deadline = loop.time() + timeout_sec
+        # aclosing: при отмене поток закрывается сразу, а не когда до генератора доберётся сборщик мусора
+        async with aclosing(ai_generate_stream(request_history, system_prompt, deadline=deadline)) as stream:
+            async for text in stream:
+                final_text = text
+                generation.progress(text)
+                if live_message is None:
+                    continue
+                now = loop.time()
+                if now < next_edit_at:
+                    continue
+                preview = _live_preview(text)
+                if preview == shown:
+                    continue
+                next_edit_at = now + STREAM_EDIT_INTERVAL
+                try:
+                    # Кадры потока — служебные: уступают готовым ответам других чатов
+                    with low_priority():
+                        await live_message.edit_text(preview)
+                    shown = preview
+                except TelegramRetryAfter as e:
+                    # Упёрлись в лимит Telegram — пропускаем кадры до конца паузы
+                    next_edit_at = now + e.retry_after
+                except TelegramBadRequest as e:
+                    logger.debug("Не удалось обновить потоковое сообщение: %s", e)
+
+    try:
+        await scheduler.run(
+            state.key.chat_id,
+            lambda: asyncio.wait_for(consume(), timeout=timeout_sec),
+            tokens=report.total_tokens + YANDEX_MAX_TOKENS,
+            on_position=on_queue,
+        )
+        if not final_text: raise RuntimeError("ai_generate_stream не вернул текст")
+        return final_text
+    except asyncio.TimeoutError:
+        logger.exception("ai_generate_stream timeout")
+        await state.set_state(fallback_state)
+        # Если часть ответа уже пришла — отдаём её, а не теряем
+        return final_text or TIMEOUT_REPLY
+    except Exception as e:
+        logger.exception("Ошибка при вызове ai_generate_stream: %s", e)
+        await state.set_state(fallback_state)
+        return f"⚠️ Произошла ошибка при генерации: {str(e)}"
+
+def make_queue_notifier(placeholder: Optional[Message]):
+    """Пока запрос ждёт в очереди, вместо «думаю...» показываем позицию и ожидание."""
+    if placeholder is None:
+        return None
+    original_html = placeholder.html_text
+
+    async def notify(position: int, eta: float):
+        with low_priority():
+            if position == 0:
+                # Очередь подошла — возвращаем исходную строку
+                await placeholder.edit_text(original_html, parse_mode=ParseMode.HTML)
+                return
+            await placeholder.edit_text(
+                f"⏳ <i>Мастер занят другими героями. Ты {position}-й в очереди, "
+                f"ожидание ~{max(1, round(eta))} с...</i>",
+                parse_mode=ParseMode.HTML,
+            )
+
+    return notify
+
+async def generate_reply(history, state: FSMContext, placeholder: Optional[Message], generation, intent: str = "story") -> str:
+    """
+    Запрашивает ответ мастера; в потоковом режиме placeholder показывает ответ вживую.
+    Бросает GenerationCancelled, если ход отменили (/start, новый ход) — ответ не нужен.
+    """
+    on_queue = make_queue_notifier(placeholder)
+    if YANDEX_STREAMING:
+        coro = safe_ai_generate_stream(history, state, Gen.history, placeholder, generation, intent=intent, on_queue=on_queue)
+    else:
+        coro = safe_ai_generate(history, state, Gen.history, generation, intent=intent, on_queue=on_queue)
+    try:
+        raw = await generations.run(generation, coro)
+    except asyncio.TimeoutError:
+        # Ход не уложился в GENERATION_TIMEOUT вместе с ожиданием в очереди — запрос отменён.
+        # Если часть потокового ответа уже пришла — отдаём её
+        logger.warning("Генерация #%s не уложилась в отведённое время", generation.id)
+        await state.set_state(Gen.history)
+        return generation.text or TIMEOUT_REPLY
+    return raw if raw else "⚠️ Пустой ответ от сервера."
+
+async def drop_placeholder(placeholder: Optional[Message]):
+    """Убирает «думаю...» (или черновик потокового ответа) отменённого хода."""
+    if placeholder is None:
+        return
+    try:
+        with low_priority():
+            await placeholder.delete()
+    except TelegramBadRequest as e:
+        logger.debug("Не удалось удалить сообщение отменённого хода: %s", e)
+
+async def send_final_reply(message: Message, placeholder: Optional[Message], response: str):
+    """Отправляет итоговый ответ в HTML с клавиатурой выбора."""
+    if YANDEX_STREAMING and placeholder is not None:
+        # Reply-клавиатуру нельзя повесить правкой, поэтому живое сообщение
+        # заменяем финальным: удаляем черновик и отправляем готовый ответ
+        try:
+            await placeholder.delete()
+        except TelegramBadRequest as e:
+            logger.debug("Не удалось удалить потоковое сообщение: %s", e)
+
+    # Длинный ответ уходит несколькими сообщениями; клавиатура — только у последнего
+    chunks = render_reply(response)
+    for i, chunk in enumerate(chunks):
+        reply_markup = make_choice_keyboard() if i == len(chunks) - 1 else None
+        await message.answer(chunk, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
 @router.message(CommandStart())
 async def cmd_start(message: Message, state: FSMContext):
+    generations.cancel(state.key, "restart")
+    # Фоновую летопись прежней кампании снимаем до очистки, чтобы она не записалась поверх
+    forget_summary_session(state.key)
     await state.clear()
+    menu_cache.forget(state.key)
+    forget_session(state.key)
+    openings.cancel(state.key)
+    prefetcher.cancel(state.key)
 
     keyboard = InlineKeyboardMarkup(
         inline_keyboard=[[InlineKeyboardButton(text="🎲 Начать приключение", callback_data="start_game")]]
@@ -387,6 +570,107 @@ async def cmd_start(message: Message, state: FSMContext):
         parse_mode=ParseMode.HTML,
     )
 
+# ---------- Сохранения (saves.py) ----------
+# Команды стоят раньше хендлеров создания персонажа и диалога, чтобы /save и /load
+# не уходили мастеру как реплика игрока.
+
+def parse_slot(args: Optional[str]) -> Optional[int]:
+    """Номер слота из аргумента команды или None."""
+    if args and args.strip().isdigit() and saves.valid_slot(int(args.strip())):
+        return int(args.strip())
+    return None
+
+def make_saves_keyboard(slots: list) -> InlineKeyboardMarkup:
+    """По строке на слот: сохранить в него и, если он занят, загрузить."""
+    taken = {info.slot for info in slots}
+    rows = []
+    for slot in range(1, saves.slots + 1):
+        row = [InlineKeyboardButton(text=f"💾 Сохранить в {slot}", callback_data=f"save_slot:{slot}")]
+        if slot in taken:
+            row.append(InlineKeyboardButton(text=f"📂 Загрузить {slot}", callback_data=f"load_slot:{slot}"))
+        rows.append(row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def show_saves(message: Message, user_id: int):
+    """Список слотов сохранений с кнопками."""
+    slots = await saves.list_slots(user_id)
+    by_slot = {info.slot: info for info in slots}
+    lines = ["💾 <b>Сохранения</b>", ""]
+    for slot in range(1, saves.slots + 1):
+        info = by_slot.get(slot)
+        if info is None:
+            lines.append(f"{slot}. <i>пусто</i>")
+        else:
+            saved_at = time.strftime("%d.%m %H:%M", time.localtime(info.saved_at))
+            lines.append(f"{slot}. {escape(info.title)} <i>({saved_at})</i>")
+    await message.answer("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=make_saves_keyboard(slots))
+
+async def save_campaign(message: Message, state: FSMContext, slot: int):
+    if await state.get_state() == Gen.wait.state:
+        return await message.answer("⏳ <i>Дождись ответа мастера, затем сохраняйся.</i>", parse_mode=ParseMode.HTML)
+    data = await state.get_data()
+    if not data.get("history"):
+        return await message.answer("📭 Сохранять пока нечего — сначала начни приключение.")
+
+    result = await saves.save(state.key.user_id, slot, data)
+    if result == "unchanged":
+        text = f"✅ В слоте {slot} уже сохранено это же состояние."
+    else:
+        text = f"💾 Сохранено в слот {slot}: {escape(describe(data))}"
+    await message.answer(text, parse_mode=ParseMode.HTML)
+
+async def load_campaign(message: Message, state: FSMContext, slot: int):
+    """
+    Восстанавливает кампанию из слота без обращения к ИИ и повторяет последнюю сцену.
+    Ход, который ещё генерируется, отменяется — его ответ относится к прежней кампании.
+    """
+    try:
+        data = await saves.load(state.key.user_id, slot)
+    except SnapshotError as e:
+        logger.warning("Не удалось прочитать сохранение %s/%s: %s", state.key.user_id, slot, e)
+        return await message.answer(f"⚠️ Сохранение в слоте {slot} повреждено или создано более новой версией бота.")
+    if data is None:
+        return await message.answer(f"📭 Слот {slot} пуст.")
+
+    # Всё, что относилось к прежней кампании, сбрасываем — как при /start
+    generations.cancel(state.key, "load")
+    menu_cache.forget(state.key)
+    forget_session(state.key)
+    forget_summary_session(state.key)
+    openings.cancel(state.key)
+    prefetcher.cancel(state.key)
+    await state.set_data(data)
+    await state.set_state(Gen.history)
+
+    await message.answer(f"📂 Загружено: {escape(describe(data))}", parse_mode=ParseMode.HTML)
+    history = data.get("history", [])
+    last_scene = next((m.get("content", "") for m in reversed(history) if m.get("role") == "assistant"), "")
+    if last_scene:
+        await send_final_reply(message, None, last_scene)
+        prefetcher.start(state.key, history, data)
+    else:
+        await message.answer("Что делаешь дальше?", reply_markup=make_choice_keyboard())
+
+@router.message(Command("saves"))
+async def cmd_saves(message: Message, state: FSMContext):
+    await show_saves(message, state.key.user_id)
+
+@router.message(Command("save"))
+async def cmd_save(message: Message, state: FSMContext, command: CommandObject):
+    """/save N — сохранить в слот N; без номера — список слотов."""
+    slot = parse_slot(command.args)
+    if slot is None:
+        return await show_saves(message, state.key.user_id)
+    await save_campaign(message, state, slot)
+
+@router.message(Command("load"))
+async def cmd_load(message: Message, state: FSMContext, command: CommandObject):
+    """/load N — загрузить слот N; без номера — список слотов."""
+    slot = parse_slot(command.args)
+    if slot is None:
+        return await show_saves(message, state.key.user_id)
+    await load_campaign(message, state, slot)
+
 @router.callback_query(F.data == "start_game")
 async def start_game_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
@@ -453,6 +737,8 @@ async def set_class(message: Message, state: FSMContext):
     spells = generate_class_spells(cl)
     
     await state.update_data(char_class=cl, equipment=equipment, wallet=wallet, spells=spells)
+    # Имя, раса и класс известны — стартовая сцена генерируется, пока игрок выбирает предысторию
+    openings.start(state.key, await state.get_data())
     text = f"✅ <b>Класс выбран:</b> {cl}\n\n"
     text += "📖 <b>Создание персонажа — Шаг 4 из 4</b>\n\n"
     text += "📚 <b>Выберите предысторию вашего героя:</b>\n\n"
@@ -529,42 +815,18 @@ async def finish_creation(message: Message, state: FSMContext):
 
     # ---------- 1. Характеристики ----------
     stats = data.get("stats", {})
-    stats_lines = [f"{k}: {v}" for k, v in stats.items()]
-    stats_str = "\n".join(stats_lines)
-    
+
     # Получаем актуальные данные после обновления монет
     final_data = await state.get_data()
     coins_amount = final_data.get("coins", random.randint(1, 6) + 1)
 
-    # ---------- 2. CHARACTER блок (ПЕРЕНЕСЁН В КОНЕЦ ПРОМПТА) ----------
-    character_block = (
-        "[CHARACTER]\n"
-        f"Имя: {data.get('name','')}\n"
-        f"Раса: {data.get('race','')}\n"
-        f"Класс: {data.get('char_class','')}\n"
-        f"Предыстория: {data.get('background','')}\n"
-        f"Характеристики:\n{stats_str}\n"
-        f"Бонусы_расы: {data.get('apply_bonuses','да')}\n"
-        f"День_старта: {data.get('day_counter', 1)}\n"
-        f"Снаряжение: {data.get('equipment','Базовая экипировка')}\n"
-        f"Кошель: {data.get('wallet','Золотая монета, серебряная монета')}\n"
-        f"Заклинания: {data.get('spells','Нет начальных заклинаний')}\n"
-        f"Монеты: {coins_amount}\n"
-        f"Сумка: {data.get('bag','Пустая сумка')}\n"
-        "[/CHARACTER]\n"
-    )
+    # ---------- 2. CHARACTER блок ----------
+    # Блок собирается из FSM-данных игрока при каждом запросе (см. prompts.py),
+    # общий prompt.txt больше не перезаписывается.
+    if data.get("coins") != coins_amount:
+        await state.update_data(coins=coins_amount)
 
-    # ---------- 3. Запись prompt.txt ----------
-    try:
-        with open(PROMPT_PATH, "w", encoding="utf-8") as f:
-            # В файл кладём неизменяемый базовый промпт + CHARACTER блок в КОНЕЦ
-            f.write(BASE_PROMPT + "\n\n" + character_block)
-    except Exception as e:
-        logger.exception("Ошибка записи prompt.txt: %s", e)
-        await message.answer("⚠️ Не удалось сохранить персонажа.", parse_mode=ParseMode.HTML)
-        return
-
-    # ---------- 4. Подготовка данных для сцены ----------
+    # ---------- 3. Подготовка данных для сцены ----------
     scene_data = {
         "name": data.get("name", ""),
         "race": data.get("race", ""),
@@ -581,17 +843,17 @@ async def finish_creation(message: Message, state: FSMContext):
         "coins": coins_amount,
     }
 
-    # ---------- 5. Загрузка start_scene.txt ----------
+    # ---------- 4. Загрузка start_scene.txt ----------
     try:
         with open(START_SCENE_PATH, "r", encoding="utf-8") as f:
             template = f.read()
     except Exception:
         template = "{name} начинает своё приключение..."
 
-    # ---------- 6. Формирование стартовой сцены ----------
+    # ---------- 5. Формирование стартовой сцены ----------
     start_scene = template.format(**scene_data)
 
-    # ---------- 7. Формирование информации о персонаже для вывода ----------
+    # ---------- 6. Формирование информации о персонаже для вывода ----------
     stats_emoji = {
         "Сила": "💪",
         "Ловкость": "🏹",
@@ -625,53 +887,60 @@ async def finish_creation(message: Message, state: FSMContext):
         f"---\n\n"
     )
     
-    # ---------- 8. Отправка информации о персонаже ----------
+    # ---------- 7. Отправка информации о персонаже ----------
     await message.answer(
         character_info,
         parse_mode=ParseMode.HTML,
         reply_markup=make_choice_keyboard()
     )
     
-    # ---------- 9. Инициализация истории и генерация первого ответа от ИИ ----------
-    # Формируем запрос для ИИ, чтобы он сгенерировал стартовую сцену по шаблону
+    # ---------- 8. Инициализация истории и генерация первого ответа от ИИ ----------
+    # Стартовая сцена обычно уже сгенерирована заранее (см. opening.py),
+    # иначе генерируем её сейчас.
     # ВАЖНО: Информация о персонаже уже выведена отдельным сообщением, 
     # ИИ должен генерировать ТОЛЬКО стартовую сцену с вариантами действий
-    initial_prompt = (
-        f"Используй КАРКАС_ПЕРВОГО_ОТВЕТА из шаблона. "
-        f"Информация о персонаже уже показана игроку отдельно. "
-        f"Твоя задача - описать стартовую сцену для {data.get('name', '')} "
-        f"({data.get('race', '')}, {data.get('char_class', '')}, {data.get('background', '')}). "
-        f"Начни приключение в классической локации (дорога, таверна, лагерь). "
-        f"Опиши локацию, время суток, атмосферу (2-4 абзаца). "
-        f"Затем предложи ровно 3 варианта действий + возможность написать свой. "
-        f"НЕ дублируй информацию о персонаже - она уже выведена."
-    )
-    
-    history = [
-        {"role": "user", "content": initial_prompt}
-    ]
-    await state.update_data(history=history)
+    # Счётчик ходов и ход последней синхронизации листа персонажа (см. sheet.py)
+    await state.update_data(turn=0, sheet_turn=0)
     await state.set_state(Gen.wait)
-    
-    # Генерируем первый ответ от ИИ
-    thinking_msg = await message.answer(
-        "🔮 <i>Мастер готовит начало приключения...</i>",
-        parse_mode=ParseMode.HTML
-    )
-    
-    raw = await safe_ai_generate(history, state, Gen.history)
-    response = raw if raw else "⚠️ Пустой ответ от сервера."
+
+    with low_priority():
+        thinking_msg = await message.answer(
+            "🔮 <i>Мастер готовит начало приключения...</i>",
+            parse_mode=ParseMode.HTML
+        )
+
+    generation = generations.begin(state.key)
+    try:
+        prepared = await generations.run(generation, openings.take(state.key, data))
+        if prepared is not None:
+            initial_prompt, response = prepared
+            history = [Turn("user", initial_prompt)]
+            await state.update_data(history=history)
+        else:
+            history = [Turn("user", build_opening_prompt(data))]
+            await state.update_data(history=history)
+            response = await generate_reply(history, state, thinking_msg, generation, "start")
+    except asyncio.TimeoutError:
+        logger.warning("Генерация #%s не дождалась стартовой сцены", generation.id)
+        history = [Turn("user", build_opening_prompt(data))]
+        await state.update_data(history=history)
+        response = TIMEOUT_REPLY
+    except GenerationCancelled:
+        # Пока готовилась сцена, игрок нажал /start — начинать уже нечего
+        return await drop_placeholder(thinking_msg)
 
     # Сохраняем оригинальный ответ в историю (Markdown)
-    history.append({"role": "assistant", "content": response})
-    history = trim_history(history, max_pairs=10)
+    history.append(Turn("assistant", response))
+    history = await fold_history(history, state, max_pairs=10)
+    if not generations.finish(generation):
+        return await drop_placeholder(thinking_msg)
     await state.update_data(history=history)
+    await sync_game_state(state, response, 0)
     await state.set_state(Gen.history)
 
     # Конвертируем Markdown форматирование в HTML для отображения
-    response_html = markdown_to_html(response)
-
-    await message.answer(response_html, parse_mode=ParseMode.HTML, reply_markup=make_choice_keyboard())
+    await send_final_reply(message, thinking_msg, response)
+    prefetcher.start(state.key, history, await state.get_data())
 
 # Обработчик кнопки меню (должен быть выше continue_dialog для приоритета)
 @router.message(F.text == "⚙️ Меню")
@@ -684,6 +953,26 @@ async def show_menu(message: Message, state: FSMContext):
         reply_markup=make_menu_inline_keyboard()
     )
 
+async def show_sheet(message: Message, state: FSMContext, intent: str, fallback_text: str):
+    """Отвечает на статус/инвентарь/заклинания из FSM-данных; к LLM идёт, только если данных нет или они устарели."""
+    sheet_html = render_sheet(intent, await state.get_data())
+    if sheet_html is None:
+        return await process_user_turn(message, state, fallback_text, intent=intent)
+    await message.answer(sheet_html, parse_mode=ParseMode.HTML)
+
+# Кнопки игровой клавиатуры с локальным ответом
+SHEET_BUTTONS = {
+    "📊 Статус": ("status", "статус"),
+    "🎒 Инвентарь": ("inventory", "инвентарь"),
+    "✨ Заклинания": ("spells", "заклинания"),
+}
+
+@router.message(Gen.history, F.text.in_(SHEET_BUTTONS))
+async def sheet_button(message: Message, state: FSMContext):
+    """Обработчик кнопок Статус/Инвентарь/Заклинания игровой клавиатуры"""
+    intent, fallback_text = SHEET_BUTTONS[message.text]
+    await show_sheet(message, state, intent, fallback_text)
+
 @router.message(Gen.history)
 async def continue_dialog(message: Message, state: FSMContext):
     user_text = (message.text or "").strip()
@@ -694,7 +983,7 @@ async def continue_dialog(message: Message, state: FSMContext):
 
     # Обработка вариантов выбора 1/2/3
     if user_text in {"1", "2", "3"}:
-        user_content = f"Выбираю вариант {user_text}."
+        user_content = choice_content(user_text)
         return await process_user_turn(message, state, user_content)
 
     # Свой вариант — переключаемся в режим ввода собственного действия
@@ -736,67 +1025,81 @@ async def custom_action(message: Message, state: FSMContext):
 async def menu_status_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Статус в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "статус")
+    await show_sheet(callback.message, state, CALLBACK_INTENTS[callback.data], "статус")
 
 @router.callback_query(F.data == "menu_inventory")
 async def menu_inventory_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Инвентарь в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "инвентарь")
+    await show_sheet(callback.message, state, CALLBACK_INTENTS[callback.data], "инвентарь")
 
 @router.callback_query(F.data == "menu_spells")
 async def menu_spells_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Заклинания в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "заклинания")
+    await show_sheet(callback.message, state, CALLBACK_INTENTS[callback.data], "заклинания")
 
 @router.callback_query(F.data == "menu_reputation")
 async def menu_reputation_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Репутация в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "репутация")
+    await process_user_turn(callback.message, state, "репутация", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_quests")
 async def menu_quests_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Задания в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "задания")
+    await process_user_turn(callback.message, state, "задания", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_encyclopedia")
 async def menu_encyclopedia_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Энциклопедия в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "энциклопедия")
+    await process_user_turn(callback.message, state, "энциклопедия", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_short_rest")
 async def menu_short_rest_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Короткий отдых в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "короткий отдых")
+    await process_user_turn(callback.message, state, "короткий отдых", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_long_rest")
 async def menu_long_rest_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Долгий отдых в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "долгий отдых")
+    await process_user_turn(callback.message, state, "долгий отдых", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_rumors")
 async def menu_rumors_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Слухи в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "слухи")
+    await process_user_turn(callback.message, state, "слухи", intent=CALLBACK_INTENTS[callback.data])
 
 @router.callback_query(F.data == "menu_save")
 async def menu_save_callback(callback: types.CallbackQuery, state: FSMContext):
-    """Обработчик кнопки Сохранение в меню"""
+    """Обработчик кнопки Сохранение в меню: список слотов"""
+    await callback.answer()
+    await show_saves(callback.message, state.key.user_id)
+
+@router.callback_query(F.data.startswith("save_slot:"))
+async def save_slot_callback(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    slot = parse_slot(callback.data.split(":", 1)[1])
+    if slot is not None:
+        await save_campaign(callback.message, state, slot)
+
+@router.callback_query(F.data.startswith("load_slot:"))
+async def load_slot_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
-    await process_user_turn(callback.message, state, "сохранение")
+    slot = parse_slot(callback.data.split(":", 1)[1])
+    if slot is not None:
+        await load_campaign(callback.message, state, slot)
 
 @router.callback_query(F.data == "menu_trade")
 async def menu_trade_callback(callback: types.CallbackQuery, state: FSMContext):
     """Обработчик кнопки Торговля в меню"""
     await callback.answer()
-    await process_user_turn(callback.message, state, "торговля")
+    await process_user_turn(callback.message, state, "торговля", intent=CALLBACK_INTENTS[callback.data])
 
 @router.message(Gen.wait)
 async def stop_flood(message: Message):
@@ -815,4 +1118,5 @@ async def stop_flood(message: Message):
         "🛡️ <i>Хранители знаний проверяют информацию...</i>",
     ]
 
-    await message.answer(random.choice(waiting_messages), parse_mode=ParseMode.HTML)
\ No newline at end of file
+    with low_priority():
+        await message.answer(random.choice(waiting_messages), parse_mode=ParseMode.HTML)
\ No newline at end of file
@@ -0,0 +1,331 @@
+import re
+import json
+from typing import Optional
+
+from config import HISTORY_FULL_REPLIES
+from context_builder import estimate_tokens
+from game_state import parse_response
+
+# Компактная история диалога.
+# Реплика — запись Turn со слотами role/content вместо dict: в памяти FSM она
+# занимает меньше, а в JSON (SQLite, Redis, снимки сохранений) пишется парой
+# ["a", "текст"] вместо {"role": "assistant", "content": "текст"}.
+# В старых ответах мастера (кроме HISTORY_FULL_REPLIES последних) механические
+# блоки — LOOT, XP, STATUS, таблицы торговли, строки боя с эмодзи — сворачиваются
+# в одну строку-сводку; повествование, реплики NPC и варианты действий остаются.
+# Эти ответы пересылаются модели с каждым ходом, пока не выпадут из окна истории.
+
+ROLE_CODES = {"user": "u", "assistant": "a", "system": "s"}
+ROLES = {code: role for role, code in ROLE_CODES.items()}
+
+# Поля данных FSM со списками реплик
+HISTORY_FIELDS = ("history", "summary_pending")
+
+# Начало строки-сводки; такие строки повторно не сворачиваются
+DIGEST_MARKER = "⚙️"
+
+# Эмодзи в механических строках промпта ("🎲 Атака: …", "Орк-1: ❤️ 15 → 6"); в повествовании
+# они тоже встречаются, поэтому механикой считается строка с эмодзи в начале или почти без слов
+_EMOJI = "[\u2300-\u23ff\u2500-\u27bf\u2b00-\u2bff\U0001f000-\U0001faff]"
+_EMOJI_RE = re.compile(_EMOJI)
+_LEADING_EMOJI_RE = re.compile(r"[*_\s]*" + _EMOJI)
+_CYRILLIC_WORD_RE = re.compile(r"[А-Яа-яЁё]{2,}")
+_MAX_MECHANICAL_WORDS = 3
+_LATIN_RE = re.compile(r"[A-Za-z]")
+_CYRILLIC_RE = re.compile(r"[А-Яа-яЁё]")
+_LETTER_RE = re.compile(r"[^\W\d_]")
+_QUOTE_RE = re.compile("[\"«»“”„]")
+# Служебная метка в начале строки: "TOTAL XP:", "**Enemies**:" — капсом или из формата промпта,
+# чтобы реплика "Guard: …" не сошла за механику
+_LATIN_LABEL_RE = re.compile(r"[*_]*([A-Z][A-Za-z ]*?)[*_]*:")
+_MECHANICAL_LABELS = {
+    "enemies", "distances", "inventory", "xp", "total xp", "status", "effect", "wallet", "gold",
+    "arrows", "bolts", "inspiration", "traumas", "days", "reputation", "quests", "success", "sold", "spent",
+}
+# Вариант действия: "1. …", "**2)** …", "3️⃣ …"
+_OPTION_RE = re.compile(r"[*_\s]*\d+(?:[.)]|️⃣)")
+_LABEL_JUNK_RE = re.compile(r"[^\w\s-]")
+_MAX_LABELS = 6
+
+
+class Turn:
+    """Одна реплика истории. Читается как dict (turn["content"], turn.get("role"))."""
+    __slots__ = ("role", "content")
+
+    def __init__(self, role: str, content: str):
+        self.role = role
+        self.content = content
+
+    def get(self, name: str, default=None):
+        return getattr(self, name, default) if name in self.__slots__ else default
+
+    def __getitem__(self, name: str):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def keys(self):
+        return self.__slots__
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Turn):
+            return self.role == other.role and self.content == other.content
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        return f"Turn({self.role!r}, {self.content[:40]!r})"
+
+
+def to_turn(item) -> Turn:
+    """Turn из Turn, пары ["a", "текст"] или старого dict (role/content или role/text)."""
+    if isinstance(item, Turn):
+        return item
+    if isinstance(item, (list, tuple)):
+        return Turn(ROLES.get(item[0], item[0]), item[1])
+    return Turn(item.get("role", "user"), item.get("content", item.get("text", "")))
+
+
+# ---------- JSON ----------
+
+def encode_turn(obj):
+    """default= для json.dumps: Turn → ["a", "текст"]."""
+    if isinstance(obj, Turn):
+        return [ROLE_CODES.get(obj.role, obj.role), obj.content]
+    raise TypeError(f"{type(obj).__name__} не сериализуется в JSON")
+
+
+def restore_turns(data: dict) -> dict:
+    """После json.loads: списки реплик в полях HISTORY_FIELDS → Turn (на месте)."""
+    for field in HISTORY_FIELDS:
+        items = data.get(field)
+        if items:
+            data[field] = [to_turn(item) for item in items]
+    return data
+
+
+def encode_data(data) -> str:
+    """Данные FSM → JSON для SQLite/Redis."""
+    return json.dumps(data, ensure_ascii=False, default=encode_turn)
+
+
+def decode_data(raw) -> dict:
+    """JSON из SQLite/Redis → данные FSM с репликами Turn."""
+    data = json.loads(raw)
+    return restore_turns(data) if isinstance(data, dict) else data
+
+
+# ---------- Сворачивание механики ----------
+
+def _is_latin_label(line: str) -> bool:
+    match = _LATIN_LABEL_RE.match(line)
+    if match is None:
+        return False
+    label = match.group(1).strip()
+    return label.isupper() or label.lower() in _MECHANICAL_LABELS
+
+
+def _is_mechanical(line: str) -> bool:
+    if line.startswith(DIGEST_MARKER) or _OPTION_RE.match(line):
+        return False
+    if line.startswith("|") or (_is_latin_label(line) and not _QUOTE_RE.search(line)):
+        return True
+    if _EMOJI_RE.search(line):
+        return bool(_LEADING_EMOJI_RE.match(line)) or len(_CYRILLIC_WORD_RE.findall(line)) <= _MAX_MECHANICAL_WORDS
+    # Игра ведётся по-русски: строка только из латиницы капсом или с числами — служебная
+    # (MASTER REMINDER), если это не реплика в кавычках
+    if not _LATIN_RE.search(line) or _CYRILLIC_RE.search(line) or _QUOTE_RE.search(line):
+        return False
+    letters = "".join(_LATIN_RE.findall(line))
+    return letters.isupper() or any(char.isdigit() for char in line)
+
+
+def _label(line: str) -> Optional[str]:
+    if line.startswith("|"):
+        return "таблица"
+    head = line.split(":", 1)[0]
+    words = _LABEL_JUNK_RE.sub(" ", head).split()
+    label = " ".join(words)
+    if not words or len(words) > 3 or len(label) > 24 or not _LETTER_RE.search(label):
+        return None
+    return label
+
+
+def _facts(text: str) -> list:
+    """Итоговые числа блока: пары (как показать, текст для сравнения с заголовками)."""
+    state, found = parse_response(text)
+    if not found:
+        return []
+    facts = []
+    if state.hp is not None:
+        hp = f"{state.hp}/{state.hp_max}" if state.hp_max is not None else f"{state.hp}"
+        facts.append((f"❤️{hp}", hp))
+    if state.slots:
+        facts.append((f"🔮{state.slots}", str(state.slots)))
+    if state.gold is not None:
+        facts.append((f"🟡{state.gold}", str(state.gold)))
+    if state.xp is not None:
+        facts.append((f"XP {state.xp}/{state.xp_next}", f"{state.xp}/{state.xp_next}"))
+    if state.level is not None:
+        facts.append((f"L{state.level}", f"l{state.level}"))
+    if state.inventory_used is not None:
+        used = f"{state.inventory_used}/{state.inventory_max}"
+        facts.append((f"📦{used}", used))
+    if state.day is not None:
+        facts.append((f"день {state.day}", f"день {state.day}"))
+    if state.location:
+        facts.append((f"📍{state.location}", state.location))
+    return facts
+
+
+def digest(block: list) -> str:
+    """Строки механического блока → одна строка: заголовки блоков и итоговые числа."""
+    labels = []
+    for line in block:
+        label = _label(line)
+        if label and label not in labels:
+            labels.append(label)
+    if len(labels) > _MAX_LABELS:
+        labels = labels[:_MAX_LABELS] + ["…"]
+    text = ", ".join(labels) or "механика"
+    # То, что уже есть в заголовках ("Лес День 3"), второй раз не пишем
+    facts = " ".join(shown for shown, plain in _facts("\n".join(block)) if plain.lower() not in text.lower())
+    return f"{DIGEST_MARKER} {text}: {facts}" if facts else f"{DIGEST_MARKER} {text}"
+
+
+def _shorter(digest_line: str, lines: list) -> bool:
+    original = "\n".join(lines)
+    return len(digest_line) < len(original) and estimate_tokens(digest_line) <= estimate_tokens(original)
+
+
+def collapse_mechanics(text: str) -> str:
+    """
+    Сворачивает подряд идущие механические строки ответа в строку-сводку.
+    Пустые строки и разделители внутри блока поглощаются, после блока — остаются.
+    Блок, сводка которого не короче его самого, остаётся как был. Повторный
+    вызов ничего не меняет.
+    """
+    out = []
+    block = []
+    raw = []
+    gap = []
+    collapsed = False
+
+    def flush():
+        nonlocal collapsed
+        line = digest(block)
+        if _shorter(line, raw):
+            out.append(line)
+            collapsed = True
+        else:
+            out.extend(raw)
+        block.clear()
+        raw.clear()
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not _LETTER_RE.search(stripped):
+            # Пустая строка, "---", "═══" — граница абзаца; внутри блока не нужна
+            (gap if block else out).append(line)
+            continue
+        if _is_mechanical(stripped):
+            raw.extend(gap)
+            gap.clear()
+            block.append(stripped)
+            raw.append(line)
+            continue
+        if block:
+            flush()
+        out.extend(gap)
+        gap.clear()
+        out.append(line)
+    if block:
+        flush()
+    out.extend(gap)
+    return "\n".join(out).strip() if collapsed else text
+
+
+# ---------- История ----------
+
+def _stored_bytes(turn: Turn) -> int:
+    # Как реплика хранилась раньше: {"role": …, "content": …}
+    return len(json.dumps({"role": turn.role, "content": turn.content}, ensure_ascii=False).encode("utf-8"))
+
+
+def _encoded_bytes(turn: Turn) -> int:
+    return len(json.dumps(encode_turn(turn), ensure_ascii=False).encode("utf-8"))
+
+
+def compact_history(history: list, keep_full: int = HISTORY_FULL_REPLIES) -> tuple:
+    """
+    Приводит реплики к Turn и сворачивает механику во всех ответах мастера,
+    кроме keep_full последних.
+
+    Returns:
+        tuple: (новая история, [свёрнуто ответов, байт до, байт после, токенов до, токенов после])
+    """
+    result = [to_turn(item) for item in history]
+    delta = [0, 0, 0, 0, 0]
+    replies = 0
+    for index in range(len(result) - 1, -1, -1):
+        turn = result[index]
+        if turn.role != "assistant":
+            continue
+        replies += 1
+        if replies <= keep_full:
+            continue
+        compact = collapse_mechanics(turn.content)
+        if compact == turn.content:
+            continue
+        compacted = Turn(turn.role, compact)
+        result[index] = compacted
+        delta[0] += 1
+        delta[1] += _stored_bytes(turn)
+        delta[2] += _encoded_bytes(compacted)
+        delta[3] += estimate_tokens(turn.content)
+        delta[4] += estimate_tokens(compact)
+    return result, delta
+
+
+def footprint(history: list) -> dict:
+    """Сколько история весит сейчас: в старом формате dict и в компактном, в токенах."""
+    turns = [to_turn(item) for item in history]
+    return {
+        "messages": len(turns),
+        "bytes_dict": sum(_stored_bytes(turn) for turn in turns),
+        "bytes": sum(_encoded_bytes(turn) for turn in turns),
+        "tokens": sum(estimate_tokens(turn.content) for turn in turns),
+    }
+
+
+class HistoryStats:
+    """Счётчики сворачивания с запуска процесса (по всем сессиям)."""
+
+    def __init__(self):
+        self.stats = {"compacted": 0, "bytes_before": 0, "bytes_after": 0, "tokens_before": 0, "tokens_after": 0}
+
+    def add(self, delta: list) -> None:
+        for name, value in zip(self.stats, delta):
+            self.stats[name] += value
+
+    def report(self) -> dict:
+        return {
+            **self.stats,
+            "bytes_saved": self.stats["bytes_before"] - self.stats["bytes_after"],
+            "tokens_saved": self.stats["tokens_before"] - self.stats["tokens_after"],
+        }
+
+
+def describe_session(data: dict) -> str:
+    """Отчёт по одной сессии: текущий вес истории и итог сворачивания (до → после)."""
+    now = footprint(data.get("history", []))
+    compacted, bytes_before, bytes_after, tokens_before, tokens_after = data.get("history_stats") or [0, 0, 0, 0, 0]
+    return "\n".join([
+        f"История: {now['messages']} реплик, ~{now['tokens']} токенов за запрос",
+        f"Байт: {now['bytes']} (в формате dict было бы {now['bytes_dict']})",
+        f"Свёрнуто ответов мастера: {compacted}",
+        f"  байт {bytes_before} → {bytes_after}, токенов {tokens_before} → {tokens_after} "
+        f"(−{tokens_before - tokens_after} в каждом запросе, пока ответ в окне истории)",
+    ])
+
+
+history_stats = HistoryStats()
@@ -0,0 +1,130 @@
+import gzip
+import json
+import aiohttp
+from config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_KEEPALIVE_TIMEOUT,
+    HTTP_DNS_TTL,
+    HTTP_GZIP_REQUESTS,
+)
+
+# Единственная на процесс сессия aiohttp: создаётся в run.py при старте
+# и закрывается при остановке. Все запросы к LLM идут через неё.
+_session = None
+
+
+class HttpStats:
+    """Счётчики пула: сколько соединений открыто заново, а сколько переиспользовано."""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self.reused_connections = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.bytes_sent = 0
+        self.bytes_raw = 0
+
+    def as_dict(self) -> dict:
+        total = self.new_connections + self.reused_connections
+        return {
+            "requests": self.requests,
+            "new_connections": self.new_connections,
+            "reused_connections": self.reused_connections,
+            "reuse_ratio": round(self.reused_connections / total, 3) if total else 0.0,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "bytes_sent": self.bytes_sent,
+            "bytes_raw": self.bytes_raw,
+        }
+
+
+stats = HttpStats()
+
+
+def _make_trace_config() -> aiohttp.TraceConfig:
+    trace = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        stats.requests += 1
+
+    async def on_connection_create_end(session, ctx, params):
+        stats.new_connections += 1
+
+    async def on_connection_reuseconn(session, ctx, params):
+        stats.reused_connections += 1
+
+    async def on_dns_cache_hit(session, ctx, params):
+        stats.dns_cache_hits += 1
+
+    async def on_dns_cache_miss(session, ctx, params):
+        stats.dns_cache_misses += 1
+
+    trace.on_request_start.append(on_request_start)
+    trace.on_connection_create_end.append(on_connection_create_end)
+    trace.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace.on_dns_cache_hit.append(on_dns_cache_hit)
+    trace.on_dns_cache_miss.append(on_dns_cache_miss)
+    return trace
+
+
+def _create_session() -> aiohttp.ClientSession:
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=HTTP_DNS_TTL,
+    )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[_make_trace_config()])
+
+
+async def init_http_client() -> aiohttp.ClientSession:
+    """Создаёт общую сессию (вызывается из run.py при старте)."""
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """
+    Возвращает общую сессию.
+    Если run.py её не создал (скрипты, отладка), сессия создаётся лениво.
+    Должна вызываться внутри запущенного event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = _create_session()
+    return _session
+
+
+async def close_http_client() -> None:
+    """Закрывает общую сессию и все keep-alive соединения (вызывается при остановке)."""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def encode_json_body(payload: dict) -> tuple:
+    """
+    Сериализует тело запроса в JSON и при включённом HTTP_GZIP_REQUESTS сжимает его.
+
+    Returns:
+        tuple: (bytes тела, dict дополнительных заголовков)
+    """
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    stats.bytes_raw += len(body)
+    if HTTP_GZIP_REQUESTS:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    stats.bytes_sent += len(body)
+    return body, headers
+
+
+def http_stats() -> dict:
+    """Снимок счётчиков пула для логов и админских команд."""
+    return stats.as_dict()
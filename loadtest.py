@@ -0,0 +1,571 @@
+"""
+Офлайн нагрузочный прогон бота: N виртуальных игроков проходят /start → создание
+персонажа → ходы 1/2/3 и кнопки меню через настоящий router.
+
+Вместо внешних сервисов — две локальные заглушки:
+- фейковый completion-сервер Yandex (aiohttp на 127.0.0.1) с настраиваемой
+  задержкой, потоковым режимом и долей ошибок;
+- фейковая сессия Telegram: запросы бота не уходят в сеть, а сразу получают ответ.
+  С --workers N бот работает в многопроцессном режиме (supervisor.py), и Telegram
+  заменяет локальный HTTP-сервер Bot API, общий для всех воркеров (только Linux/macOS).
+
+Пример:
+    python loadtest.py --players 200 --turns 10 --latency 1.5 --error-rate 0.02
+    python loadtest.py --players 50 --stream --max-p95 5 --max-errors 0   # как гейт для CI
+    python loadtest.py --players 400 --turns 5 --latency 0 --think 0 --workers 4   # масштабирование по ядрам
+    python loadtest.py --players 400 --turns 5 --latency 0 --think 0 --scaling 8   # 1, 2, 4, 8 воркеров подряд
+
+С --scaling N прогон повторяется отдельными процессами для 1, 2, 4 … N воркеров и печатает
+пропускную способность (ходов/с), ускорение относительно одного воркера и эффективность.
+Ускорение имеет смысл мерить на машине, где ядер не меньше N (os.cpu_count() в отчёте).
+
+Код выхода 1, если превышены --max-p95 / --max-errors.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tracemalloc
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Сцена в формате мастера: три варианта и механические строки для game_state
+FAKE_SCENE = (
+    "📅 DAY 1 | 📍 Таверна «Ржавый якорь»\n\n"
+    "Дождь стучит по ставням, у очага спорят двое наёмников. "
+    "Трактирщик косится на тебя и протирает кружку.\n\n"
+    "❤️ HP 12/12 | 🔮 Слоты 2/2 | 💰 🟡 7\n"
+    "📦 Inventory 5/36\n\n"
+    "1. Подсесть к наёмникам\n"
+    "2. Расспросить трактирщика\n"
+    "3. Выйти под дождь\n"
+    "4. Свой вариант"
+)
+
+MENU_CALLBACKS = ("menu_status", "menu_inventory", "menu_rumors", "menu_quests", "menu_short_rest")
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def rss_mb() -> float:
+    """Пиковая память процесса, МБ. Без модуля resource (Windows) — через psutil, если он есть."""
+    try:
+        import resource
+    except ImportError:
+        try:
+            import psutil
+        except ImportError:
+            # Остаётся только память Python под --tracemalloc (пик), иначе 0
+            return tracemalloc.get_traced_memory()[1] / 2 ** 20 if tracemalloc.is_tracing() else 0.0
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 2 ** 20
+    # ru_maxrss в Linux — килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# ---------- Фейковый Yandex ----------
+
+class FakeYandex:
+    """Completion-сервер: задержка ~ logнормальная вокруг latency, ошибки с долей error_rate."""
+
+    def __init__(self, latency: float, jitter: float, error_rate: float, chunk_delay: float):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chunk_delay = chunk_delay
+        self.requests = 0
+        self.errors = 0
+        self.runner = None
+        self.url = None
+
+    def _delay(self) -> float:
+        if self.latency <= 0:
+            return 0.0
+        return random.lognormvariate(0, self.jitter) * self.latency if self.jitter else self.latency
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        self.requests += 1
+        payload = await request.json()
+        input_tokens = sum(len(m.get("text", "")) for m in payload.get("messages", [])) // 3
+
+        if random.random() < self.error_rate:
+            self.errors += 1
+            await asyncio.sleep(self._delay() / 4)
+            if random.random() < 0.5:
+                return web.Response(status=429, text="rate limited", headers={"Retry-After": "1"})
+            return web.Response(status=503, text="unavailable")
+
+        usage = {"inputTextTokens": str(input_tokens), "completionTokens": str(len(FAKE_SCENE) // 3)}
+        if not payload.get("completionOptions", {}).get("stream"):
+            await asyncio.sleep(self._delay())
+            return web.json_response({"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": FAKE_SCENE}, "status": "ALTERNATIVE_STATUS_FINAL"}],
+                "usage": usage,
+            }})
+
+        # Потоковый ответ: NDJSON, в каждой строке — накопленный текст
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        await asyncio.sleep(self._delay() / 3)
+        lines = FAKE_SCENE.split("\n")
+        for i in range(1, len(lines) + 1):
+            chunk = {"result": {
+                "alternatives": [{"message": {"role": "assistant", "text": "\n".join(lines[:i])}}],
+                "usage": usage,
+            }}
+            await response.write(json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n")
+            await asyncio.sleep(self.chunk_delay)
+        await response.write_eof()
+        return response
+
+    async def start(self) -> str:
+        from aiohttp import web
+
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_post("/foundationModels/v1/completion", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.url = f"http://127.0.0.1:{port}/foundationModels/v1/completion"
+        return self.url
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+# ---------- Фейковый Telegram ----------
+
+def fake_message(message_id: int, chat_id: int, text) -> dict:
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "text": text or "",
+    }
+
+
+def count_call(counters: dict, name: str, text) -> None:
+    counters[name] = counters.get(name, 0) + 1
+    if name == "SendMessage" and text and text.startswith("⚠️"):
+        counters["error_replies"] = counters.get("error_replies", 0) + 1
+
+
+class FakeTelegram:
+    """Bot API по HTTP (для --workers): воркеры — отдельные процессы и ходят сюда через TELEGRAM_API_URL."""
+
+    def __init__(self, latency: float, counters: dict):
+        self.latency = latency
+        self.counters = counters
+        self.runner = None
+        self._message_id = 0
+
+    async def handle(self, request):
+        from aiohttp import web
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        method = request.match_info["method"]
+        data = await request.post()
+        name = method[:1].upper() + method[1:]
+        text = data.get("text")
+        count_call(self.counters, name, text)
+        if name in ("SendMessage", "EditMessageText"):
+            self._message_id += 1
+            result = fake_message(self._message_id, int(data.get("chat_id") or 0), text)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self) -> str:
+        from aiohttp import web
+
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+
+    async def stop(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+def make_fake_session(latency: float, counters: dict):
+    from aiogram.client.session.base import BaseSession
+
+    class FakeTelegramSession(BaseSession):
+        """Сессия бота без сети: на каждый метод сразу отвечает правдоподобным результатом."""
+
+        def __init__(self):
+            super().__init__()
+            self._message_id = 0
+
+        async def close(self) -> None:
+            pass
+
+        async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+            if False:
+                yield b""
+
+        async def make_request(self, bot, method, timeout=None):
+            if latency:
+                await asyncio.sleep(latency)
+            name = type(method).__name__
+            text = getattr(method, "text", None)
+            count_call(counters, name, text)
+            if name in ("SendMessage", "EditMessageText"):
+                self._message_id += 1
+                result = fake_message(self._message_id, getattr(method, "chat_id", 0) or 0, text)
+            else:
+                result = True
+            content = json.dumps({"ok": True, "result": result}, ensure_ascii=False)
+            response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+            return response.result
+
+    return FakeTelegramSession()
+
+
+# ---------- Виртуальные игроки ----------
+
+class Player:
+    def __init__(self, index: int, harness: "Harness"):
+        self.chat_id = 100000 + index
+        self.name = f"Игрок{index}"
+        self.harness = harness
+
+    def _user(self) -> dict:
+        return {"id": self.chat_id, "is_bot": False, "first_name": self.name}
+
+    def _chat(self) -> dict:
+        return {"id": self.chat_id, "type": "private", "first_name": self.name}
+
+    def message(self, text: str) -> dict:
+        return {"message": {
+            "message_id": self.harness.next_id(),
+            "date": int(time.time()),
+            "chat": self._chat(),
+            "from": self._user(),
+            "text": text,
+        }}
+
+    def callback(self, data: str) -> dict:
+        return {"callback_query": {
+            "id": str(self.harness.next_id()),
+            "from": self._user(),
+            "chat_instance": str(self.chat_id),
+            "data": data,
+            "message": {
+                "message_id": self.harness.next_id(),
+                "date": int(time.time()),
+                "chat": self._chat(),
+                "text": "⚙️ Меню",
+            },
+        }}
+
+    async def run(self, turns: int, think: float) -> None:
+        h = self.harness
+        await h.send(self.message("/start"), "start")
+        await h.send(self.callback("start_game"), "start_game")
+        await h.send(self.message(str(random.randint(1, 12))), "race")
+        await h.send(self.message(self.name), "name")
+        await h.send(self.message(str(random.randint(1, 12))), "class")
+        await asyncio.sleep(random.uniform(0, think))
+        # Выбор предыстории завершает создание и запрашивает стартовую сцену
+        await h.send(self.message(str(random.randint(1, 11))), "opening", turn=True)
+        for _ in range(turns):
+            await asyncio.sleep(random.uniform(0, think))
+            roll = random.random()
+            if roll < 0.75:
+                await h.send(self.message(random.choice("123")), "choice", turn=True)
+            elif roll < 0.9:
+                await h.send(self.callback(random.choice(MENU_CALLBACKS)), "menu", turn=True)
+            else:
+                await h.send(self.message("📊 Статус"), "sheet", turn=True)
+
+
+class Harness:
+    def __init__(self, feed):
+        # feed(update) — обработать обновление и вернуться, когда бот закончил
+        self.feed = feed
+        self._id = 0
+        self.latencies = {}
+        self.turn_latencies = []
+        self.exceptions = 0
+
+    def next_id(self) -> int:
+        self._id += 1
+        return self._id
+
+    async def send(self, update: dict, kind: str, turn: bool = False) -> None:
+        update["update_id"] = self.next_id()
+        started = time.perf_counter()
+        try:
+            await self.feed(update)
+        except Exception as e:
+            self.exceptions += 1
+            print(f"⚠️ {kind}: {type(e).__name__}: {e}", file=sys.stderr)
+        elapsed = time.perf_counter() - started
+        self.latencies.setdefault(kind, []).append(elapsed)
+        if turn:
+            self.turn_latencies.append(elapsed)
+
+
+# ---------- Запуск ----------
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Офлайн нагрузочный прогон бота")
+    parser.add_argument("--players", type=int, default=100, help="число виртуальных игроков")
+    parser.add_argument("--turns", type=int, default=10, help="ходов на игрока после создания персонажа")
+    parser.add_argument("--ramp", type=float, default=5.0, help="за сколько секунд подключаются все игроки")
+    parser.add_argument("--think", type=float, default=0.5, help="максимальная пауза игрока между ходами, с")
+    parser.add_argument("--latency", type=float, default=1.0, help="средняя задержка фейкового Yandex, с")
+    parser.add_argument("--jitter", type=float, default=0.4, help="разброс задержки (sigma логнормального)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 429/503")
+    parser.add_argument("--stream", action="store_true", help="потоковый режим (YANDEX_STREAMING=1)")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="пауза между кусками потока, с")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка ответа фейкового Telegram, с")
+    parser.add_argument("--workers", type=int, default=1, help="процессов-воркеров (многопроцессный режим)")
+    parser.add_argument("--scaling", type=int, default=None,
+                        help="замер масштабирования: прогоны с 1, 2, 4 … N воркерами")
+    parser.add_argument("--tracemalloc", action="store_true", help="точный учёт памяти Python (медленнее)")
+    parser.add_argument("--json", action="store_true", help="вывести отчёт в JSON")
+    parser.add_argument("--max-p95", type=float, default=None, help="порог p95 хода, с (иначе код выхода 1)")
+    parser.add_argument("--max-errors", type=int, default=None, help="порог числа ошибок (иначе код выхода 1)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args()
+
+
+def configure_env(args) -> None:
+    # Всё до импорта config: прогон не должен трогать боевую базу и сеть
+    os.environ["TG_TOKEN"] = "123456:LOADTEST"
+    os.environ["YANDEX_API_KEY"] = "loadtest"
+    os.environ["LLM_PROVIDERS"] = "yandex"
+    os.environ["STORAGE_BACKEND"] = "memory"
+    os.environ["TOKENIZE_CALIBRATION"] = "0"
+    os.environ["YANDEX_STREAMING"] = "1" if args.stream else "0"
+    # При потоке правки идут часто — в прогоне не ждём лимитов Telegram
+    os.environ.setdefault("STREAM_EDIT_INTERVAL", "0.2")
+
+
+async def run(args) -> dict:
+    sys.path.insert(0, BASE_DIR)
+    fake = FakeYandex(args.latency, args.jitter, args.error_rate, args.chunk_delay)
+    yandex_url = await fake.start()
+    counters = {}
+
+    if args.workers > 1:
+        from supervisor import Supervisor
+
+        # Воркеры — отдельные процессы: Telegram и Yandex для них — локальные HTTP-заглушки
+        telegram = FakeTelegram(args.tg_latency, counters)
+        env = {"TELEGRAM_API_URL": await telegram.start(), "YANDEX_API_URL": yandex_url}
+        supervisor = Supervisor(args.workers, env=env)
+        await supervisor.start()
+        harness = Harness(supervisor.process)
+
+        async def shutdown():
+            await supervisor.stop()
+            await telegram.stop()
+
+        def process_stats() -> dict:
+            # Очереди LLM, провайдеры и пул HTTP у каждого воркера свои — воркеры печатают их при выходе
+            return {"workers": supervisor.report()}
+    else:
+        from aiogram import Bot, Dispatcher
+        import yandex
+        from handlers import router
+        from admin import router as admin_router
+        from storage import create_storage
+        from http_client import init_http_client, close_http_client, http_stats
+        from scheduler import scheduler
+        from generate import provider_stats
+        from outbound import outbox
+
+        yandex.YANDEX_API_URL = yandex_url
+        bot = Bot(token=os.environ["TG_TOKEN"], session=make_fake_session(args.tg_latency, counters))
+        bot.session.middleware(outbox)
+        dp = Dispatcher(storage=create_storage())
+        dp.include_router(admin_router)
+        dp.include_router(router)
+        await init_http_client()
+        harness = Harness(lambda update: dp.feed_raw_update(bot, update))
+
+        async def shutdown():
+            await outbox.close()
+            await close_http_client()
+            await dp.storage.close()
+
+        def process_stats() -> dict:
+            return {
+                "llm_scheduler": scheduler.stats(),
+                "providers": provider_stats(),
+                "http": http_stats(),
+                "outbound": outbox.report(),
+            }
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    rss_before = rss_mb()
+    started = time.perf_counter()
+
+    async def player_task(index: int):
+        await asyncio.sleep(args.ramp * index / max(1, args.players))
+        await Player(index, harness).run(args.turns, args.think)
+
+    try:
+        await asyncio.gather(*(player_task(i) for i in range(args.players)))
+    finally:
+        elapsed = time.perf_counter() - started
+        traced = tracemalloc.get_traced_memory() if args.tracemalloc else None
+        if args.tracemalloc:
+            tracemalloc.stop()
+        await shutdown()
+        await fake.stop()
+
+    turns = harness.turn_latencies
+    report = {
+        "players": args.players,
+        "elapsed_s": round(elapsed, 2),
+        "turns": len(turns),
+        "throughput_turns_per_s": round(len(turns) / elapsed, 2) if elapsed else 0.0,
+        "turn_p50_s": round(percentile(turns, 0.50), 3),
+        "turn_p95_s": round(percentile(turns, 0.95), 3),
+        "turn_p99_s": round(percentile(turns, 0.99), 3),
+        "by_kind_p95_s": {kind: round(percentile(values, 0.95), 3) for kind, values in harness.latencies.items()},
+        "exceptions": harness.exceptions,
+        "error_replies": counters.get("error_replies", 0),
+        "yandex_requests": fake.requests,
+        "yandex_injected_errors": fake.errors,
+        "telegram_calls": {k: v for k, v in counters.items() if k != "error_replies"},
+        "rss_growth_mb": round(rss_mb() - rss_before, 1),
+        **process_stats(),
+    }
+    if traced is not None:
+        report["tracemalloc_current_mb"] = round(traced[0] / 2 ** 20, 1)
+        report["tracemalloc_peak_mb"] = round(traced[1] / 2 ** 20, 1)
+    return report
+
+
+def print_report(report: dict) -> None:
+    print(f"🧪 Игроков: {report['players']}, ходов: {report['turns']}, время: {report['elapsed_s']} с")
+    print(f"⚡ Пропускная способность: {report['throughput_turns_per_s']} ходов/с")
+    print(f"⏱️ Ход: p50 {report['turn_p50_s']} с | p95 {report['turn_p95_s']} с | p99 {report['turn_p99_s']} с")
+    for kind, value in report["by_kind_p95_s"].items():
+        print(f"   {kind}: p95 {value} с")
+    print(f"❌ Исключений: {report['exceptions']}, ответов с ошибкой: {report['error_replies']} "
+          f"(внесено ошибок Yandex: {report['yandex_injected_errors']} из {report['yandex_requests']})")
+    print(f"🧠 Рост RSS: {report['rss_growth_mb']} МБ", end="")
+    if "tracemalloc_peak_mb" in report:
+        print(f", tracemalloc: {report['tracemalloc_current_mb']} МБ (пик {report['tracemalloc_peak_mb']} МБ)", end="")
+    print()
+    if "workers" in report:
+        print(f"ℹ️ Воркеры: {report['workers']}")
+    else:
+        print(f"ℹ️ Очередь LLM: {report['llm_scheduler']}")
+        print(f"ℹ️ Провайдеры LLM: {report['providers']}")
+        print(f"ℹ️ Исходящие Telegram: {report['outbound']}")
+    print(f"ℹ️ Telegram: {report['telegram_calls']}")
+
+
+def scaling_steps(limit: int) -> list:
+    steps = []
+    workers = 1
+    while workers < limit:
+        steps.append(workers)
+        workers *= 2
+    return steps + [limit]
+
+
+def measure_scaling(args) -> dict:
+    """Те же параметры прогона с 1, 2, 4 … N воркерами; каждый прогон — в своём процессе."""
+    import subprocess
+
+    # Параметры прогона — как в командной строке, без самого замера, числа воркеров и порогов
+    passthrough = []
+    skip = False
+    for arg in sys.argv[1:]:
+        name = arg.split("=", 1)[0]
+        if skip:
+            skip = False
+        elif name in ("--scaling", "--workers", "--max-p95", "--max-errors"):
+            skip = "=" not in arg
+        elif name != "--json":
+            passthrough.append(arg)
+
+    runs = []
+    for workers in scaling_steps(max(1, args.scaling)):
+        command = [sys.executable, os.path.abspath(__file__), *passthrough, "--workers", str(workers), "--json"]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        # Воркеры пишут в stdout свои строки — отчёт JSON идёт последним
+        start = 0 if output.startswith("{") else output.rindex("\n{") + 1
+        report = json.loads(output[start:])
+        runs.append({
+            "workers": workers,
+            "throughput_turns_per_s": report["throughput_turns_per_s"],
+            "turn_p95_s": report["turn_p95_s"],
+            "errors": report["exceptions"] + report["error_replies"],
+        })
+
+    base = runs[0]["throughput_turns_per_s"] or 1
+    for item in runs:
+        item["speedup"] = round(item["throughput_turns_per_s"] / base, 2)
+        item["efficiency"] = round(item["speedup"] / item["workers"], 2)
+    return {"cpu_count": os.cpu_count(), "runs": runs}
+
+
+def print_scaling(result: dict) -> None:
+    print(f"🧮 Масштабирование (ядер: {result['cpu_count']})")
+    print("воркеров  ходов/с  ускорение  эффективность  p95, с  ошибок")
+    for item in result["runs"]:
+        print(f"{item['workers']:>8}  {item['throughput_turns_per_s']:>7}  {item['speedup']:>9}  "
+              f"{item['efficiency']:>13}  {item['turn_p95_s']:>6}  {item['errors']:>6}")
+    if result["runs"][-1]["workers"] > (result["cpu_count"] or 1):
+        print("⚠️ Воркеров больше, чем ядер: ускорение упирается в число ядер, а не в бота")
+
+
+def main() -> int:
+    args = parse_args()
+    if args.scaling:
+        result = measure_scaling(args)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False, indent=2))
+        else:
+            print_scaling(result)
+        return 0
+    if args.seed is not None:
+        random.seed(args.seed)
+    configure_env(args)
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    failed = False
+    if args.max_p95 is not None and report["turn_p95_s"] > args.max_p95:
+        print(f"❌ p95 хода {report['turn_p95_s']} с выше порога {args.max_p95} с", file=sys.stderr)
+        failed = True
+    errors = report["exceptions"] + report["error_replies"]
+    if args.max_errors is not None and errors > args.max_errors:
+        print(f"❌ Ошибок {errors}, порог {args.max_errors}", file=sys.stderr)
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,86 @@
+import sys
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from config import MENU_CACHE_MAX_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Справочные запросы меню (репутация, задания, слухи, энциклопедия) не двигают
+# сюжет: пока в истории не появился новый ход, ответ мастера на них тот же.
+# Ответ кэшируется вместе с версией сюжета (story_version в данных FSM, растёт
+# с каждым сюжетным ходом); повторное нажатие при той же версии отдаётся из
+# памяти без запроса к модели и не попадает в историю.
+
+CACHED_INTENTS = frozenset({"reputation", "quests", "rumors", "encyclopedia"})
+
+
+class MenuCache:
+    """LRU-кэш ответов (StorageKey, intent) → (версия сюжета, ответ) с лимитом памяти."""
+
+    def __init__(self, max_bytes: int = MENU_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "stored": 0, "evicted": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _drop(self, entry_key) -> None:
+        _, _, size = self._entries.pop(entry_key)
+        self.bytes -= size
+
+    def get(self, key, intent: str, version: int) -> Optional[str]:
+        """Ответ для этой версии сюжета или None."""
+        if not self.enabled or intent not in CACHED_INTENTS:
+            return None
+        entry_key = (key, intent)
+        entry = self._entries.get(entry_key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry[0] != version:
+            # Сюжет продвинулся — ответ устарел
+            self._drop(entry_key)
+            self.stats["stale"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._entries.move_to_end(entry_key)
+        self.stats["hits"] += 1
+        return entry[1]
+
+    def put(self, key, intent: str, version: int, response: str) -> None:
+        if not self.enabled or intent not in CACHED_INTENTS:
+            return
+        entry_key = (key, intent)
+        if entry_key in self._entries:
+            self._drop(entry_key)
+        size = sys.getsizeof(response)
+        if size > self.max_bytes:
+            return
+        self._entries[entry_key] = (version, response, size)
+        self.bytes += size
+        self.stats["stored"] += 1
+        while self.bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.stats["evicted"] += 1
+
+    def forget(self, key) -> None:
+        """Сбрасывает ответы сессии (/start, загрузка сохранения)."""
+        for entry_key in [entry_key for entry_key in self._entries if entry_key[0] == key]:
+            self._drop(entry_key)
+
+    def report(self) -> dict:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            **self.stats,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+
+menu_cache = MenuCache()
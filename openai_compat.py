@@ -0,0 +1,152 @@
+import json
+import asyncio
+import aiohttp
+
+from config import OPENAI_BASE_URL, OPENAI_API_KEY, OPENAI_MODEL, YANDEX_MAX_TOKENS
+from http_client import get_http_session, encode_json_body
+from providers import Provider, ProviderError, RETRYABLE_STATUSES, parse_retry_after
+from usage import record_usage
+
+# Резервный провайдер: любой API, совместимый с OpenAI Chat Completions
+# (OpenAI, OpenRouter, vLLM и т.п.). Запросы идут через тот же общий пул aiohttp.
+
+NETWORK_ERROR_TEXT = (
+    "⚠️ <b>Ошибка сети</b>\n\n"
+    "🔴 Не удалось подключиться к резервному серверу генерации.\n\n"
+    "<i>Попробуйте снова через несколько секунд.</i>"
+)
+TIMEOUT_ERROR_TEXT = (
+    "⚠️ <b>Превышено время ожидания</b>\n\n"
+    "🔴 Резервный сервер генерации не ответил вовремя.\n\n"
+    "<i>Попробуйте снова через несколько секунд.</i>"
+)
+SERVICE_ERROR_TEXT = (
+    "⚠️ <b>Сервис временно недоступен</b>\n\n"
+    "🔴 Резервный сервер генерации вернул ошибку.\n\n"
+    "<i>Попробуйте снова через несколько минут.</i>"
+)
+EMPTY_RESPONSE_TEXT = "⚠️ Пустой ответ от сервера генерации."
+
+
+def build_chat_request(history: list, system_prompt: str, stream: bool) -> tuple:
+    """Собирает тело и заголовки запроса к /chat/completions. Возвращает (body, headers)."""
+    messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+    for msg in history:
+        role = msg.get("role", "user")
+        if role in ("user", "assistant", "system"):
+            messages.append({"role": role, "content": msg.get("content", msg.get("text", ""))})
+
+    payload = {
+        "model": OPENAI_MODEL,
+        "messages": messages,
+        "temperature": 0.6,
+        "max_tokens": YANDEX_MAX_TOKENS,
+        "stream": stream,
+    }
+    if stream:
+        # Последний кусок потока придёт с usage
+        payload["stream_options"] = {"include_usage": True}
+    body, headers = encode_json_body(payload)
+    headers["Authorization"] = f"Bearer {OPENAI_API_KEY}"
+    return body, headers
+
+
+class OpenAICompatProvider(Provider):
+    """OpenAI-совместимый Chat Completions API."""
+
+    name = "openai"
+
+    @property
+    def configured(self) -> bool:
+        return bool(OPENAI_API_KEY and OPENAI_MODEL)
+
+    @property
+    def url(self) -> str:
+        return OPENAI_BASE_URL.rstrip("/") + "/chat/completions"
+
+    async def _raise_for_status(self, response) -> None:
+        error_text = await response.text()
+        print(f"⚠️ Ошибка OpenAI-совместимого API: {response.status} {error_text[:500]}")
+        raise ProviderError(
+            f"HTTP {response.status}: {error_text}",
+            SERVICE_ERROR_TEXT,
+            retryable=response.status in RETRYABLE_STATUSES,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+    async def complete(self, history: list, system_prompt: str, timeout: float) -> str:
+        try:
+            body, headers = build_chat_request(history, system_prompt, stream=False)
+            session = get_http_session()
+            async with session.post(
+                self.url,
+                headers=headers,
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                if response.status != 200:
+                    await self._raise_for_status(response)
+                try:
+                    result = await response.json()
+                except (json.JSONDecodeError, aiohttp.ContentTypeError) as e:
+                    raise ProviderError(str(e), SERVICE_ERROR_TEXT)
+                usage = result.get("usage") or {}
+                record_usage(self.name, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+                choices = result.get("choices") or []
+                text = choices[0].get("message", {}).get("content") if choices else None
+                if not text:
+                    raise ProviderError("empty choices", EMPTY_RESPONSE_TEXT)
+                return text
+        except aiohttp.ClientError as e:
+            print(f"⚠️ Ошибка сети при запросе к OpenAI-совместимому API: {e}")
+            raise ProviderError(str(e), NETWORK_ERROR_TEXT)
+        except asyncio.TimeoutError:
+            print("⚠️ Таймаут при запросе к OpenAI-совместимому API")
+            raise ProviderError("timeout", TIMEOUT_ERROR_TEXT)
+
+    async def stream(self, history: list, system_prompt: str, timeout: float):
+        """
+        Потоковый режим: сервер присылает SSE-строки "data: {...}" с приращениями
+        текста; наружу, как и у Yandex, отдаём накопленный текст.
+        """
+        try:
+            body, headers = build_chat_request(history, system_prompt, stream=True)
+            session = get_http_session()
+            async with session.post(
+                self.url,
+                headers=headers,
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout),
+            ) as response:
+                if response.status != 200:
+                    await self._raise_for_status(response)
+
+                text = ""
+                usage = {}
+                async for raw_line in response.content:
+                    line = raw_line.strip()
+                    if not line.startswith(b"data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == b"[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                    except json.JSONDecodeError:
+                        continue
+                    usage = chunk.get("usage") or usage
+                    choices = chunk.get("choices") or []
+                    delta = choices[0].get("delta", {}).get("content") if choices else None
+                    if delta:
+                        text += delta
+                        yield text
+
+                record_usage(self.name, usage.get("prompt_tokens"), usage.get("completion_tokens"))
+                if not text:
+                    raise ProviderError("empty stream", EMPTY_RESPONSE_TEXT)
+        except aiohttp.ClientError as e:
+            print(f"⚠️ Ошибка сети при потоковом запросе к OpenAI-совместимому API: {e}")
+            raise ProviderError(str(e), NETWORK_ERROR_TEXT)
+        except asyncio.TimeoutError:
+            print("⚠️ Таймаут при потоковом запросе к OpenAI-совместимому API")
+            raise ProviderError("timeout", TIMEOUT_ERROR_TEXT)
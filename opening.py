@@ -0,0 +1,263 @@
+import re
+import asyncio
+import logging
+from collections import deque
+
+from config import OPENING_SPECULATION, OPENING_POOL_SIZE, OPENING_WAIT_TIMEOUT, OPENING_PENDING_TTL, YANDEX_MAX_TOKENS
+from generate import ai_generate
+from prompts import compose_system_prompt
+from context_builder import estimate_tokens
+from scheduler import scheduler, INTERACTIVE, BACKGROUND
+
+logger = logging.getLogger(__name__)
+
+# Стартовая сцена генерируется заранее: раса, имя и класс известны уже на шаге
+# выбора класса. Пока игрок выбирает предысторию, сцена успевает сгенерироваться,
+# а выбранная предыстория вплетается в готовую сцену фразой из BACKGROUND_HOOKS
+# перед вариантами действий — без второго запроса к модели.
+# Без предварительной генерации (и если она не удалась) сцена запрашивается
+# обычным путём, сразу с предысторией.
+#
+# Запасной вариант — тёплый пул обезличенных вступлений на пару раса/класс:
+# он выручает, если предварительная генерация не удалась или потерялась
+# (например, бот перезапустили посреди создания персонажа).
+
+
+# Предыстория → фраза, которая связывает с ней сцену, сгенерированную до её выбора
+BACKGROUND_HOOKS = {
+    "Народный герой": "В округе ещё помнят твоё имя: простые люди видят в тебе заступника и ждут, что ты не пройдёшь мимо чужой беды.",
+    "Благородный": "Герб твоего рода знают здесь не все, но осанку и манеры не спрячешь — кто-то уже присматривается к тебе с интересом.",
+    "Отшельник": "Годы уединения научили тебя слушать тишину — и сейчас в ней что-то не так.",
+    "Бродяга": "Дорога давно стала тебе домом, и чутьё бродяги подсказывает: здесь стоит держать ухо востро.",
+    "Артист": "Привычка артиста берёт своё: ты невольно ищешь взглядом публику — и замечаешь тех, кто смотрит на тебя.",
+    "Аферист": "Старые долги и чужие имена остались позади — по крайней мере, так тебе хочется думать.",
+    "Солдат": "Армейская выучка не отпускает: взгляд сам отмечает выходы, укрытия и тех, кто держит руку у оружия.",
+    "Торговец": "Чутьё торговца подсказывает, что здесь можно заработать — если знать, кого спросить.",
+    "Писарь": "Привычка писаря замечать мелочи не подводит: в увиденном есть то, что стоит запомнить.",
+    "Следопыт": "Следы на земле и запахи ветра ты читаешь, как открытую книгу, — и они говорят о многом.",
+    "Ремесленник": "Намётанный глаз ремесленника сразу оценивает всё вокруг: работу, материалы и тех, кто ими владеет.",
+}
+
+# Первый вариант действия в конце сцены: "1.", "**1)**", "1️⃣"
+_FIRST_OPTION_RE = re.compile(r"^[*_ \t]*1(?:[.)]|️⃣)", re.MULTILINE)
+
+
+def build_opening_prompt(data: dict) -> str:
+    """Запрос стартовой сцены для законченного персонажа (с предысторией)."""
+    return (
+        f"Используй КАРКАС_ПЕРВОГО_ОТВЕТА из шаблона. "
+        f"Информация о персонаже уже показана игроку отдельно. "
+        f"Твоя задача - описать стартовую сцену для {data.get('name', '')} "
+        f"({data.get('race', '')}, {data.get('char_class', '')}, {data.get('background', '')}). "
+        f"Начни приключение в классической локации (дорога, таверна, лагерь). "
+        f"Опиши локацию, время суток, атмосферу (2-4 абзаца). "
+        f"Затем предложи ровно 3 варианта действий + возможность написать свой. "
+        f"НЕ дублируй информацию о персонаже - она уже выведена."
+    )
+
+
+def build_speculative_opening_prompt(data: dict) -> str:
+    """
+    Запрос стартовой сцены до выбора предыстории. Предысторию потом
+    добавляет reconcile_opening.
+    """
+    return (
+        f"Используй КАРКАС_ПЕРВОГО_ОТВЕТА из шаблона. "
+        f"Информация о персонаже уже показана игроку отдельно. "
+        f"Твоя задача - описать стартовую сцену для {data.get('name', '')} "
+        f"({data.get('race', '')}, {data.get('char_class', '')}). "
+        f"Начни приключение в классической локации (дорога, таверна, лагерь). "
+        f"Опиши локацию, время суток, атмосферу (2-4 абзаца). "
+        f"Затем предложи ровно 3 варианта действий + возможность написать свой. "
+        f"НЕ дублируй информацию о персонаже - она уже выведена. "
+        f"Не опирайся на предысторию героя в этой сцене."
+    )
+
+
+def build_generic_opening_prompt(race: str, char_class: str) -> str:
+    """Запрос обезличенного вступления для тёплого пула: без имени и предыстории."""
+    return (
+        f"Используй КАРКАС_ПЕРВОГО_ОТВЕТА из шаблона. "
+        f"Опиши стартовую сцену для героя: {race}, {char_class}. "
+        f"Обращайся к герою на «ты» и НЕ называй его по имени. "
+        f"Начни приключение в классической локации (дорога, таверна, лагерь). "
+        f"Опиши локацию, время суток, атмосферу (2-4 абзаца). "
+        f"Затем предложи ровно 3 варианта действий + возможность написать свой. "
+        f"НЕ выводи информацию о персонаже."
+    )
+
+
+def reconcile_opening(response: str, background: str) -> str:
+    """Вплетает предысторию в готовую сцену: фраза-мостик встаёт перед вариантами действий."""
+    hook = BACKGROUND_HOOKS.get(background)
+    if not hook:
+        return response
+    match = _FIRST_OPTION_RE.search(response)
+    if match is None:
+        return f"{response.rstrip()}\n\n{hook}"
+    head = response[:match.start()].rstrip()
+    return f"{head}\n\n{hook}\n\n{response[match.start():]}"
+
+
+def _signature(data: dict) -> tuple:
+    # Сцена зависит только от этих полей; если они поменялись — сцену генерируем заново
+    return data.get("name", ""), data.get("race", ""), data.get("char_class", "")
+
+
+def _is_error(text) -> bool:
+    # ai_generate возвращает текст ошибки вместо исключения
+    return not text or text.startswith("⚠️")
+
+
+class OpeningSpeculator:
+    """Предварительная генерация стартовых сцен и тёплый пул вступлений."""
+
+    def __init__(self, pool_size: int = OPENING_POOL_SIZE):
+        self.pool_size = pool_size
+        # StorageKey -> (сигнатура, asyncio.Task, таймер истечения)
+        self._pending = {}
+        # (раса, класс) -> deque[ответ]
+        self._pool = {}
+        self._refilling = set()
+        self._tasks = set()
+        # ready — сцена готова к концу создания, waited — пришлось дождаться,
+        # pool — выручил пул, miss — генерация с нуля, expired — создание бросили
+        self.stats = {"ready": 0, "waited": 0, "pool": 0, "miss": 0, "expired": 0}
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _generate(self, owner, request: str, system_prompt: str, priority: int) -> str:
+        history = [{"role": "user", "content": request}]
+        return await scheduler.run(
+            owner,
+            lambda: ai_generate(history, system_prompt),
+            priority=priority,
+            tokens=estimate_tokens(system_prompt) + estimate_tokens(request) + YANDEX_MAX_TOKENS,
+        )
+
+    # ---------- Предварительная генерация для игрока ----------
+
+    def start(self, key, data: dict) -> None:
+        """Запускает генерацию стартовой сцены, как только известны имя, раса и класс."""
+        if not OPENING_SPECULATION:
+            return
+        signature = _signature(data)
+        if not all(signature):
+            return
+        pending = self._pending.get(key)
+        if pending is not None and pending[0] == signature:
+            return
+        self.cancel(key)
+
+        request = build_speculative_opening_prompt(data)
+        system_prompt = compose_system_prompt(key, data, "start")
+        task = self._spawn(self._generate(key.chat_id, request, system_prompt, INTERACTIVE))
+        # Игрок может бросить создание персонажа — тогда сцену и запрос забываем по таймеру
+        expiry = asyncio.get_running_loop().call_later(OPENING_PENDING_TTL, self._expire, key, task)
+        self._pending[key] = (signature, task, expiry)
+        self.warm(data.get("race", ""), data.get("char_class", ""))
+
+    def cancel(self, key) -> None:
+        """Отменяет незавершённую генерацию (например, после /start)."""
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            pending[2].cancel()
+            if not pending[1].done():
+                pending[1].cancel()
+
+    def _expire(self, key, task: asyncio.Task) -> None:
+        pending = self._pending.get(key)
+        if pending is not None and pending[1] is task:
+            self.stats["expired"] += 1
+            self.cancel(key)
+
+    async def take(self, key, data: dict):
+        """
+        Отдаёт стартовую сцену для законченного персонажа.
+
+        Готовая сцена и вступление из пула написаны без предыстории — она
+        добавляется через reconcile_opening, а в историю идёт обычный запрос
+        build_opening_prompt, как если бы сцену генерировали сейчас.
+
+        Returns:
+            tuple | None: (запрос, ответ) — готовая или дождавшаяся сцена либо
+            вступление из пула; None — сцену нужно генерировать обычным путём.
+        """
+        pending = self._pending.pop(key, None)
+        if pending is not None:
+            signature, task, expiry = pending
+            expiry.cancel()
+            if signature != _signature(data):
+                task.cancel()
+            else:
+                was_ready = task.done()
+                try:
+                    response = await asyncio.wait_for(asyncio.shield(task), timeout=OPENING_WAIT_TIMEOUT)
+                except asyncio.TimeoutError:
+                    task.cancel()
+                    response = None
+                except asyncio.CancelledError:
+                    # Отменили ожидающего (например, /start) — сцена тоже больше не нужна
+                    task.cancel()
+                    raise
+                except Exception as e:
+                    logger.warning("Предварительная генерация стартовой сцены не удалась: %s", e)
+                    response = None
+                if not _is_error(response):
+                    self.stats["ready" if was_ready else "waited"] += 1
+                    return build_opening_prompt(data), reconcile_opening(response, data.get("background", ""))
+
+        pooled = self._take_pooled(data.get("race", ""), data.get("char_class", ""))
+        if pooled is not None:
+            self.stats["pool"] += 1
+            return build_opening_prompt(data), reconcile_opening(pooled, data.get("background", ""))
+
+        self.stats["miss"] += 1
+        return None
+
+    # ---------- Тёплый пул ----------
+
+    def _take_pooled(self, race: str, char_class: str):
+        pool = self._pool.get((race, char_class))
+        if not pool:
+            return None
+        item = pool.popleft()
+        self.warm(race, char_class)
+        return item
+
+    def warm(self, race: str, char_class: str) -> None:
+        """Дозаполняет пул вступлений для пары раса/класс фоновыми запросами."""
+        if not OPENING_SPECULATION or self.pool_size <= 0:
+            return
+        pair = (race, char_class)
+        if pair in self._refilling or len(self._pool.get(pair, ())) >= self.pool_size:
+            return
+        self._refilling.add(pair)
+        self._spawn(self._refill(pair))
+
+    async def _refill(self, pair: tuple) -> None:
+        race, char_class = pair
+        request = build_generic_opening_prompt(race, char_class)
+        system_prompt = compose_system_prompt(None, {}, "start")
+        pool = self._pool.setdefault(pair, deque())
+        try:
+            while len(pool) < self.pool_size:
+                response = await self._generate(("opening_pool", pair), request, system_prompt, BACKGROUND)
+                if _is_error(response):
+                    logger.warning("Не удалось пополнить пул вступлений %s/%s", race, char_class)
+                    return
+                pool.append(response)
+        except Exception as e:
+            logger.exception("Ошибка пополнения пула вступлений: %s", e)
+        finally:
+            self._refilling.discard(pair)
+
+    def report(self) -> dict:
+        return {**self.stats, "pooled": sum(len(pool) for pool in self._pool.values())}
+
+
+openings = OpeningSpeculator()
@@ -0,0 +1,337 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    SendMessage,
+    SendPhoto,
+    SendDocument,
+    SendChatAction,
+    EditMessageText,
+    EditMessageReplyMarkup,
+    DeleteMessage,
+)
+
+from config import (
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_GROUP_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_MAX_RETRIES,
+)
+from providers import LatencyTracker
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих: настоящие ответы раньше служебных сообщений
+# («думаю...», «подожди», позиция в очереди, кадры потокового ответа)
+ANSWER = 0
+FLUFF = 1
+
+# Приоритет отправки задаёт вызывающий код (см. low_priority), по умолчанию — ответ
+send_priority = ContextVar("send_priority", default=ANSWER)
+
+# Методы, которые идут через очередь: всё, что пишет в чат
+_QUEUED_METHODS = (
+    SendMessage, SendPhoto, SendDocument, SendChatAction,
+    EditMessageText, EditMessageReplyMarkup, DeleteMessage,
+)
+# Повторные правки одного сообщения, ещё не ушедшие в Telegram, склеиваются в последнюю
+_COALESCED_METHODS = (EditMessageText, EditMessageReplyMarkup)
+
+
+@contextmanager
+def low_priority():
+    """Отправки внутри блока — служебные: уступают ответам других чатов."""
+    token = send_priority.set(FLUFF)
+    try:
+        yield
+    finally:
+        send_priority.reset(token)
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше capacity про запас; rate 0 — без лимита."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        if self.rate:
+            self._refill(now)
+            self.tokens -= 1
+
+    def full(self, now: float) -> bool:
+        if not self.rate:
+            return True
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Item:
+    __slots__ = ("make_request", "bot", "method", "priority", "waiters", "enqueued_at", "attempts")
+
+    def __init__(self, make_request, bot, method, priority):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.priority = priority
+        self.waiters = [asyncio.get_running_loop().create_future()]
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+    @property
+    def abandoned(self) -> bool:
+        """Все, кто ждал отправки, отменены — отправлять незачем."""
+        return all(waiter.done() for waiter in self.waiters)
+
+
+class _Chat:
+    __slots__ = ("bucket", "items", "paused_until", "busy")
+
+    def __init__(self, bucket: TokenBucket):
+        self.bucket = bucket
+        self.items = deque()
+        self.paused_until = 0.0
+        self.busy = False
+
+
+class OutboundQueue(BaseRequestMiddleware):
+    """
+    Центральная очередь исходящих запросов к Telegram (middleware сессии бота).
+
+    - Всё, что пишет в чат (отправка, правка, удаление), проходит через очередь;
+      остальные методы (getUpdates, answerCallbackQuery и т.п.) идут напрямую.
+    - Общий лимит бота и лимит на чат — token bucket'ы; внутри чата порядок
+      сохраняется и одновременно выполняется не больше одного запроса.
+    - Между чатами первыми обслуживаются ответы, затем служебные сообщения.
+    - Flood-wait (429 RetryAfter) ставит чат на паузу, запрос повторяется первым.
+    - Неотправленные правки одного сообщения склеиваются в последнюю.
+    """
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 group_rate: float = OUTBOUND_GROUP_RATE, chat_burst: int = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats = {}
+        self._wakeup = None
+        self._task = None
+        self._send_tasks = set()
+        self.wait_latency = LatencyTracker(500)
+        self.send_latency = LatencyTracker(500)
+        self.max_queue_seen = 0
+        self.stats = {"sent": 0, "coalesced": 0, "flood_waits": 0, "failed": 0, "abandoned": 0}
+
+    # ---------- Middleware ----------
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None or not isinstance(method, _QUEUED_METHODS):
+            return await make_request(bot, method)
+        return await self.submit(make_request, bot, method, chat_id)
+
+    # ---------- Очередь ----------
+
+    @property
+    def queued(self) -> int:
+        return sum(len(chat.items) for chat in self._chats.values())
+
+    def _chat(self, chat_id) -> _Chat:
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            # Отрицательные id — группы и каналы, у них лимит строже
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            chat = self._chats[chat_id] = _Chat(TokenBucket(rate, self.chat_burst))
+        return chat
+
+    def _coalesce(self, chat: _Chat, method, priority: int):
+        """Находит в очереди правку того же сообщения, которую можно заменить новой."""
+        if not isinstance(method, _COALESCED_METHODS):
+            return None
+        message_id = getattr(method, "message_id", None)
+        for item in reversed(chat.items):
+            if getattr(item.method, "message_id", None) != message_id:
+                continue
+            # Склеиваем только с последней операцией над этим сообщением и того же вида
+            if type(item.method) is not type(method):
+                return None
+            item.method = method
+            item.priority = min(item.priority, priority)
+            return item
+        return None
+
+    async def submit(self, make_request, bot, method, chat_id):
+        """Ставит запрос в очередь чата и ждёт его выполнения."""
+        self._ensure_running()
+        priority = FLUFF if isinstance(method, SendChatAction) else send_priority.get()
+        chat = self._chat(chat_id)
+
+        item = self._coalesce(chat, method, priority)
+        if item is not None:
+            waiter = asyncio.get_running_loop().create_future()
+            item.waiters.append(waiter)
+            self.stats["coalesced"] += 1
+        else:
+            item = _Item(make_request, bot, method, priority)
+            waiter = item.waiters[0]
+            chat.items.append(item)
+            self.max_queue_seen = max(self.max_queue_seen, self.queued)
+        self._wakeup.set()
+        return await waiter
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def _pick(self, now: float):
+        """
+        Выбирает чат для следующей отправки: (chat_id, None) или (None, сколько ждать).
+        Среди готовых — с самым приоритетным и давним запросом в голове очереди.
+        """
+        best, best_key, wait = None, None, None
+        for chat_id, chat in list(self._chats.items()):
+            while chat.items and chat.items[0].abandoned:
+                chat.items.popleft()
+                self.stats["abandoned"] += 1
+            if not chat.items:
+                # Пустой чат забываем, когда он отдохнул — иначе сохраняем паузу и лимит
+                if not chat.busy and chat.paused_until <= now and chat.bucket.full(now):
+                    del self._chats[chat_id]
+                continue
+            if chat.busy:
+                continue
+            ready_in = max(chat.paused_until - now, chat.bucket.delay(now))
+            if ready_in > 0:
+                wait = ready_in if wait is None else min(wait, ready_in)
+                continue
+            head = chat.items[0]
+            key = (head.priority, head.enqueued_at)
+            if best_key is None or key < best_key:
+                best, best_key = chat_id, key
+        return best, wait
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            chat_id, wait = self._pick(now)
+            if chat_id is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_wait = self.global_bucket.delay(now)
+            if global_wait > 0:
+                # Общий лимит исчерпан; после паузы выбор повторяется — вдруг пришёл ответ важнее
+                await asyncio.sleep(global_wait)
+                continue
+
+            chat = self._chats[chat_id]
+            item = chat.items.popleft()
+            self.global_bucket.take(now)
+            chat.bucket.take(now)
+            chat.busy = True
+            task = asyncio.create_task(self._send(chat_id, chat, item))
+            self._send_tasks.add(task)
+            task.add_done_callback(self._send_tasks.discard)
+
+    async def _send(self, chat_id, chat: _Chat, item: _Item) -> None:
+        started = time.monotonic()
+        if item.attempts == 0:
+            self.wait_latency.add(started - item.enqueued_at)
+        try:
+            result = await item.make_request(item.bot, item.method)
+        except TelegramRetryAfter as e:
+            item.attempts += 1
+            self.stats["flood_waits"] += 1
+            chat.paused_until = time.monotonic() + e.retry_after
+            logger.warning("Flood-wait %s с для чата %s (попытка %s)", e.retry_after, chat_id, item.attempts)
+            if item.attempts > self.max_retries:
+                self.stats["failed"] += 1
+                self._resolve(item, exception=e)
+            else:
+                chat.items.appendleft(item)
+        except Exception as e:
+            self.stats["failed"] += 1
+            self._resolve(item, exception=e)
+        else:
+            self.stats["sent"] += 1
+            self.send_latency.add(time.monotonic() - started)
+            self._resolve(item, result=result)
+        finally:
+            chat.busy = False
+            self._wakeup.set()
+
+    @staticmethod
+    def _resolve(item: _Item, result=None, exception=None) -> None:
+        for waiter in item.waiters:
+            if waiter.done():
+                continue
+            if exception is not None:
+                waiter.set_exception(exception)
+            else:
+                waiter.set_result(result)
+
+    # ---------- Остановка и метрики ----------
+
+    async def close(self, timeout: float = 10) -> None:
+        """Дожидается отправки уже поставленного в очередь и останавливает цикл."""
+        if self._task is None:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while (self.queued or self._send_tasks) and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        if self.queued:
+            logger.warning("Не отправлено при остановке: %s", self.queued)
+        self._task.cancel()
+        await asyncio.gather(self._task, *self._send_tasks, return_exceptions=True)
+        self._task = None
+
+    def report(self) -> dict:
+        def ms(tracker: LatencyTracker, q: float):
+            value = tracker.percentile(q)
+            return None if value is None else round(value * 1000)
+
+        return {
+            **self.stats,
+            "queued": self.queued,
+            "max_queued": self.max_queue_seen,
+            "chats": len(self._chats),
+            "wait_p50_ms": ms(self.wait_latency, 0.5),
+            "wait_p95_ms": ms(self.wait_latency, 0.95),
+            "send_p50_ms": ms(self.send_latency, 0.5),
+            "send_p95_ms": ms(self.send_latency, 0.95),
+        }
+
+
+outbox = OutboundQueue()
@@ -0,0 +1,256 @@
+import re
+import asyncio
+import logging
+from datetime import date
+
+from config import (
+    CHOICE_PREFETCH,
+    CHOICE_PREFETCH_USER_TOKENS,
+    CHOICE_PREFETCH_GLOBAL_TOKENS,
+    YANDEX_MAX_TOKENS,
+    LOCAL_DICE,
+)
+from generate import ai_generate
+from prompts import compose_system_prompt, classify_intent
+from context_builder import assemble_context
+from summary import split_history
+from history import Turn
+from scheduler import scheduler, BACKGROUND
+from usage import ledger
+
+logger = logging.getLogger(__name__)
+
+# Предварительная генерация продолжений для вариантов 1/2/3.
+# Нажатие «1»/«2»/«3» превращается в фиксированный ход «Выбираю вариант N.»,
+# поэтому следующий запрос известен заранее. Пока игрок читает сцену, продолжения
+# генерируются в фоне; на нажатие отдаётся готовое, остальные отменяются.
+#
+# Режимы CHOICE_PREFETCH: off — выключено, one — только самый вероятный вариант
+# (по прошлым выборам игрока), all — все три.
+
+CHOICES = ("1", "2", "3")
+
+# Сцена действительно заканчивается тремя вариантами: "1.", "2)", "3️⃣"
+_OPTION_RE = re.compile(r"(?:^|\s|\*)([1-3])(?:[.)]|️⃣)")
+
+
+def choice_content(choice: str) -> str:
+    """Ход игрока для варианта — тот же текст, что отправляет continue_dialog."""
+    return f"Выбираю вариант {choice}."
+
+
+def has_options(reply: str) -> bool:
+    return set(_OPTION_RE.findall(reply or "")) >= set(CHOICES)
+
+
+def _swallow_result(task: asyncio.Task) -> None:
+    # Невостребованная генерация могла упасть по таймауту — не засоряем лог предупреждениями asyncio
+    if not task.cancelled():
+        task.exception()
+
+
+class _Speculation:
+    __slots__ = ("choice", "task", "started", "reserved")
+
+    def __init__(self, choice: str, reserved: int):
+        self.choice = choice
+        self.task = None
+        self.started = False
+        self.reserved = reserved
+
+
+class ChoicePrefetcher:
+    """Фоновые продолжения для вариантов 1/2/3 с лимитом расхода и метриками попаданий."""
+
+    def __init__(self, mode: str = CHOICE_PREFETCH,
+                 user_tokens: int = CHOICE_PREFETCH_USER_TOKENS,
+                 global_tokens: int = CHOICE_PREFETCH_GLOBAL_TOKENS):
+        self.mode = mode if mode in ("one", "all") else "off"
+        self.user_tokens = user_tokens
+        self.global_tokens = global_tokens
+        # StorageKey -> (ход, {вариант: _Speculation})
+        self._sessions = {}
+        # StorageKey -> {вариант: сколько раз выбран} — для режима one
+        self._preferences = {}
+        # Расход оценочных токенов за текущие сутки
+        self._day = date.today()
+        self._spent_by_user = {}
+        self._spent_total = 0
+        self.stats = {
+            "started": 0,      # запущено фоновых генераций
+            "hits": 0,         # нажатие пришлось на готовое продолжение
+            "hits_waited": 0,  # продолжение ещё генерировалось, дождались
+            "misses": 0,       # нажат вариант, для которого ничего не было
+            "wasted": 0,       # отменённые или невостребованные генерации
+            "capped": 0,       # не запущено из-за лимита расхода
+            "combat": 0,       # не запущено: ход боя ждёт свежих бросков (см. dice.py)
+            "tokens_spent": 0,
+            "tokens_wasted": 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    # ---------- Лимит расхода ----------
+
+    def _roll_day(self) -> None:
+        today = date.today()
+        if today != self._day:
+            self._day = today
+            self._spent_by_user.clear()
+            self._spent_total = 0
+
+    def _reserve(self, owner, tokens: int) -> bool:
+        self._roll_day()
+        # Фоновые продолжения не должны съедать дневную квоту игрока
+        remaining = ledger.remaining(owner)
+        if remaining is not None and remaining < tokens:
+            return False
+        if self.global_tokens and self._spent_total + tokens > self.global_tokens:
+            return False
+        spent = self._spent_by_user.get(owner, 0)
+        if self.user_tokens and spent + tokens > self.user_tokens:
+            return False
+        self._spent_by_user[owner] = spent + tokens
+        self._spent_total += tokens
+        self.stats["tokens_spent"] += tokens
+        return True
+
+    def _refund(self, owner, tokens: int) -> None:
+        # Генерацию отменили до отправки запроса — токены не потрачены
+        self._spent_by_user[owner] = max(0, self._spent_by_user.get(owner, 0) - tokens)
+        self._spent_total = max(0, self._spent_total - tokens)
+        self.stats["tokens_spent"] -= tokens
+
+    # ---------- Запуск ----------
+
+    def _choices_to_prefetch(self, key) -> tuple:
+        if self.mode == "all":
+            return CHOICES
+        preferences = self._preferences.get(key, {})
+        # Без истории выборов чаще всего жмут первый вариант
+        return (max(CHOICES, key=lambda c: (preferences.get(c, 0), c == "1")),)
+
+    def start(self, key, history: list, data: dict) -> None:
+        """Запускает фоновые продолжения после того, как игрок получил сцену."""
+        if not self.enabled:
+            return
+        self.cancel(key)
+        last_reply = history[-1].get("content", "") if history and history[-1].get("role") == "assistant" else ""
+        if not has_options(last_reply):
+            return
+
+        turn = data.get("turn", 0)
+        speculations = {}
+        for choice in self._choices_to_prefetch(key):
+            content = choice_content(choice)
+            intent = classify_intent(content, last_reply)
+            if intent == "combat" and LOCAL_DICE:
+                # Запрос хода боя несёт блок [БРОСКИ] — без него мастер бросал бы кости сам
+                self.stats["combat"] += 1
+                continue
+            system_prompt = compose_system_prompt(key, data, intent)
+            # Та же обрезка истории и сборка контекста, что и у настоящего хода
+            _, kept = split_history(history + [Turn("user", content)], 10)
+            request_history, report = assemble_context(kept, system_prompt, data.get("summary", ""))
+            tokens = report.total_tokens + YANDEX_MAX_TOKENS
+            if not self._reserve(key.chat_id, tokens):
+                self.stats["capped"] += 1
+                continue
+            speculation = _Speculation(choice, tokens)
+            speculation.task = asyncio.create_task(self._run(key.chat_id, speculation, request_history, system_prompt))
+            speculation.task.add_done_callback(_swallow_result)
+            speculations[choice] = speculation
+            self.stats["started"] += 1
+        if speculations:
+            self._sessions[key] = (turn, speculations)
+
+    async def _run(self, owner, speculation: _Speculation, request_history: list, system_prompt: str) -> str:
+        def factory():
+            speculation.started = True
+            return asyncio.wait_for(ai_generate(request_history, system_prompt), timeout=60)
+
+        return await scheduler.run(owner, factory, priority=BACKGROUND, tokens=speculation.reserved)
+
+    # ---------- Выдача ----------
+
+    def _discard(self, owner, speculation: _Speculation) -> None:
+        self.stats["wasted"] += 1
+        if speculation.task.done() or speculation.started:
+            self.stats["tokens_wasted"] += speculation.reserved
+        else:
+            self._refund(owner, speculation.reserved)
+        speculation.task.cancel()
+
+    def cancel(self, key) -> None:
+        """Отменяет все фоновые продолжения сессии (другой ход, /start)."""
+        session = self._sessions.pop(key, None)
+        if session is None:
+            return
+        for speculation in session[1].values():
+            self._discard(key.chat_id, speculation)
+
+    def claim(self, key, user_content: str, turn: int):
+        """
+        Забирает продолжение под ход игрока; все остальные отменяются.
+        Возвращает _Speculation или None, если ход не совпал с предсказанным.
+        """
+        session = self._sessions.pop(key, None)
+        choice = next((c for c in CHOICES if choice_content(c) == user_content), None)
+        if choice is not None:
+            preferences = self._preferences.setdefault(key, {})
+            preferences[choice] = preferences.get(choice, 0) + 1
+        if session is None:
+            if choice is not None and self.enabled:
+                self.stats["misses"] += 1
+            return None
+
+        session_turn, speculations = session
+        claimed = speculations.pop(choice, None) if session_turn == turn else None
+        for speculation in speculations.values():
+            self._discard(key.chat_id, speculation)
+        if claimed is None:
+            if choice is not None:
+                self.stats["misses"] += 1
+            return None
+        if not claimed.started and not claimed.task.done():
+            # Ещё стоит в фоновой очереди — обычный запрос игрока пройдёт быстрее
+            self._discard(key.chat_id, claimed)
+            self.stats["misses"] += 1
+            return None
+        return claimed
+
+    async def resolve(self, speculation: _Speculation):
+        """Дожидается продолжения. None — генерация не удалась, нужен обычный запрос."""
+        was_ready = speculation.task.done()
+        # asyncio.wait не пробрасывает отмену самой задачи продолжения: отменённое
+        # продолжение — такой же промах, а отмена хода игрока по-прежнему поднимается
+        await asyncio.wait({speculation.task})
+        if speculation.task.cancelled():
+            logger.warning("Фоновое продолжение отменено")
+            response = None
+        else:
+            try:
+                response = speculation.task.result()
+            except Exception as e:
+                logger.warning("Фоновое продолжение не удалось: %s", e)
+                response = None
+        if not response or response.startswith("⚠️"):
+            self.stats["misses"] += 1
+            self.stats["tokens_wasted"] += speculation.reserved
+            return None
+        self.stats["hits" if was_ready else "hits_waited"] += 1
+        return response
+
+    def report(self) -> dict:
+        served = self.stats["hits"] + self.stats["hits_waited"]
+        clicks = served + self.stats["misses"]
+        return {
+            "mode": self.mode,
+            **self.stats,
+            "hit_rate": round(served / clicks, 3) if clicks else 0.0,
+        }
+
+
+prefetcher = ChoicePrefetcher()
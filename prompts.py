@@ -0,0 +1,280 @@
+import os
+import re
+from collections import OrderedDict
+
+from context_builder import estimate_tokens
+
+# Базовая директория проекта (где лежит prompts.py и prompt.txt)
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PROMPT_PATH = os.path.join(BASE_DIR, "prompt.txt")
+
+# Сколько блоков [CHARACTER] сессий держим в памяти одновременно (около 1 КБ каждый;
+# сами промпты не кэшируются — общая часть на намерение одна на процесс)
+PROMPT_CACHE_SIZE = 10000
+
+# Блок [CHARACTER], дописанный в конец файла старыми версиями бота.
+# Пример формата внутри промпта идёт с отступом, поэтому его не трогаем.
+_CHARACTER_TAIL_RE = re.compile(r"^\[CHARACTER\]$.*?^\[/CHARACTER\]$", re.M | re.S)
+
+
+def load_base_prompt(path: str = PROMPT_PATH) -> str:
+    """Читает prompt.txt один раз и отрезает от него устаревший блок [CHARACTER]."""
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            text = file.read()
+    except FileNotFoundError:
+        print(f"❌ Ошибка: файл prompt.txt не найден по пути: {path}")
+        return ""
+    except Exception as e:
+        print(f"❌ Ошибка при чтении prompt.txt ({path}): {e}")
+        return ""
+    return _CHARACTER_TAIL_RE.sub("", text).strip()
+
+
+# Загружаем базовый промпт при старте
+BASE_PROMPT = load_base_prompt()
+
+
+# ---------- Секции промпта ----------
+
+# Заголовок секции: "   ## TRIGGER #1: COMBAT", "   ## ABSOLUTE LAWS (ALWAYS ACTIVE)"
+_SECTION_RE = re.compile(r"^[ \t]*## (.+?)[ \t]*$", re.M)
+
+# Секции, которые уходят в каждый запрос
+CORE_SECTIONS = (
+    "IDENTITY",
+    "ABSOLUTE LAWS",
+    "TRIGGER PRIORITY",
+    "CRITICAL ERRORS",
+    "REFERENCE: CHARACTER DATA PROTOCOL",
+)
+
+# Дополнительные секции по намерению игрока. None — нужен весь промпт целиком
+# (обычный ход сюжета может обернуться чем угодно: боем, торговлей, смертью).
+INTENT_SECTIONS = {
+    "start": ("FIRST MESSAGE PROTOCOL", "GAME START", "TRIGGER #0"),
+    "status": ("TRIGGER #7", "REFERENCE: XP THRESHOLDS"),
+    "inventory": ("TRIGGER #7", "REFERENCE: INVENTORY SLOTS", "REFERENCE: ECONOMY"),
+    "spells": ("TRIGGER #7", "REFERENCE: SPELLS"),
+    "reputation": ("TRIGGER #7", "REFERENCE: WORLD LAWS"),
+    "quests": ("TRIGGER #7", "REFERENCE: XP THRESHOLDS"),
+    "encyclopedia": ("TRIGGER #7",),
+    "save": ("TRIGGER #7", "REFERENCE: INVENTORY SLOTS"),
+    "rumors": ("TRIGGER #7", "TRIGGER #10", "REFERENCE: WORLD LAWS"),
+    "trade": ("TRIGGER #3", "TRIGGER #13", "REFERENCE: ECONOMY", "REFERENCE: INVENTORY SLOTS"),
+    "short_rest": ("TRIGGER #2", "TRIGGER #1", "TRIGGER #15"),
+    "long_rest": ("TRIGGER #0", "TRIGGER #2", "TRIGGER #1", "TRIGGER #10", "TRIGGER #15"),
+    "combat": (
+        "TRIGGER #1", "TRIGGER #6", "TRIGGER #8", "TRIGGER #9", "TRIGGER #15",
+        "REFERENCE: SPELLS", "REFERENCE: WORLD LAWS", "REFERENCE: XP THRESHOLDS",
+    ),
+    "story": None,
+}
+
+# Какой intent соответствует callback_data меню
+CALLBACK_INTENTS = {
+    "menu_status": "status",
+    "menu_inventory": "inventory",
+    "menu_spells": "spells",
+    "menu_reputation": "reputation",
+    "menu_quests": "quests",
+    "menu_encyclopedia": "encyclopedia",
+    "menu_rumors": "rumors",
+    "menu_trade": "trade",
+    "menu_short_rest": "short_rest",
+    "menu_long_rest": "long_rest",
+}
+
+# Лёгкий классификатор текста игрока: команда целиком или ключевые корни слов
+_COMMAND_INTENTS = {
+    "статус": "status",
+    "инвентарь": "inventory",
+    "заклинания": "spells",
+    "репутация": "reputation",
+    "задания": "quests",
+    "энциклопедия": "encyclopedia",
+    "сохранение": "save",
+    "слухи": "rumors",
+    "торговля": "trade",
+    "короткий отдых": "short_rest",
+    "долгий отдых": "long_rest",
+}
+_TRADE_RE = re.compile(r"\b(куп|прода|торг|обменя|лавк|магазин|торговц)", re.I)
+_COMBAT_RE = re.compile(r"\b(атак|напада|бью|удар|стреля|руб|колю|бросаюсь|сража|убива|колдую|кастую)", re.I)
+# Признаки идущего боя в последнем ответе мастера
+_COMBAT_ACTIVE_RE = re.compile(r"⚔️ COMBAT|Инициатива|Initiative|Твой ход")
+
+
+def classify_intent(text: str, last_reply: str = "") -> str:
+    """Определяет намерение по тексту игрока и последнему ответу мастера."""
+    normalized = (text or "").strip().lower().rstrip(".!")
+    if normalized in _COMMAND_INTENTS:
+        return _COMMAND_INTENTS[normalized]
+    if _COMBAT_ACTIVE_RE.search(last_reply or "") or _COMBAT_RE.search(normalized):
+        return "combat"
+    if _TRADE_RE.search(normalized):
+        return "trade"
+    return "story"
+
+
+def _section_id(heading: str) -> str:
+    # "TRIGGER #1: COMBAT" -> "TRIGGER #1"; "ABSOLUTE LAWS (ALWAYS ACTIVE)" -> "ABSOLUTE LAWS"
+    if heading.startswith("TRIGGER #"):
+        return heading.split(":", 1)[0]
+    return re.sub(r"\s*\(.*\)$", "", heading)
+
+
+def parse_sections(text: str) -> tuple:
+    """
+    Делит промпт на (преамбула, OrderedDict секций) по заголовкам "## ".
+    Порядок секций сохраняется как в prompt.txt.
+    """
+    matches = list(_SECTION_RE.finditer(text))
+    if not matches:
+        return text, OrderedDict()
+    preamble = text[:matches[0].start()].rstrip()
+    sections = OrderedDict()
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        sections[_section_id(match.group(1))] = text[match.start():end].rstrip()
+    return preamble, sections
+
+
+class SectionedPrompt:
+    """Промпт, разобранный на секции один раз при старте; собирает текст под намерение."""
+
+    def __init__(self, text: str):
+        self.full_text = text
+        self.preamble, self.sections = parse_sections(text)
+        self._by_intent = {}
+        self.full_tokens = estimate_tokens(text)
+        # intent -> [запросов, сэкономлено токенов]
+        self.stats = {}
+
+    def for_intent(self, intent: str) -> str:
+        cached = self._by_intent.get(intent)
+        if cached is not None:
+            return cached
+        extra = INTENT_SECTIONS.get(intent)
+        if extra is None or not self.sections:
+            text = self.full_text
+        else:
+            wanted = set(CORE_SECTIONS) | set(extra)
+            parts = [self.preamble] + [body for name, body in self.sections.items() if name in wanted]
+            text = "\n\n".join(part for part in parts if part)
+        self._by_intent[intent] = text
+        return text
+
+    def record(self, intent: str) -> None:
+        saved = self.full_tokens - estimate_tokens(self.for_intent(intent))
+        entry = self.stats.setdefault(intent, [0, 0])
+        entry[0] += 1
+        entry[1] += saved
+
+    def report(self) -> list:
+        """Строки отчёта: сколько входных токенов сэкономлено по каждому намерению."""
+        lines = []
+        for intent, (requests, saved) in sorted(self.stats.items(), key=lambda item: -item[1][1]):
+            per_request = saved // requests if requests else 0
+            lines.append(f"{intent}: {requests} запр., сэкономлено ~{saved} токенов (~{per_request} на запрос)")
+        return lines
+
+
+sectioned_prompt = SectionedPrompt(BASE_PROMPT)
+
+
+def build_character_block(data: dict) -> str:
+    """Собирает блок [CHARACTER] из FSM-данных конкретного игрока."""
+    stats = data.get("stats", {})
+    stats_str = "\n".join(f"{k}: {v}" for k, v in stats.items())
+    return (
+        "[CHARACTER]\n"
+        f"Имя: {data.get('name','')}\n"
+        f"Раса: {data.get('race','')}\n"
+        f"Класс: {data.get('char_class','')}\n"
+        f"Предыстория: {data.get('background','')}\n"
+        f"Характеристики:\n{stats_str}\n"
+        f"Бонусы_расы: {data.get('apply_bonuses','да')}\n"
+        f"День_старта: {data.get('day_counter', 1)}\n"
+        f"Снаряжение: {data.get('equipment','Базовая экипировка')}\n"
+        f"Кошель: {data.get('wallet','Золотая монета, серебряная монета')}\n"
+        f"Заклинания: {data.get('spells','Нет начальных заклинаний')}\n"
+        f"Монеты: {data.get('coins', 0)}\n"
+        f"Сумка: {data.get('bag','Пустая сумка')}\n"
+        "[/CHARACTER]\n"
+    )
+
+
+# Поля FSM, из которых собирается блок [CHARACTER]
+_CHARACTER_FIELDS = (
+    "name", "race", "char_class", "background", "stats", "apply_bonuses",
+    "day_counter", "equipment", "wallet", "spells", "coins", "bag",
+)
+
+
+def character_fingerprint(data: dict) -> tuple:
+    """Отпечаток данных персонажа — поля блока [CHARACTER], без сборки самого блока."""
+    return tuple(
+        tuple(value.items()) if isinstance(value, dict) else value
+        for value in (data.get(field) for field in _CHARACTER_FIELDS)
+    )
+
+
+class SystemPromptCache:
+    """
+    Кэш блоков [CHARACTER] по сессиям.
+
+    Ключ — StorageKey из FSMContext, значение — (отпечаток персонажа, блок).
+    Блок пересобирается только если персонаж изменился; промпт — общая часть
+    для намерения плюс блок — склеивается на каждый запрос.
+    """
+
+    def __init__(self, prompt: SectionedPrompt, max_size: int = PROMPT_CACHE_SIZE):
+        self.prompt = prompt
+        self.max_size = max_size
+        self._items = OrderedDict()
+
+    def get(self, key, data: dict, intent: str = "story") -> str:
+        base = self.prompt.for_intent(intent)
+        # Без персонажа (например, до завершения создания) отдаём чистый базовый промпт
+        if not data.get("name"):
+            return base
+
+        fingerprint = character_fingerprint(data)
+        cached = self._items.get(key)
+        if cached is None or cached[0] != fingerprint:
+            cached = (fingerprint, build_character_block(data))
+            self._items[key] = cached
+        self._items.move_to_end(key)
+
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+        # CHARACTER блок идёт в КОНЕЦ промпта
+        return base + "\n\n" + cached[1]
+
+    def forget(self, key) -> None:
+        self._items.pop(key, None)
+
+
+prompt_cache = SystemPromptCache(sectioned_prompt)
+
+
+def compose_system_prompt(key, data: dict, intent: str = "story") -> str:
+    """
+    Возвращает системный промпт сессии: секции BASE_PROMPT, нужные для intent,
+    + её собственный [CHARACTER].
+    """
+    if intent not in INTENT_SECTIONS:
+        intent = "story"
+    sectioned_prompt.record(intent)
+    return prompt_cache.get(key, data, intent)
+
+
+def intent_report() -> list:
+    """Отчёт об экономии входных токенов по намерениям."""
+    return sectioned_prompt.report()
+
+
+def forget_session(key) -> None:
+    """Сбрасывает закэшированный промпт сессии (например, после /start)."""
+    prompt_cache.forget(key)
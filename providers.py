@@ -0,0 +1,149 @@
+import time
+import logging
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Optional
+
+from config import LLM_BREAKER_FAILURES, LLM_BREAKER_COOLDOWN
+
+logger = logging.getLogger(__name__)
+
+# Общий интерфейс LLM-провайдеров (Yandex GPT, OpenAI-совместимые API).
+# Провайдер не возвращает текст ошибки пользователю, а бросает ProviderError:
+# повторы, переключение на другой провайдер и выбор текста для игрока
+# решает маршрутизатор в generate.py.
+
+# Коды, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class ProviderError(Exception):
+    """
+    Ошибка запроса к провайдеру.
+
+    Attributes:
+        user_text: Понятный игроку текст ошибки (начинается с "⚠️")
+        retryable: Имеет ли смысл повторить запрос к тому же провайдеру
+        retry_after: Сколько секунд просил подождать сервер (заголовок Retry-After)
+    """
+
+    def __init__(self, message: str, user_text: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.user_text = user_text
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Заголовок Retry-After в секундах (HTTP-дата не поддерживается — берём backoff)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Предохранитель провайдера: после LLM_BREAKER_FAILURES ошибок подряд провайдер
+    выключается на LLM_BREAKER_COOLDOWN секунд, затем пропускается один пробный
+    запрос — успех закрывает предохранитель, ошибка снова размыкает.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN):
+        self.failure_threshold = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.trips += 1
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """Пробный запрос отменён, не дойдя до результата — пропускаем следующий."""
+        self._probe_in_flight = False
+
+
+class LatencyTracker:
+    """Задержки последних успешных запросов — для порога хеджирования (p95)."""
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+
+class Provider(ABC):
+    """Базовый провайдер: complete() и stream() бросают ProviderError."""
+
+    name = "provider"
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.latency = LatencyTracker()
+        self.stats = {"requests": 0, "errors": 0, "retries": 0}
+
+    @property
+    def configured(self) -> bool:
+        """Хватает ли настроек (ключ, модель), чтобы обращаться к провайдеру."""
+        return True
+
+    @abstractmethod
+    async def complete(self, history: list, system_prompt: str, timeout: float) -> str:
+        """Полный текст ответа."""
+
+    @abstractmethod
+    async def stream(self, history: list, system_prompt: str, timeout: float):
+        """Асинхронный генератор накопленного текста ответа."""
+        yield ""
+
+    def report(self) -> dict:
+        p50 = self.latency.percentile(0.5)
+        p95 = self.latency.percentile(0.95)
+        return {
+            **self.stats,
+            "breaker": self.breaker.state,
+            "breaker_trips": self.breaker.trips,
+            "p50": round(p50, 2) if p50 is not None else None,
+            "p95": round(p95, 2) if p95 is not None else None,
+        }
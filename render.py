@@ -0,0 +1,173 @@
+import re
+from bisect import bisect_right
+
+# Ответ мастера (Markdown) → HTML для Telegram и нарезка на сообщения до 4096 символов
+
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_TEXT_LIMIT = 4096
+
+# Теги, которые понимает Telegram: их из ответа оставляем как есть, остальное экранируем
+_ALLOWED_TAGS = (
+    "b|strong|i|em|u|ins|s|strike|del|code|pre|a|tg-spoiler|blockquote|span"
+)
+_TAG = r"</?(?:" + _ALLOWED_TAGS + r")(?:\s[^<>\n]*)?>"
+_BOLD = r"\*\*(?P<bold>.+?)\*\*"
+_ITALIC = r"(?<!\*)\*(?!\*)(?P<italic>.+?)(?<!\*)\*(?!\*)"
+_ESCAPE = r"(?P<esc>[&<>])"
+# Обычный текст без спецсимволов забираем одним куском, чтобы движок regex
+# не перебирал все альтернативы на каждой позиции
+_TEXT = r"(?P<text>[^<>&*\n]+)"
+
+# Один проход по тексту: маркеры списка, обычный текст, теги, **жирный**, *курсив*,
+# спецсимволы HTML. Жирный и курсив не переходят через перевод строки — как и в прежней версии.
+_MARKDOWN_RE = re.compile(
+    r"(?P<bullet>^[ \t]*-[ \t]+)|" + _TEXT + r"|(?P<tag>" + _TAG + r")|" + _BOLD + "|" + _ITALIC + "|" + _ESCAPE,
+    re.M,
+)
+# То же без маркеров списка — для содержимого внутри **...**
+_INLINE_RE = re.compile(_TEXT + r"|(?P<tag>" + _TAG + r")|" + _BOLD + "|" + _ITALIC + "|" + _ESCAPE)
+
+_ESCAPES = {"&": "&amp;", "<": "&lt;", ">": "&gt;"}
+
+
+def _replace(match: re.Match) -> str:
+    kind = match.lastgroup
+    if kind == "text":
+        return match.group("text")
+    if kind == "esc":
+        return _ESCAPES[match.group("esc")]
+    if kind == "tag":
+        return match.group("tag")
+    if kind == "bullet":
+        return "• "
+    if kind == "bold":
+        return "<b>" + _INLINE_RE.sub(_replace, match.group("bold")) + "</b>"
+    return "<i>" + _INLINE_RE.sub(_replace, match.group("italic")) + "</i>"
+
+
+def markdown_to_html(text: str) -> str:
+    """
+    Конвертирует Markdown форматирование в HTML для Telegram.
+    Обрабатывает: **жирный**, *курсив*, списки с -, спецсимволы HTML.
+    Поддерживаемые Telegram теги из ответа сохраняются.
+    """
+    if not text:
+        return text
+    return _MARKDOWN_RE.sub(_replace, text)
+
+
+# ---------- Нарезка на сообщения ----------
+
+_ANY_TAG_RE = re.compile(r"<[^<>]*>")
+_TAG_NAME_RE = re.compile(r"<(/?)([a-zA-Z][\w-]*)")
+
+
+def _apply_tag(stack: tuple, tag: str) -> tuple:
+    """Стек открытых тегов ((имя, открывающий тег), ...) после тега."""
+    match = _TAG_NAME_RE.match(tag)
+    if not match:
+        return stack
+    closing, name = match.group(1), match.group(2).lower()
+    if not closing:
+        return stack + ((name, tag),)
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i][0] == name:
+            return stack[:i] + stack[i + 1:]
+    return stack
+
+
+def _closing(stack: tuple) -> str:
+    return "".join(f"</{name}>" for name, _ in reversed(stack))
+
+
+def _opening(stack: tuple) -> str:
+    return "".join(tag for _, tag in stack)
+
+
+class _Splitter:
+    """Позиции тегов в HTML и поиск безопасного места разреза."""
+
+    def __init__(self, html: str):
+        self.html = html
+        self.tags = [(m.start(), m.end(), m.group(0)) for m in _ANY_TAG_RE.finditer(html)]
+        self.starts = [start for start, _, _ in self.tags]
+
+    def _tag_around(self, pos: int):
+        """Тег, внутри которого стоит позиция pos, или None."""
+        i = bisect_right(self.starts, pos) - 1
+        if i >= 0 and self.tags[i][0] < pos < self.tags[i][1]:
+            return self.tags[i]
+        return None
+
+    def find_cut(self, start: int, end: int) -> int:
+        """
+        Где резать кусок html[start:end]: сначала граница абзаца, затем строки,
+        затем любой пробел — но не в первой трети куска и не внутри тега.
+        Если пробела нет — режем по end, не разрывая тег и HTML-сущность.
+        """
+        html = self.html
+        if end >= len(html):
+            return len(html)
+        floor = start + (end - start) // 3
+        for sep in ("\n\n", "\n", " "):
+            i = html.rfind(sep, floor, end)
+            while i > start and self._tag_around(i):
+                i = html.rfind(sep, floor, i)
+            if i > start:
+                return i
+        tag = self._tag_around(end)
+        if tag and tag[0] > start:
+            return tag[0]
+        amp = html.rfind("&", max(start, end - 10), end)
+        if amp > start and ";" not in html[amp:end]:
+            return amp
+        return end
+
+    def stack_at(self, stack: tuple, index: int, pos: int) -> tuple:
+        """Применяет теги начиная с self.tags[index], стоящие до pos. Возвращает (стек, индекс)."""
+        while index < len(self.tags) and self.tags[index][0] < pos:
+            stack = _apply_tag(stack, self.tags[index][2])
+            index += 1
+        return stack, index
+
+
+def split_html(html: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    """
+    Делит HTML на сообщения не длиннее limit, предпочитая границы абзацев.
+    Незакрытые на границе теги закрываются в конце куска и открываются заново
+    в начале следующего, так что каждый кусок — валидный HTML для Telegram.
+    """
+    if len(html) <= limit:
+        return [html]
+
+    splitter = _Splitter(html)
+    chunks = []
+    stack, index = (), 0
+    pos = 0
+    while pos < len(html):
+        # Пробелы на границе кусков не переносим
+        while pos < len(html) and html[pos].isspace():
+            pos += 1
+        if pos >= len(html):
+            break
+        prefix = _opening(stack)
+        room = max(1, limit - len(prefix))
+        while True:
+            cut = splitter.find_cut(pos, pos + room)
+            cut_stack, cut_index = splitter.stack_at(stack, index, cut)
+            suffix = _closing(cut_stack)
+            if cut - pos + len(suffix) <= limit - len(prefix) or room <= len(suffix) + 1:
+                break
+            # Не влезли закрывающие теги — ищем разрез левее
+            room = limit - len(prefix) - len(suffix)
+        body = html[pos:cut].rstrip()
+        if body:
+            chunks.append(prefix + body + suffix)
+        stack, index = cut_stack, cut_index
+        pos = cut
+    return chunks
+
+
+def render_reply(text: str, limit: int = TELEGRAM_TEXT_LIMIT) -> list:
+    """Ответ мастера → список HTML-сообщений для отправки по порядку."""
+    return split_html(markdown_to_html(text), limit) if text else [text]
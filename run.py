@@ -1,14 +1,84 @@
 import asyncio
 from aiogram import Bot, Dispatcher
-from config import TG_TOKEN
+from config import TG_TOKEN, BOT_MODE, BOT_WORKERS, BOT_WORKER_INDEX, TELEGRAM_API_URL
 from handlers import router
+from admin import router as admin_router
+from http_client import init_http_client, close_http_client, http_stats
+from storage import create_storage
+from prompts import intent_report
+from scheduler import scheduler
+from opening import openings
+from prefetch import prefetcher
+from generations import generations
+from menu_cache import menu_cache
+from history import history_stats
+from webhook import WebhookServer
+from generate import provider_stats
+from usage import ledger
+from outbound import outbox
+from saves import saves
+from supervisor import run_supervisor, serve_worker
+
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        bot = Bot(token=TG_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    else:
+        bot = Bot(token=TG_TOKEN)
+    # Все отправки и правки сообщений идут через очередь с лимитами Telegram
+    bot.session.middleware(outbox)
+    return bot
+
+
 async def main():
-    bot = Bot(token=TG_TOKEN)
-    await bot.delete_webhook(drop_pending_updates=True)
-    dp = Dispatcher()
+    is_worker = BOT_WORKER_INDEX >= 0
+    if BOT_WORKERS > 1 and not is_worker:
+        # Супервизор сам обновления не обрабатывает — раздаёт их воркерам (supervisor.py)
+        allowed_updates = sorted(set(admin_router.resolve_used_update_types()) | set(router.resolve_used_update_types()))
+        await run_supervisor(create_bot(), allowed_updates)
+        return
+
+    bot = create_bot()
+    # Состояние игроков хранится в SQLite и переживает перезапуск бота
+    dp = Dispatcher(storage=create_storage())
+    dp.include_router(admin_router)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    # Общий пул соединений к LLM живёт всё время работы бота
+    await init_http_client()
+    # Учёт токенов подгружает расход за последние дни — квоты переживают перезапуск
+    await ledger.open()
+    await saves.open()
+    try:
+        if is_worker:
+            # Обновления своего шарда приходят от супервизора через stdin
+            await serve_worker(dp, bot)
+        elif BOT_MODE == "webhook":
+            await WebhookServer(dp, bot).run()
+        else:
+            # Вебхук, оставшийся от режима webhook, мешает getUpdates
+            await bot.delete_webhook(drop_pending_updates=True)
+            await dp.start_polling(bot)
+    finally:
+        print(f"ℹ️ HTTP-пул: {http_stats()}")
+        print(f"ℹ️ Очередь LLM: {scheduler.stats()}")
+        print(f"ℹ️ Провайдеры LLM: {provider_stats()}")
+        print(f"ℹ️ Исходящие Telegram: {outbox.report()}")
+        print(f"ℹ️ Стартовые сцены: {openings.report()}")
+        print(f"ℹ️ Продолжения 1/2/3: {prefetcher.report()}")
+        print(f"ℹ️ Генерации ходов: {generations.report()}")
+        print(f"ℹ️ Кэш справок меню: {menu_cache.report()}")
+        print(f"ℹ️ Сворачивание истории: {history_stats.report()}")
+        for line in intent_report():
+            print(f"ℹ️ Промпт по намерениям — {line}")
+        await outbox.close()
+        await close_http_client()
+        await ledger.close()
+        await saves.close()
+        await dp.storage.close()
+        await bot.session.close()
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
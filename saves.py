@@ -0,0 +1,238 @@
+import json
+import time
+import zlib
+import struct
+import sqlite3
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from config import STORAGE_BACKEND, SAVES_PATH, SAVE_SLOTS, SAVE_HISTORY_MESSAGES, SUMMARY_MAX_PENDING
+from history import encode_turn, restore_turns
+
+logger = logging.getLogger(__name__)
+
+# Сохранения кампаний: снимок данных FSM (персонаж, game_state, летопись,
+# последние реплики) в компактном бинарном виде:
+#   заголовок b"DND" + версия (1 байт) + длина JSON (4 байта) + zlib(канонический JSON)
+# Снимки адресуются по sha256 содержимого, поэтому одинаковые сохранения
+# (в том числе в разных слотах) хранятся один раз, а повторное сохранение
+# неизменившейся кампании ничего не пишет.
+
+# 1 — реплики истории словарями {role, content}; 2 — парами ["a", текст] (history.Turn)
+SNAPSHOT_VERSION = 2
+_MAGIC = b"DND"
+_HEADER = struct.Struct(">3sBI")
+
+# Поля FSM, которые попадают в снимок; всё остальное (служебные флаги) не сохраняется
+SNAPSHOT_FIELDS = (
+    "name", "race", "char_class", "background",
+    "stats", "stats_report", "apply_bonuses",
+    "coins", "equipment", "wallet", "spells", "bag", "day_counter",
+    "game_state", "turn", "sheet_turn",
+    "summary", "summary_pending", "history",
+)
+
+
+class SnapshotError(Exception):
+    """Снимок повреждён или записан более новой версией бота."""
+
+
+def pack_snapshot(data: dict) -> tuple:
+    """
+    Данные FSM → (sha256, канонический JSON в байтах).
+    История обрезается до последних SAVE_HISTORY_MESSAGES реплик. Окно истории
+    (fold_history) длиннее, и срезанные реплики в летопись ещё не попали —
+    поэтому они переносятся в очередь летописи (summary_pending) и после
+    загрузки будут свёрнуты вместе с остальными.
+    """
+    snapshot = {field: data[field] for field in SNAPSHOT_FIELDS if field in data}
+    history = snapshot.get("history")
+    if history and len(history) > SAVE_HISTORY_MESSAGES:
+        trimmed = history[:-SAVE_HISTORY_MESSAGES]
+        snapshot["history"] = history[-SAVE_HISTORY_MESSAGES:]
+        snapshot["summary_pending"] = (list(snapshot.get("summary_pending") or []) + trimmed)[-SUMMARY_MAX_PENDING:]
+    raw = json.dumps(
+        snapshot, ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=encode_turn,
+    ).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest(), raw
+
+
+def encode_snapshot(raw: bytes) -> bytes:
+    return _HEADER.pack(_MAGIC, SNAPSHOT_VERSION, len(raw)) + zlib.compress(raw, 9)
+
+
+def _upgrade(snapshot: dict, version: int) -> dict:
+    """Приводит снимок старой версии к текущей: to_turn понимает и словари версии 1."""
+    return restore_turns(snapshot)
+
+
+def decode_snapshot(blob: bytes) -> dict:
+    """Бинарный снимок → данные FSM. Бросает SnapshotError."""
+    try:
+        magic, version, size = _HEADER.unpack_from(blob)
+    except struct.error as e:
+        raise SnapshotError(f"короткий снимок: {e}")
+    if magic != _MAGIC:
+        raise SnapshotError("не снимок сохранения")
+    if version > SNAPSHOT_VERSION:
+        raise SnapshotError(f"снимок версии {version}, бот понимает до {SNAPSHOT_VERSION}")
+    try:
+        raw = zlib.decompress(blob[_HEADER.size:])
+    except zlib.error as e:
+        raise SnapshotError(f"не удалось распаковать снимок: {e}")
+    if len(raw) != size:
+        raise SnapshotError("длина снимка не совпадает с заголовком")
+    return _upgrade(json.loads(raw), version)
+
+
+def describe(data: dict) -> str:
+    """Подпись слота: кто, где и на каком ходу."""
+    parts = [data.get("name") or "Безымянный"]
+    hero = " ".join(str(data[field]) for field in ("race", "char_class") if data.get(field))
+    if hero:
+        parts.append(hero)
+    parts.append(f"ход {data.get('turn', 0)}")
+    location = (data.get("game_state") or {}).get("location")
+    if location:
+        parts.append(f"📍 {location}")
+    return ", ".join(parts)
+
+
+class SaveSlot:
+    __slots__ = ("slot", "title", "saved_at", "size")
+
+    def __init__(self, slot: int, title: str, saved_at: float, size: int):
+        self.slot = slot
+        self.title = title
+        self.saved_at = saved_at
+        self.size = size
+
+
+class SaveStore:
+    """
+    Слоты сохранений игроков в базе SQLite (SAVES_PATH, по умолчанию та же, что FSM).
+
+    snapshots(hash → сжатый снимок) и save_slots((user_id, slot) → hash).
+    Снимок, на который не ссылается ни один слот, удаляется при перезаписи слота.
+    """
+
+    def __init__(self, path: str, slots: int = SAVE_SLOTS):
+        self.path = path
+        self.slots = slots
+        self._conn = None
+        self._executor = None
+        self.stats = {"saved": 0, "unchanged": 0, "deduplicated": 0, "loaded": 0}
+
+    # ---------- SQLite (только в фоновом потоке) ----------
+
+    def _init_db(self) -> None:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS snapshots ("
+            " hash TEXT PRIMARY KEY,"
+            " version INTEGER NOT NULL,"
+            " data BLOB NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS save_slots ("
+            " user_id INTEGER NOT NULL,"
+            " slot INTEGER NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " title TEXT NOT NULL,"
+            " saved_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, slot))"
+        )
+        self._conn.commit()
+
+    def _save(self, user_id: int, slot: int, digest: str, raw: bytes, title: str) -> str:
+        with self._conn:
+            row = self._conn.execute(
+                "SELECT hash FROM save_slots WHERE user_id = ? AND slot = ?", (user_id, slot)
+            ).fetchone()
+            if row is not None and row[0] == digest:
+                return "unchanged"
+            exists = self._conn.execute("SELECT 1 FROM snapshots WHERE hash = ?", (digest,)).fetchone()
+            if exists is None:
+                self._conn.execute(
+                    "INSERT INTO snapshots (hash, version, data) VALUES (?, ?, ?)",
+                    (digest, SNAPSHOT_VERSION, encode_snapshot(raw)),
+                )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO save_slots (user_id, slot, hash, title, saved_at) VALUES (?, ?, ?, ?, ?)",
+                (user_id, slot, digest, title, time.time()),
+            )
+            if row is not None:
+                self._conn.execute(
+                    "DELETE FROM snapshots WHERE hash = ?"
+                    " AND NOT EXISTS (SELECT 1 FROM save_slots WHERE hash = ?)",
+                    (row[0], row[0]),
+                )
+        return "deduplicated" if exists is not None else "saved"
+
+    def _load(self, user_id: int, slot: int) -> Optional[bytes]:
+        row = self._conn.execute(
+            "SELECT s.data FROM save_slots AS ss JOIN snapshots AS s ON s.hash = ss.hash"
+            " WHERE ss.user_id = ? AND ss.slot = ?",
+            (user_id, slot),
+        ).fetchone()
+        return row[0] if row else None
+
+    def _list(self, user_id: int) -> list:
+        return self._conn.execute(
+            "SELECT ss.slot, ss.title, ss.saved_at, length(s.data)"
+            " FROM save_slots AS ss JOIN snapshots AS s ON s.hash = ss.hash"
+            " WHERE ss.user_id = ? ORDER BY ss.slot",
+            (user_id,),
+        ).fetchall()
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # ---------- Публичный интерфейс ----------
+
+    async def open(self) -> None:
+        if self.path == ":memory:" and STORAGE_BACKEND != "memory":
+            # Состояние переживёт перезапуск воркера, а его сохранения — нет
+            raise RuntimeError(f"STORAGE_BACKEND={STORAGE_BACKEND} требует SAVES_PATH (файл сохранений на постоянном диске)")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="saves-sqlite")
+        await self._run(self._init_db)
+
+    async def close(self) -> None:
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def valid_slot(self, slot: int) -> bool:
+        return 1 <= slot <= self.slots
+
+    async def save(self, user_id: int, slot: int, data: dict) -> str:
+        """
+        Сохраняет кампанию в слот. Возвращает "saved", "deduplicated"
+        (такой снимок уже хранится) или "unchanged" (в слоте то же самое).
+        """
+        digest, raw = pack_snapshot(data)
+        result = await self._run(self._save, user_id, slot, digest, raw, describe(data))
+        self.stats[result] += 1
+        return result
+
+    async def load(self, user_id: int, slot: int) -> Optional[dict]:
+        """Данные FSM из слота или None, если слот пуст. Бросает SnapshotError."""
+        blob = await self._run(self._load, user_id, slot)
+        if blob is None:
+            return None
+        self.stats["loaded"] += 1
+        return decode_snapshot(blob)
+
+    async def list_slots(self, user_id: int) -> list:
+        return [SaveSlot(*row) for row in await self._run(self._list, user_id)]
+
+
+# Без SAVES_PATH (STORAGE_BACKEND=memory) сохранения живут до перезапуска, как и само состояние
+saves = SaveStore(SAVES_PATH or ":memory:")
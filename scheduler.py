@@ -0,0 +1,227 @@
+import math
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from config import LLM_MAX_IN_FLIGHT, LLM_TOKENS_PER_MINUTE
+from usage import current_request
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты: ходы игроков всегда обслуживаются раньше фоновых задач (летопись и т.п.)
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class _Ticket:
+    __slots__ = ("owner", "priority", "tokens", "future", "on_position", "enqueued_at", "reported")
+
+    def __init__(self, owner, priority, tokens, on_position):
+        self.owner = owner
+        self.priority = priority
+        self.tokens = tokens
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_position = on_position
+        self.enqueued_at = time.monotonic()
+        self.reported = None
+
+
+class LLMScheduler:
+    """
+    Глобальный планировщик запросов к LLM.
+
+    - Не больше max_in_flight запросов одновременно.
+    - Не больше tokens_per_minute оценочных токенов за скользящую минуту (0 — без лимита).
+    - Очередь справедливая: владельцы (чаты) обслуживаются по кругу, так что один
+      активный чат не может вытеснить остальных. Интерактивные запросы идут раньше фоновых.
+    - Ожидающим сообщается позиция в очереди и примерное время ожидания.
+    """
+
+    def __init__(self, max_in_flight: int = LLM_MAX_IN_FLIGHT, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE):
+        self.max_in_flight = max_in_flight
+        self.tokens_per_minute = tokens_per_minute
+        self.in_flight = 0
+        # priority -> OrderedDict(owner -> deque[_Ticket]); порядок владельцев = порядок обхода
+        self._queues = {INTERACTIVE: OrderedDict(), BACKGROUND: OrderedDict()}
+        self._window = deque()
+        self._window_tokens = 0
+        self._wakeup = None
+        # Скользящее среднее длительности запроса — для оценки ожидания
+        self.avg_duration = 10.0
+        self.completed = 0
+        self.max_queue_seen = 0
+        self._notify_tasks = set()
+
+    # ---------- Очередь ----------
+
+    def _waiting(self) -> list:
+        """Ожидающие в порядке обслуживания (по приоритету, внутри — по кругу владельцев)."""
+        order = []
+        for priority in (INTERACTIVE, BACKGROUND):
+            queues = [list(q) for q in self._queues[priority].values()]
+            depth = max((len(q) for q in queues), default=0)
+            for i in range(depth):
+                order.extend(q[i] for q in queues if i < len(q))
+        return order
+
+    @property
+    def queued(self) -> int:
+        return sum(len(q) for queues in self._queues.values() for q in queues.values())
+
+    def _enqueue(self, ticket: _Ticket) -> None:
+        queues = self._queues[ticket.priority]
+        queues.setdefault(ticket.owner, deque()).append(ticket)
+        self.max_queue_seen = max(self.max_queue_seen, self.queued)
+
+    def _remove(self, ticket: _Ticket) -> None:
+        queues = self._queues[ticket.priority]
+        queue = queues.get(ticket.owner)
+        if queue is None:
+            return
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            return
+        if not queue:
+            del queues[ticket.owner]
+
+    def _pop_next(self):
+        for priority in (INTERACTIVE, BACKGROUND):
+            queues = self._queues[priority]
+            if not queues:
+                continue
+            owner, queue = next(iter(queues.items()))
+            ticket = queue[0]
+            return ticket, owner, queues
+        return None, None, None
+
+    # ---------- Лимит токенов ----------
+
+    def _trim_window(self, now: float) -> None:
+        while self._window and now - self._window[0][0] >= 60:
+            _, tokens = self._window.popleft()
+            self._window_tokens -= tokens
+
+    def _tokens_allowed(self, tokens: int, now: float) -> bool:
+        if not self.tokens_per_minute:
+            return True
+        self._trim_window(now)
+        # Запрос крупнее всего лимита пропускаем, когда окно пустое — иначе он не пройдёт никогда
+        return not self._window or self._window_tokens + tokens <= self.tokens_per_minute
+
+    def _schedule_wakeup(self, now: float) -> None:
+        if self._wakeup is not None or not self._window:
+            return
+        delay = max(0.05, 60 - (now - self._window[0][0]))
+        self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self) -> None:
+        self._wakeup = None
+        self._pump()
+
+    # ---------- Выдача слотов ----------
+
+    def _pump(self) -> None:
+        now = time.monotonic()
+        while self.in_flight < self.max_in_flight:
+            ticket, owner, queues = self._pop_next()
+            if ticket is None:
+                break
+            if not self._tokens_allowed(ticket.tokens, now):
+                self._schedule_wakeup(now)
+                break
+            # Владелец уходит в конец круга
+            queue = queues.pop(owner)
+            queue.popleft()
+            if queue:
+                queues[owner] = queue
+            self.in_flight += 1
+            if self.tokens_per_minute:
+                self._window.append((now, ticket.tokens))
+                self._window_tokens += ticket.tokens
+            ticket.future.set_result(True)
+            if ticket.reported is not None and ticket.on_position is not None:
+                # Запрос стоял в очереди — сообщаем, что генерация началась (позиция 0)
+                self._spawn_notify(ticket, 0, 0.0)
+        self._report_positions()
+
+    def _report_positions(self) -> None:
+        for position, ticket in enumerate(self._waiting(), start=1):
+            if ticket.on_position is None or ticket.reported == position:
+                continue
+            ticket.reported = position
+            self._spawn_notify(ticket, position, self.estimate_wait(position))
+
+    def _spawn_notify(self, ticket: _Ticket, position: int, eta: float) -> None:
+        task = asyncio.create_task(self._notify(ticket, position, eta))
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+
+    async def _notify(self, ticket: _Ticket, position: int, eta: float) -> None:
+        try:
+            await ticket.on_position(position, eta)
+        except Exception as e:
+            logger.debug("Не удалось сообщить позицию в очереди: %s", e)
+
+    def estimate_wait(self, position: int) -> float:
+        """Примерное ожидание (секунды) для позиции в очереди."""
+        return math.ceil(position / max(1, self.max_in_flight)) * self.avg_duration
+
+    def _release(self, started_at: float) -> None:
+        self.in_flight -= 1
+        duration = time.monotonic() - started_at
+        self.completed += 1
+        self.avg_duration += (duration - self.avg_duration) * 0.2
+        self._pump()
+
+    # ---------- Публичный интерфейс ----------
+
+    async def run(self, owner, factory, priority: int = INTERACTIVE, tokens: int = 0, on_position=None):
+        """
+        Выполняет factory() (корутину запроса к LLM), когда планировщик выдаст слот.
+
+        Args:
+            owner: Владелец запроса для справедливой очереди (обычно chat_id)
+            factory: Функция без аргументов, возвращающая корутину
+            priority: INTERACTIVE или BACKGROUND
+            tokens: Оценка токенов запроса для лимита в минуту
+            on_position: async callback(position, eta_seconds), если запрос ждёт в очереди;
+                после выдачи слота вызывается с позицией 0
+        """
+        ticket = _Ticket(owner, priority, tokens, on_position)
+        self._enqueue(ticket)
+        self._pump()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # Слот уже выдан, но запрос отменили — возвращаем его
+                self.in_flight -= 1
+                self._pump()
+            else:
+                self._remove(ticket)
+                self._pump()
+            raise
+
+        started_at = time.monotonic()
+        # Провайдеры записывают расход токенов на владельца запроса (см. usage.py)
+        context_token = current_request.set((owner, priority == INTERACTIVE))
+        try:
+            return await factory()
+        finally:
+            current_request.reset(context_token)
+            self._release(started_at)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "max_queue_seen": self.max_queue_seen,
+            "completed": self.completed,
+            "avg_duration": round(self.avg_duration, 2),
+            "window_tokens": self._window_tokens,
+        }
+
+
+scheduler = LLMScheduler()
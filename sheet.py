@@ -0,0 +1,112 @@
+from html import escape
+
+from config import SHEET_MAX_STALE_TURNS
+
+# Лист персонажа, отрисованный локально из FSM-данных — без запроса к LLM
+
+STATS_EMOJI = {
+    "Сила": "💪",
+    "Ловкость": "🏹",
+    "Телосложение": "🛡️",
+    "Интеллект": "📚",
+    "Мудрость": "🔮",
+    "Харизма": "🎭",
+}
+
+# Поля, без которых лист не отрисовать
+_REQUIRED_FIELDS = ("name", "race", "char_class", "stats")
+
+# Поля game_state, по которым свежесть статуса подтверждается ответом мастера.
+# Строка "📅 DAY | 📍" есть почти в каждом ответе, поэтому день и локация не в счёт.
+STATUS_FIELDS = ("hp", "hp_max", "slots", "xp", "xp_next", "level")
+
+# Снаряжение, сумка и заклинания из ответов мастера не разбираются: локально
+# эти разделы верны только до первого хода после создания персонажа
+_CREATION_ONLY = ("inventory", "spells")
+
+
+def stat_modifier(value: int) -> int:
+    """Модификатор характеристики по правилам 5e."""
+    return (int(value) - 10) // 2
+
+
+def is_sheet_available(data: dict, intent: str = "status") -> bool:
+    """
+    Можно ли ответить на раздел листа локально.
+    Нет — если персонаж не создан или данные раздела устарели: инвентарь и
+    заклинания — после первого хода, статус — если с последнего ответа мастера
+    с его цифрами (sheet_turn) прошло больше SHEET_MAX_STALE_TURNS ходов.
+    """
+    if not all(data.get(field) for field in _REQUIRED_FIELDS):
+        return False
+    if intent in _CREATION_ONLY:
+        return data.get("turn", 0) == 0
+    turns_since_sync = data.get("turn", 0) - data.get("sheet_turn", 0)
+    return turns_since_sync <= SHEET_MAX_STALE_TURNS
+
+
+def render_status(data: dict) -> str:
+    lines = [
+        f"📊 <b>{escape(data.get('name', ''))}</b>",
+        f"👤 {escape(data.get('race', ''))}-{escape(data.get('char_class', ''))} "
+        f"({escape(data.get('background', ''))})",
+        "",
+    ]
+    for stat_name, value in data.get("stats", {}).items():
+        emoji = STATS_EMOJI.get(stat_name, "•")
+        lines.append(f"{emoji} {stat_name}: {value} ({stat_modifier(value):+d})")
+    game = data.get("game_state") or {}
+    lines.append("")
+    if game.get("level") is not None:
+        lines.append(f"🎓 Уровень {game['level']}")
+    if game.get("hp") is not None:
+        lines.append(f"❤️ {game['hp']}/{game.get('hp_max') or '?'}")
+    if game.get("slots"):
+        lines.append(f"🔮 {escape(game['slots'])}")
+    if game.get("xp") is not None:
+        lines.append(f"📈 XP: {game['xp']}/{game.get('xp_next') or '?'}")
+    location = f" | 📍 {escape(game['location'])}" if game.get("location") else ""
+    lines.append(f"📅 День {game.get('day') or data.get('day_counter', 1)}{location}")
+    return "\n".join(lines)
+
+
+def render_inventory(data: dict) -> str:
+    game = data.get("game_state") or {}
+    gold = game.get("gold")
+    capacity = ""
+    if game.get("inventory_used") is not None:
+        capacity = f" ({game['inventory_used']}/{game.get('inventory_max') or 36})"
+    lines = [
+        f"🎒 <b>Инвентарь</b>{capacity}",
+        "",
+        f"💰 🟡{gold if gold is not None else data.get('coins', 0)}",
+        f"⚔️ <b>Снаряжение:</b> {escape(str(data.get('equipment', 'Базовая экипировка')))}",
+        f"📦 <b>Кошель:</b> {escape(str(data.get('wallet', 'Пусто')))}",
+        f"👜 <b>Сумка:</b> {escape(str(data.get('bag', 'Пустая сумка')))}",
+    ]
+    return "\n".join(lines)
+
+
+def render_spells(data: dict) -> str:
+    spells = str(data.get("spells", "") or "Нет начальных заклинаний")
+    lines = ["🧿 <b>Заклинания</b>", ""]
+    for spell in spells.split(" | "):
+        spell = spell.strip()
+        if spell:
+            lines.append(f"• {escape(spell)}")
+    return "\n".join(lines)
+
+
+SHEET_RENDERERS = {
+    "status": render_status,
+    "inventory": render_inventory,
+    "spells": render_spells,
+}
+
+
+def render_sheet(intent: str, data: dict):
+    """Возвращает HTML листа для intent или None, если локальный ответ невозможен."""
+    renderer = SHEET_RENDERERS.get(intent)
+    if renderer is None or not is_sheet_available(data, intent):
+        return None
+    return renderer(data)
@@ -0,0 +1,260 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import STORAGE_BACKEND, STORAGE_PATH, STORAGE_FLUSH_INTERVAL, STORAGE_CACHE_SIZE, REDIS_URL
+from history import Turn, to_turn, encode_data, decode_data
+
+logger = logging.getLogger(__name__)
+
+# Версия схемы таблиц SQLite (хранится в таблице meta)
+SCHEMA_VERSION = 1
+
+
+class _Record:
+    """Запись FSM в памяти: состояние + данные."""
+    __slots__ = ("state", "data")
+
+    def __init__(self, state: Optional[str] = None, data: Optional[Dict[str, Any]] = None):
+        self.state = state
+        self.data = data if data is not None else {}
+
+
+def storage_key_to_str(key: StorageKey) -> str:
+    """Сериализует StorageKey в строковый первичный ключ таблицы."""
+    return ":".join(
+        str(part) if part is not None else ""
+        for part in (
+            key.bot_id,
+            key.chat_id,
+            key.user_id,
+            key.thread_id,
+            getattr(key, "business_connection_id", None),
+            key.destiny,
+        )
+    )
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM на локальном SQLite (WAL) с отложенной пакетной записью.
+
+    - Состояние пользователя подгружается из базы лениво, при первом обращении.
+    - set_state/set_data/update_data меняют только запись в памяти и помечают её
+      «грязной»; раз в flush_interval секунд все грязные записи пишутся одной
+      транзакцией. Поэтому серия update_data внутри одного хендлера даёт одну запись.
+    - Чистые записи сверх cache_size вытесняются из памяти (LRU) — при подгрузке
+      новой записи и после каждого сброса.
+    - Записи в старом формате MemoryStorage (history словарями, stats, coins "1d6+1")
+      приводятся к текущему при чтении (normalize_legacy_data).
+    - Все обращения к sqlite3 идут через один фоновый поток, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, path: str, flush_interval: float = 0.5, cache_size: int = 5000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._flush_task = None
+        self._closed = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm-sqlite")
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._init_schema()
+
+    # ---------- SQLite (вызывается только из фонового потока или при инициализации) ----------
+
+    def _init_schema(self) -> None:
+        conn = self._conn
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " key TEXT PRIMARY KEY,"
+            " state TEXT,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        conn.execute(
+            "INSERT OR IGNORE INTO meta (name, value) VALUES ('schema_version', ?)",
+            (str(SCHEMA_VERSION),),
+        )
+        conn.commit()
+
+    def _select(self, key_str: str):
+        return self._conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key_str,)).fetchone()
+
+    def _write_rows(self, rows: list) -> None:
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO fsm (key, state, data, updated_at) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    # ---------- Кэш в памяти ----------
+
+    async def _get_record(self, key: StorageKey) -> _Record:
+        key_str = storage_key_to_str(key)
+        record = self._cache.get(key_str)
+        if record is not None:
+            self._cache.move_to_end(key_str)
+            return record
+
+        row = await self._run(self._select, key_str)
+        # Пока шёл запрос, запись мог создать другой хендлер — не затираем её
+        record = self._cache.get(key_str)
+        if record is None:
+            if row is None:
+                record = _Record()
+            else:
+                record = _Record(row[0], normalize_legacy_data(decode_data(row[1])))
+            self._cache[key_str] = record
+            # Между сбросами кэш тоже не должен расти сверх cache_size
+            self._evict()
+        return record
+
+    def _mark_dirty(self, key: StorageKey) -> None:
+        self._dirty.add(storage_key_to_str(key))
+        if self._flush_task is None and not self._closed:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        try:
+            await asyncio.sleep(self.flush_interval)
+        finally:
+            self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            # Ошибка уже залогирована, ключи остались грязными — пробуем ещё раз позже
+            if self._dirty and not self._closed:
+                self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    def _evict(self) -> None:
+        overflow = len(self._cache) - self.cache_size
+        if overflow <= 0:
+            return
+        for key_str in list(self._cache.keys()):
+            if overflow <= 0:
+                break
+            if key_str in self._dirty:
+                continue
+            del self._cache[key_str]
+            overflow -= 1
+
+    async def flush(self) -> None:
+        """Пишет все изменённые записи одной транзакцией."""
+        if not self._dirty:
+            return
+        now = time.time()
+        rows = []
+        for key_str in self._dirty:
+            record = self._cache.get(key_str)
+            if record is not None:
+                rows.append((key_str, record.state, encode_data(record.data), now))
+        self._dirty.clear()
+        try:
+            await self._run(self._write_rows, rows)
+        except Exception:
+            logger.exception("Не удалось записать состояние FSM в %s", self.path)
+            # Возвращаем ключи в очередь, чтобы повторить запись со следующим сбросом
+            self._dirty.update(row[0] for row in rows)
+            raise
+        self._evict()
+
+    # ---------- BaseStorage ----------
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(key)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(key)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        return record.data.copy()
+
+    async def update_data(self, key: StorageKey, data: Dict[str, Any]) -> Dict[str, Any]:
+        record = await self._get_record(key)
+        record.data.update(data)
+        self._mark_dirty(key)
+        return record.data.copy()
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+
+# ---------- Данные в старом формате MemoryStorage ----------
+
+def normalize_legacy_data(data: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Приводит данные в формате MemoryStorage (history, stats, equipment, wallet,
+    spells, coins) к текущему виду. Вызывается при каждой подгрузке записи из базы.
+    """
+    result = dict(data)
+
+    history = result.get("history")
+    if history is not None:
+        result["history"] = [to_turn(msg) for msg in history if isinstance(msg, (dict, Turn))]
+
+    stats = result.get("stats")
+    if isinstance(stats, dict):
+        result["stats"] = {str(k): int(v) for k, v in stats.items()}
+
+    coins = result.get("coins")
+    if coins is not None:
+        try:
+            result["coins"] = int(coins)
+        except (TypeError, ValueError):
+            # Старое значение "1d6+1" — finish_creation перебросит монеты сам
+            result.pop("coins")
+
+    for field in ("equipment", "wallet", "spells"):
+        if field in result and not isinstance(result[field], str):
+            result[field] = str(result[field])
+
+    return result
+
+
+def create_storage() -> BaseStorage:
+    """Создаёт хранилище FSM согласно STORAGE_BACKEND (sqlite | memory | redis)."""
+    if STORAGE_BACKEND == "memory":
+        return MemoryStorage()
+    if STORAGE_BACKEND == "redis":
+        # Необязательная зависимость: pip install redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        # История в Redis — в том же компактном JSON, что и в SQLite
+        return RedisStorage.from_url(REDIS_URL, json_loads=decode_data, json_dumps=encode_data)
+    directory = os.path.dirname(os.path.abspath(STORAGE_PATH))
+    os.makedirs(directory, exist_ok=True)
+    return SQLiteStorage(STORAGE_PATH, flush_interval=STORAGE_FLUSH_INTERVAL, cache_size=STORAGE_CACHE_SIZE)
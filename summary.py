@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
+from aiogram.fsm.context import FSMContext
+
+from config import SUMMARY_BATCH_MESSAGES, SUMMARY_MAX_CHARS, SUMMARY_MAX_PENDING
+from generate import ai_generate
+from scheduler import scheduler, BACKGROUND
+from context_builder import estimate_tokens
+from history import compact_history, history_stats
+
+logger = logging.getLogger(__name__)
+
+# Отдельный короткий системный промпт: суммаризатору не нужен весь prompt.txt
+SUMMARY_SYSTEM_PROMPT = (
+    "Ты летописец кампании D&D. Тебе дают текущую летопись и новые реплики игрока и мастера. "
+    "Обнови летопись: сохрани имена, места, NPC, обещания, долги, квесты, добычу, ранения и решения игрока; "
+    "отбрось атмосферные описания и механические таблицы. "
+    f"Пиши по-русски, сжато, не длиннее {SUMMARY_MAX_CHARS} символов, без эмодзи и без вариантов действий."
+)
+
+# Фоновые задачи суммаризации (держим ссылки, чтобы их не собрал GC)
+_background_tasks = set()
+# Замки на сессию: очередь вытесненных реплик меняют и хендлер, и фоновая задача.
+# Замок живёт, пока им кто-то пользуется (счётчик в _lock_users), — иначе
+# словарь рос бы с каждым игроком, который так и не нажал /start.
+_locks = {}
+_lock_users = {}
+# Текущая суммаризация сессии. Задача пишет результат, только пока она здесь
+# записана: /start и загрузка сохранения (forget_session) снимают и отменяют её.
+_tasks = {}
+
+
+@asynccontextmanager
+async def _session_lock(key):
+    lock = _locks.get(key)
+    if lock is None:
+        lock = _locks[key] = asyncio.Lock()
+    _lock_users[key] = _lock_users.get(key, 0) + 1
+    try:
+        async with lock:
+            yield
+    finally:
+        _lock_users[key] -= 1
+        if not _lock_users[key]:
+            del _lock_users[key]
+            if _locks.get(key) is lock:
+                del _locks[key]
+
+
+def split_history(history: list, max_pairs: int) -> tuple:
+    """Делит историю на (вытесненные, оставшиеся) — по тем же правилам, что trim_history."""
+    limit = max_pairs * 2 + 1
+    if len(history) <= limit:
+        return [], history
+    return history[:-limit], history[-limit:]
+
+
+async def fold_history(history: list, state: FSMContext, max_pairs: int = 10) -> list:
+    """
+    Обрезает историю до последних max_pairs пар, а вытесненные ходы
+    откладывает в очередь летописи. Когда в очереди набирается
+    SUMMARY_BATCH_MESSAGES реплик, в фоне запускается суммаризация.
+    Ход игрока при этом никогда не ждёт LLM.
+    Заодно в старых ответах мастера сворачивается механика (history.compact_history),
+    а счётчики сворачивания копятся в данных сессии (history_stats).
+    """
+    history, delta = compact_history(history)
+    evicted, kept = split_history(history, max_pairs)
+    if not evicted and not delta[0]:
+        return kept
+
+    async with _session_lock(state.key):
+        data = await state.get_data()
+        if delta[0]:
+            history_stats.add(delta)
+            session = data.get("history_stats") or [0, 0, 0, 0, 0]
+            await state.update_data(history_stats=[a + b for a, b in zip(session, delta)])
+        if not evicted:
+            return kept
+        pending = data.get("summary_pending", []) + evicted
+        # Если суммаризатор долго недоступен, старейшие реплики отбрасываем
+        pending = pending[-SUMMARY_MAX_PENDING:]
+        await state.update_data(summary_pending=pending)
+
+    if len(pending) >= SUMMARY_BATCH_MESSAGES and state.key not in _tasks:
+        task = _tasks[state.key] = asyncio.create_task(_summarize(state))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+    return kept
+
+
+def _drop_summarized(pending: list, batch: list) -> list:
+    """
+    Убирает из очереди уже свёрнутые реплики. Пока шла генерация, SUMMARY_MAX_PENDING
+    мог срезать начало очереди, поэтому ищем самый длинный хвост batch, с которого
+    очередь сейчас начинается.
+    """
+    for overlap in range(min(len(batch), len(pending)), 0, -1):
+        if pending[:overlap] == batch[-overlap:]:
+            return pending[overlap:]
+    return pending
+
+
+def _build_summary_request(summary: str, batch: list) -> list:
+    lines = []
+    for msg in batch:
+        who = "Игрок" if msg.get("role") == "user" else "Мастер"
+        lines.append(f"{who}: {msg.get('content', '')}")
+    return [{
+        "role": "user",
+        "content": (
+            f"Текущая летопись:\n{summary or 'пока пусто'}\n\n"
+            "Новые события:\n" + "\n\n".join(lines) +
+            "\n\nВерни только обновлённую летопись."
+        ),
+    }]
+
+
+async def _summarize(state: FSMContext) -> None:
+    """Фоновая задача: сворачивает накопленные реплики в летопись кампании."""
+    try:
+        data = await state.get_data()
+        batch = data.get("summary_pending", [])
+        if not batch:
+            return
+
+        request = _build_summary_request(data.get("summary", ""), batch)
+        # Фоновый приоритет: планировщик пропускает вперёд все ходы игроков
+        result = await scheduler.run(
+            state.key.chat_id,
+            lambda: ai_generate(request, SUMMARY_SYSTEM_PROMPT),
+            priority=BACKGROUND,
+            tokens=estimate_tokens(request[0]["content"]) + estimate_tokens(SUMMARY_SYSTEM_PROMPT) + SUMMARY_MAX_CHARS // 3,
+        )
+        # ai_generate возвращает текст ошибки вместо исключения — такой ответ не сохраняем
+        if not result or result.startswith("⚠️"):
+            logger.warning("Суммаризация не удалась, реплики остаются в очереди")
+            return
+
+        async with _session_lock(state.key):
+            if _tasks.get(state.key) is not asyncio.current_task():
+                # Пока шла генерация, игрок начал новую кампанию или загрузил сохранение
+                return
+            data = await state.get_data()
+            # За время генерации в очередь могли добавиться новые реплики — их не трогаем
+            rest = _drop_summarized(data.get("summary_pending", []), batch)
+            await state.update_data(summary=result.strip()[:SUMMARY_MAX_CHARS], summary_pending=rest)
+    except Exception as e:
+        logger.exception("Ошибка фоновой суммаризации: %s", e)
+    finally:
+        if _tasks.get(state.key) is asyncio.current_task():
+            del _tasks[state.key]
+
+
+def forget_session(key) -> None:
+    """Отменяет суммаризацию прежней кампании сессии (например, при /start)."""
+    task = _tasks.pop(key, None)
+    if task is not None:
+        task.cancel()
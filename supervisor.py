@@ -0,0 +1,439 @@
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import logging
+from collections import deque
+
+from config import (
+    BOT_MODE,
+    BOT_WORKERS,
+    WORKER_STOP_TIMEOUT,
+    LLM_MAX_IN_FLIGHT,
+    LLM_TOKENS_PER_MINUTE,
+    OUTBOUND_GLOBAL_RATE,
+    CHOICE_PREFETCH_GLOBAL_TOKENS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Многопроцессный режим (BOT_WORKERS > 1): супервизор принимает обновления
+# (polling или вебхук) и раздаёт их воркерам — процессам run.py — по chat_id.
+# Все обновления одного чата попадают в один процесс и в порядке поступления,
+# поэтому кэш FSM каждого воркера владеет своими чатами единолично, а сами
+# данные лежат в общем хранилище (STORAGE_BACKEND: sqlite-файл или redis).
+#
+# Протокол с воркером: обновления — строки JSON в stdin, подтверждения
+# обработки (update_id) — строки в отдельный pipe (BOT_WORKER_ACK_FD).
+# stdout/stderr воркера остаются для логов.
+#
+# Только POSIX (Linux, macOS): pipe передаётся воркеру по номеру дескриптора
+# (pass_fds), остановка и перезапуск — сигналы SIGTERM/SIGHUP. На Windows бот
+# работает одним процессом (BOT_WORKERS=1).
+#
+# Перезапуск одного воркера: kill -TERM <pid воркера> — он доработает принятые
+# обновления и выйдет, супервизор поднимет новый. kill -HUP <pid супервизора> —
+# поочерёдный перезапуск всех воркеров (например, после обновления кода).
+
+RUN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+
+# Сколько обновлений держать для воркера, пока он перезапускается; старшие сверх лимита отбрасываются
+MAX_BUFFERED = 10000
+# Пауза перед перезапуском упавшего воркера растёт от 1 до 30 секунд
+RESTART_DELAY_MIN = 1.0
+RESTART_DELAY_MAX = 30.0
+
+# Разделы обновления, в которых есть чат; для остальных шардируем по отправителю
+_CHAT_KEYS = ("message", "edited_message", "channel_post", "edited_channel_post",
+              "business_message", "edited_business_message")
+
+
+def chat_id_of(update: dict) -> int:
+    """chat_id, по которому обновление шардируется (0 — если чата нет)."""
+    for key in _CHAT_KEYS:
+        if key in update:
+            return update[key]["chat"]["id"]
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        # callback_query: чат сообщения с кнопкой — тот же ключ FSM, что и у сообщений
+        message = value.get("message")
+        if isinstance(message, dict) and "chat" in message:
+            return message["chat"]["id"]
+        if "chat" in value:
+            return value["chat"]["id"]
+        if "from" in value:
+            return value["from"]["id"]
+    return 0
+
+
+def per_worker_limits(workers: int) -> dict:
+    """
+    Лимиты, которые в одиночном процессе общие, делятся между воркерами,
+    чтобы вместе они не превышали настроек (0 — без лимита — так и остаётся).
+    """
+    def share(total, minimum=1):
+        return max(minimum, total // workers) if total else 0
+
+    return {
+        "LLM_MAX_IN_FLIGHT": str(share(LLM_MAX_IN_FLIGHT)),
+        "LLM_TOKENS_PER_MINUTE": str(share(LLM_TOKENS_PER_MINUTE)),
+        "CHOICE_PREFETCH_GLOBAL_TOKENS": str(share(CHOICE_PREFETCH_GLOBAL_TOKENS)),
+        "OUTBOUND_GLOBAL_RATE": str(OUTBOUND_GLOBAL_RATE / workers),
+    }
+
+
+class WorkerProcess:
+    """Один воркер: процесс, буфер ещё не переданных ему обновлений и подтверждения."""
+
+    def __init__(self, index: int, supervisor: "Supervisor"):
+        self.index = index
+        self.supervisor = supervisor
+        self.process = None
+        self.buffer = deque()
+        self.unacked = set()
+        self.processed = 0
+        self.restarts = 0
+        self.crashes = 0
+        self.dropped = 0
+        self.started = asyncio.Event()
+        self._wakeup = asyncio.Event()
+        self._restart_requested = False
+        self._pump_task = None
+        self._ack_task = None
+        self._task = None
+
+    # ---------- Очередь ----------
+
+    def enqueue(self, update_id, line: bytes) -> None:
+        if len(self.buffer) >= MAX_BUFFERED:
+            dropped_id, _ = self.buffer.popleft()
+            self.dropped += 1
+            self.supervisor._lost(dropped_id)
+            logger.warning("Воркер %s: буфер переполнен, обновление %s отброшено", self.index, dropped_id)
+        self.buffer.append((update_id, line))
+        self._wakeup.set()
+
+    async def _pump(self) -> None:
+        """Передаёт накопленные обновления в stdin воркера пачками."""
+        stdin = self.process.stdin
+        while True:
+            while not self.buffer:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            batch = list(self.buffer)
+            self.buffer.clear()
+            self.unacked.update(update_id for update_id, _ in batch)
+            try:
+                stdin.write(b"".join(line for _, line in batch))
+                await stdin.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # Процесс завершается; неподтверждённое учтёт _supervise
+                return
+
+    async def _read_acks(self, reader: asyncio.StreamReader) -> None:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            update_id = int(line)
+            self.unacked.discard(update_id)
+            self.processed += 1
+            self.supervisor._acked(update_id)
+
+    # ---------- Процесс ----------
+
+    async def _spawn(self) -> None:
+        loop = asyncio.get_running_loop()
+        ack_read, ack_write = os.pipe()
+        env = dict(os.environ, **self.supervisor.worker_env)
+        env["BOT_WORKER_INDEX"] = str(self.index)
+        env["BOT_WORKER_ACK_FD"] = str(ack_write)
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, RUN_PATH,
+                stdin=asyncio.subprocess.PIPE,
+                env=env,
+                pass_fds=(ack_write,),
+            )
+        finally:
+            os.close(ack_write)
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(ack_read, "rb", 0))
+        self._ack_task = asyncio.create_task(self._read_acks(reader))
+        self._pump_task = asyncio.create_task(self._pump())
+        logger.info("Воркер %s запущен, pid %s", self.index, self.process.pid)
+        self.started.set()
+
+    async def _supervise(self) -> None:
+        delay = RESTART_DELAY_MIN
+        while True:
+            started_at = time.monotonic()
+            await self._spawn()
+            code = await self.process.wait()
+            self.started.clear()
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+            # Подтверждения, записанные до выхода, дочитываем до конца pipe
+            await self._ack_task
+            for update_id in self.unacked:
+                self.supervisor._lost(update_id)
+            self.unacked.clear()
+
+            if self.supervisor.stopping:
+                return
+            self.restarts += 1
+            if self._restart_requested or code == 0:
+                # Плановый перезапуск (supervisor или kill -TERM воркера) — сразу
+                self._restart_requested = False
+                delay = RESTART_DELAY_MIN
+                continue
+            self.crashes += 1
+            if time.monotonic() - started_at > 60:
+                delay = RESTART_DELAY_MIN
+            logger.error("Воркер %s завершился с кодом %s, перезапуск через %.0f с", self.index, code, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._supervise())
+
+    async def _terminate(self, timeout: float) -> None:
+        """Закрывает stdin: воркер дорабатывает принятые обновления и выходит."""
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Воркер %s не завершился за %s с, принудительная остановка", self.index, timeout)
+            self.process.kill()
+            await self.process.wait()
+
+    async def restart(self, timeout: float = WORKER_STOP_TIMEOUT) -> None:
+        """Плавный перезапуск: обновления этого шарда копятся в буфере, пока поднимается новый процесс."""
+        self._restart_requested = True
+        self.started.clear()
+        await self._terminate(timeout)
+        # Ждём, пока _supervise поднимет замену
+        while not self.started.is_set() and not self._task.done():
+            await asyncio.sleep(0.05)
+
+    async def stop(self, timeout: float = WORKER_STOP_TIMEOUT) -> None:
+        # Буфер отдаём воркеру до закрытия stdin
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.buffer and self.started.is_set() and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        await self._terminate(max(1.0, deadline - loop.time()))
+        if self._task is not None:
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    def report(self) -> dict:
+        return {
+            "pid": self.process.pid if self.process is not None else None,
+            "processed": self.processed,
+            "buffered": len(self.buffer),
+            "in_flight": len(self.unacked),
+            "restarts": self.restarts,
+            "crashes": self.crashes,
+            "dropped": self.dropped,
+        }
+
+
+class Supervisor:
+    """Держит BOT_WORKERS воркеров и раздаёт им обновления по chat_id."""
+
+    def __init__(self, workers: int = BOT_WORKERS, env: dict = None):
+        if os.name != "posix":
+            raise RuntimeError("BOT_WORKERS > 1 требует POSIX-систему (Linux, macOS); на Windows используйте BOT_WORKERS=1")
+        self.worker_env = {**per_worker_limits(workers), "BOT_WORKERS": str(workers), **(env or {})}
+        self.workers = [WorkerProcess(i, self) for i in range(workers)]
+        self.stopping = False
+        self.routed = 0
+        self.lost = 0
+        self._waiters = {}
+        self._restart_task = None
+
+    def worker_for(self, update: dict) -> WorkerProcess:
+        return self.workers[chat_id_of(update) % len(self.workers)]
+
+    def submit(self, update: dict) -> None:
+        """Передаёт обновление воркеру его чата (не ждёт обработки)."""
+        line = json.dumps(update, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        self.routed += 1
+        self.worker_for(update).enqueue(update.get("update_id", 0), line)
+
+    async def process(self, update: dict) -> None:
+        """Передаёт обновление и ждёт, пока воркер его обработает (для нагрузочного прогона)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[update["update_id"]] = future
+        self.submit(update)
+        await future
+
+    def _acked(self, update_id) -> None:
+        future = self._waiters.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    def _lost(self, update_id) -> None:
+        self.lost += 1
+        future = self._waiters.pop(update_id, None)
+        if future is not None and not future.done():
+            future.set_exception(RuntimeError(f"обновление {update_id} потеряно: воркер завершился"))
+
+    async def start(self) -> None:
+        for worker in self.workers:
+            worker.start()
+        await asyncio.gather(*(worker.started.wait() for worker in self.workers))
+
+    async def rolling_restart(self) -> None:
+        """Перезапускает воркеров по одному: остальные шарды всё это время обслуживаются."""
+        for worker in self.workers:
+            if self.stopping:
+                return
+            logger.info("Перезапуск воркера %s", worker.index)
+            await worker.restart()
+
+    def request_rolling_restart(self) -> None:
+        if self._restart_task is None or self._restart_task.done():
+            self._restart_task = asyncio.create_task(self.rolling_restart())
+
+    async def stop(self) -> None:
+        self.stopping = True
+        if self._restart_task is not None:
+            await asyncio.gather(self._restart_task, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+    def report(self) -> dict:
+        return {
+            "workers": len(self.workers),
+            "routed": self.routed,
+            "lost": self.lost,
+            "per_worker": [worker.report() for worker in self.workers],
+        }
+
+
+# ---------- Источники обновлений ----------
+
+async def poll_updates(bot, supervisor: Supervisor, allowed_updates: list, timeout: int = 30) -> None:
+    """getUpdates в супервизоре; сами обновления обрабатывают воркеры."""
+    # Вебхук, оставшийся от режима webhook, мешает getUpdates
+    await bot.delete_webhook(drop_pending_updates=True)
+    offset = None
+    delay = RESTART_DELAY_MIN
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=timeout, allowed_updates=allowed_updates)
+        except Exception as e:
+            logger.warning("Ошибка getUpdates: %s, повтор через %.0f с", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESTART_DELAY_MAX)
+            continue
+        delay = RESTART_DELAY_MIN
+        for update in updates:
+            offset = update.update_id + 1
+            supervisor.submit(update.model_dump(mode="json", exclude_unset=True))
+
+
+def make_webhook_server(bot, supervisor: Supervisor, allowed_updates: list):
+    """Вебхук супервизора: тот же сервер, что в одиночном режиме, но обновления уходят воркерам."""
+    from aiogram import Dispatcher
+    from webhook import WebhookServer
+
+    class ShardingWebhookServer(WebhookServer):
+        async def feed(self, update: dict) -> None:
+            supervisor.submit(update)
+
+        def allowed_updates(self) -> list:
+            return allowed_updates
+
+        def status(self) -> str:
+            status = super().status()
+            # Процесс-воркер упал и ещё не перезапущен — его чаты ждут
+            if status == "ok" and any(w.process is None or w.process.returncode is not None for w in supervisor.workers):
+                return "degraded"
+            return status
+
+        def health(self) -> dict:
+            return {"status": self.status(), "queue": self.queue.qsize(), **self.stats, **supervisor.report()}
+
+    # Диспетчер без роутеров: только для startup/shutdown вебхук-сервера
+    return ShardingWebhookServer(Dispatcher(), bot)
+
+
+async def run_supervisor(bot, allowed_updates: list) -> None:
+    supervisor = Supervisor()
+    await supervisor.start()
+    print(f"ℹ️ Супервизор: {len(supervisor.workers)} воркеров, режим {BOT_MODE}")
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+    loop.add_signal_handler(signal.SIGINT, stop.set)
+    loop.add_signal_handler(signal.SIGHUP, supervisor.request_rolling_restart)
+
+    if BOT_MODE == "webhook":
+        source = asyncio.create_task(make_webhook_server(bot, supervisor, allowed_updates).run())
+    else:
+        source = asyncio.create_task(poll_updates(bot, supervisor, allowed_updates))
+    stopper = asyncio.create_task(stop.wait())
+    try:
+        await asyncio.wait({source, stopper}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        source.cancel()
+        stopper.cancel()
+        await asyncio.gather(source, stopper, return_exceptions=True)
+        await supervisor.stop()
+        print(f"ℹ️ Воркеры: {supervisor.report()}")
+        await bot.session.close()
+
+
+# ---------- Сторона воркера ----------
+
+async def serve_worker(dp, bot) -> None:
+    """
+    Цикл воркера: читает обновления из stdin и обрабатывает их параллельно,
+    как polling aiogram; после обработки пишет update_id в pipe подтверждений.
+    Конец stdin или SIGTERM — доработать принятое и выйти.
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 2 ** 20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    ack_fd = os.environ.get("BOT_WORKER_ACK_FD")
+    ack = os.fdopen(int(ack_fd), "wb", buffering=0) if ack_fd else None
+
+    loop.add_signal_handler(signal.SIGTERM, reader.feed_eof)
+    # Ctrl+C в терминале получает вся группа процессов; останавливает воркеров супервизор
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+
+    tasks = set()
+
+    async def handle(update: dict) -> None:
+        try:
+            await dp.feed_raw_update(bot, update)
+        except Exception as e:
+            logger.exception("Ошибка обработки обновления %s: %s", update.get("update_id"), e)
+        finally:
+            if ack is not None:
+                ack.write(f"{update.get('update_id', 0)}\n".encode())
+
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            task = asyncio.create_task(handle(json.loads(line)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=WORKER_STOP_TIMEOUT)
+            if pending:
+                logger.warning("Не доработано при остановке воркера: %s", len(pending))
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        if ack is not None:
+            ack.close()
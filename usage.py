@@ -0,0 +1,264 @@
+import sqlite3
+import asyncio
+import logging
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from config import (
+    STORAGE_BACKEND,
+    STORAGE_PATH,
+    USER_DAILY_TOKEN_QUOTA,
+    USAGE_FLUSH_INTERVAL,
+    USAGE_KEEP_DAYS,
+    USAGE_PRICE_INPUT_1K,
+    USAGE_PRICE_OUTPUT_1K,
+    BOT_WORKERS,
+    BOT_WORKER_INDEX,
+)
+
+logger = logging.getLogger(__name__)
+
+# Учёт токенов по игрокам и дням: провайдеры сообщают usage каждого ответа,
+# а чей это запрос и ход ли это игрока, берётся из контекста, который
+# выставляет планировщик (scheduler.run) перед вызовом LLM.
+# (владелец запроса, True — ход игрока / False — фоновая задача)
+current_request = ContextVar("current_request", default=(None, False))
+
+# Поля строки учёта: запросов, из них ходов игрока, входных и выходных токенов, токенов в ходах
+_REQUESTS, _TURNS, _INPUT, _OUTPUT, _TURN_TOKENS = range(5)
+
+# Запросы без игрока (тёплый пул вступлений и т.п.) учитываются как пользователь 0;
+# в многопроцессном режиме у каждого воркера свой (0, -1, -2...), чтобы строки не затирали друг друга
+SYSTEM_USER = -max(0, BOT_WORKER_INDEX)
+
+
+def today() -> str:
+    """Учётные сутки — по UTC, в этот же момент сбрасываются квоты."""
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _to_int(value) -> int:
+    # Yandex присылает счётчики строками
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+class UsageLedger:
+    """
+    Компактный журнал расхода токенов: (день, пользователь) -> 5 счётчиков.
+
+    В памяти держатся последние USAGE_KEEP_DAYS дней; изменения раз в
+    flush_interval секунд пишутся в таблицу usage той же базы SQLite, что и FSM,
+    поэтому дневные квоты переживают перезапуск бота.
+    """
+
+    def __init__(self, path: Optional[str] = None, flush_interval: float = USAGE_FLUSH_INTERVAL,
+                 quota: int = USER_DAILY_TOKEN_QUOTA):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.quota = quota
+        self._rows = {}
+        self._dirty = set()
+        self._by_provider = {}
+        self._conn = None
+        self._executor = None
+        self._flush_task = None
+
+    # ---------- SQLite ----------
+
+    def _init_db(self) -> list:
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS usage ("
+            " day TEXT NOT NULL,"
+            " user_id INTEGER NOT NULL,"
+            " requests INTEGER NOT NULL,"
+            " turns INTEGER NOT NULL,"
+            " input_tokens INTEGER NOT NULL,"
+            " output_tokens INTEGER NOT NULL,"
+            " turn_tokens INTEGER NOT NULL,"
+            " PRIMARY KEY (day, user_id))"
+        )
+        self._conn.commit()
+        return self._select_recent()
+
+    def _select_recent(self) -> list:
+        since = (datetime.now(timezone.utc) - timedelta(days=USAGE_KEEP_DAYS - 1)).strftime("%Y-%m-%d")
+        return self._conn.execute(
+            "SELECT day, user_id, requests, turns, input_tokens, output_tokens, turn_tokens"
+            " FROM usage WHERE day >= ?", (since,)
+        ).fetchall()
+
+    def _write_rows(self, rows: list) -> None:
+        with self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO usage VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def open(self) -> None:
+        """Подгружает последние дни из базы (если учёт хранится на диске)."""
+        if not self.path:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="usage-sqlite")
+        for day, user_id, *counters in await self._run(self._init_db):
+            self._rows[(day, user_id)] = counters
+
+    async def refresh(self) -> None:
+        """
+        Перечитывает учёт из базы: в многопроцессном режиме другие воркеры
+        пишут свои строки, и отчёт должен их видеть. Несохранённые строки
+        этого процесса не трогаем.
+        """
+        if self._conn is None:
+            return
+        for day, user_id, *counters in await self._run(self._select_recent):
+            if (day, user_id) not in self._dirty:
+                self._rows[(day, user_id)] = counters
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        if not self._dirty or self._conn is None:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows = [(day, user_id, *self._rows[(day, user_id)]) for day, user_id in keys if (day, user_id) in self._rows]
+        try:
+            await self._run(self._write_rows, rows)
+        except Exception as e:
+            logger.exception("Не удалось сохранить учёт токенов: %s", e)
+            self._dirty |= keys
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._executor.shutdown(wait=True)
+            self._conn = None
+
+    # ---------- Учёт ----------
+
+    def _prune(self, day: str) -> None:
+        oldest = (datetime.strptime(day, "%Y-%m-%d") - timedelta(days=USAGE_KEEP_DAYS - 1)).strftime("%Y-%m-%d")
+        for key in [key for key in self._rows if key[0] < oldest and key not in self._dirty]:
+            del self._rows[key]
+
+    def record(self, provider: str, input_tokens, output_tokens) -> None:
+        """Записывает usage одного ответа на игрока из текущего контекста запроса."""
+        input_tokens, output_tokens = _to_int(input_tokens), _to_int(output_tokens)
+        owner, interactive = current_request.get()
+        user_id = owner if isinstance(owner, int) else SYSTEM_USER
+        day = today()
+
+        row = self._rows.get((day, user_id))
+        if row is None:
+            row = self._rows[(day, user_id)] = [0, 0, 0, 0, 0]
+            self._prune(day)
+        row[_REQUESTS] += 1
+        row[_INPUT] += input_tokens
+        row[_OUTPUT] += output_tokens
+        if interactive:
+            row[_TURNS] += 1
+            row[_TURN_TOKENS] += input_tokens + output_tokens
+
+        provider_row = self._by_provider.setdefault(provider, [0, 0])
+        provider_row[0] += input_tokens
+        provider_row[1] += output_tokens
+
+        self._dirty.add((day, user_id))
+        if self.path and self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush())
+
+    # ---------- Квоты ----------
+
+    def used_today(self, user_id) -> int:
+        row = self._rows.get((today(), user_id))
+        return row[_INPUT] + row[_OUTPUT] if row else 0
+
+    def remaining(self, user_id) -> Optional[int]:
+        """Сколько токенов осталось на сегодня; None — квоты нет."""
+        if not self.quota:
+            return None
+        return max(0, self.quota - self.used_today(user_id))
+
+    def over_quota(self, user_id) -> bool:
+        return self.remaining(user_id) == 0
+
+    # ---------- Отчёты ----------
+
+    @staticmethod
+    def cost(input_tokens: int, output_tokens: int) -> float:
+        return input_tokens / 1000 * USAGE_PRICE_INPUT_1K + output_tokens / 1000 * USAGE_PRICE_OUTPUT_1K
+
+    def top(self, day: Optional[str] = None, limit: int = 10) -> list:
+        """Самые расходные пользователи за день: [(user_id, row), ...]."""
+        day = day or today()
+        rows = [(user_id, row) for (row_day, user_id), row in self._rows.items() if row_day == day]
+        rows.sort(key=lambda item: -(item[1][_INPUT] + item[1][_OUTPUT]))
+        return rows[:limit]
+
+    def totals(self, day: Optional[str] = None) -> list:
+        """Суммарные счётчики за день (все пользователи)."""
+        day = day or today()
+        total = [0, 0, 0, 0, 0]
+        for (row_day, _), row in self._rows.items():
+            if row_day == day:
+                total = [a + b for a, b in zip(total, row)]
+        return total
+
+    def report(self, limit: int = 10) -> str:
+        """HTML-отчёт для админа: итоги за сегодня и по дням, топ потребителей."""
+        day = today()
+        requests, turns, input_tokens, output_tokens, turn_tokens = self.totals(day)
+        per_turn = turn_tokens // turns if turns else 0
+        lines = [
+            f"📊 <b>Расход токенов за {day} (UTC)</b>",
+            "",
+            f"Запросов: {requests}, ходов: {turns}",
+            f"Вход: {input_tokens}, выход: {output_tokens}",
+            f"В среднем на ход: {per_turn}",
+            f"Стоимость: ~{self.cost(input_tokens, output_tokens):.2f}",
+        ]
+        if self.quota:
+            lines.append(f"Квота на игрока: {self.quota} в сутки")
+
+        lines += ["", "<b>Топ игроков:</b>"]
+        for user_id, row in self.top(day, limit):
+            name = "система" if -BOT_WORKERS < user_id <= 0 else f"<code>{user_id}</code>"
+            user_per_turn = row[_TURN_TOKENS] // row[_TURNS] if row[_TURNS] else 0
+            lines.append(
+                f"{name}: {row[_INPUT] + row[_OUTPUT]} ток. "
+                f"({row[_TURNS]} ход., ~{user_per_turn}/ход, ~{self.cost(row[_INPUT], row[_OUTPUT]):.2f})"
+            )
+
+        days = sorted({row_day for row_day, _ in self._rows}, reverse=True)
+        if len(days) > 1:
+            lines += ["", "<b>По дням:</b>"]
+            for row_day in days:
+                day_total = self.totals(row_day)
+                day_per_turn = day_total[_TURN_TOKENS] // day_total[_TURNS] if day_total[_TURNS] else 0
+                lines.append(f"{row_day}: {day_total[_INPUT] + day_total[_OUTPUT]} ток., ~{day_per_turn}/ход")
+
+        if self._by_provider:
+            lines += ["", "<b>По провайдерам (с запуска):</b>"]
+            for provider, (provider_input, provider_output) in self._by_provider.items():
+                lines.append(f"{provider}: вход {provider_input}, выход {provider_output}")
+        return "\n".join(lines)
+
+
+ledger = UsageLedger(STORAGE_PATH if STORAGE_BACKEND == "sqlite" else None)
+
+
+def record_usage(provider: str, input_tokens, output_tokens) -> None:
+    ledger.record(provider, input_tokens, output_tokens)
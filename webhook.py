@@ -0,0 +1,164 @@
+import hmac
+import asyncio
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from config import (
+    WEBHOOK_BASE_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_WORKERS,
+    WEBHOOK_QUEUE_SIZE,
+)
+from scheduler import scheduler
+from generate import provider_stats
+from outbound import outbox
+from generations import generations
+from menu_cache import menu_cache
+from history import history_stats
+
+logger = logging.getLogger(__name__)
+
+# Приём обновлений через вебхук: Telegram получает 200 сразу, а само обновление
+# обрабатывается пулом из WEBHOOK_WORKERS воркеров через ограниченную очередь.
+# Если очередь переполнена, отвечаем 503 — Telegram повторит доставку позже.
+#
+# Локальная проверка без публичного адреса (WEBHOOK_BASE_URL пустой):
+#   curl -X POST localhost:8080/webhook \
+#        -H "X-Telegram-Bot-Api-Secret-Token: $WEBHOOK_SECRET" \
+#        -H "Content-Type: application/json" -d @update.json
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WebhookServer:
+    """aiohttp-приложение: приём обновлений, пул обработки и /healthz."""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = WEBHOOK_WORKERS,
+                 queue_size: int = WEBHOOK_QUEUE_SIZE, secret: str = WEBHOOK_SECRET):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self._workers = []
+        self.stats = {"received": 0, "processed": 0, "failed": 0, "rejected": 0, "unauthorized": 0}
+
+        self.app = web.Application()
+        self.app.router.add_post(WEBHOOK_PATH, self.handle_update)
+        self.app.router.add_get("/healthz", self.handle_health)
+
+    # ---------- HTTP ----------
+
+    async def handle_update(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            self.stats["unauthorized"] += 1
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            logger.warning("Очередь вебхука переполнена, обновление %s отклонено", update.get("update_id"))
+            return web.Response(status=503)
+        self.stats["received"] += 1
+        return web.Response(status=200)
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        health = self.health()
+        # Балансировщик и мониторинг смотрят на код ответа
+        return web.json_response(health, status=200 if health["status"] == "ok" else 503)
+
+    def status(self) -> str:
+        """ok; degraded — часть воркеров пула умерла; overloaded — очередь полна; down — пул не работает."""
+        alive = sum(1 for worker in self._workers if not worker.done())
+        if not alive:
+            return "down"
+        if self.queue.full():
+            return "overloaded"
+        return "ok" if alive == len(self._workers) else "degraded"
+
+    def health(self) -> dict:
+        return {
+            "status": self.status(),
+            "queue": self.queue.qsize(),
+            "workers": sum(1 for worker in self._workers if not worker.done()),
+            **self.stats,
+            "llm": scheduler.stats(),
+            "providers": provider_stats(),
+            "outbound": outbox.report(),
+            "generations": generations.report(),
+            "menu_cache": menu_cache.report(),
+            "history": history_stats.report(),
+        }
+
+    # ---------- Пул обработки ----------
+
+    async def feed(self, update: dict) -> None:
+        """Обработка одного обновления; супервизор (supervisor.py) вместо этого передаёт его воркеру."""
+        await self.dp.feed_raw_update(self.bot, update)
+
+    def allowed_updates(self) -> list:
+        return self.dp.resolve_used_update_types()
+
+    async def _worker(self) -> None:
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.feed(update)
+                self.stats["processed"] += 1
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.exception("Ошибка обработки обновления %s: %s", update.get("update_id"), e)
+            finally:
+                self.queue.task_done()
+
+    async def run(self) -> None:
+        """Поднимает сервер, регистрирует вебхук и работает до отмены."""
+        if not self.secret:
+            # Без секрета любой, кто знает адрес, может слать боту поддельные обновления
+            raise RuntimeError("BOT_MODE=webhook требует WEBHOOK_SECRET")
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+        await site.start()
+        logger.info("Вебхук слушает %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+        await self.dp.emit_startup(bot=self.bot)
+        if WEBHOOK_BASE_URL:
+            await self.bot.set_webhook(
+                WEBHOOK_BASE_URL.rstrip("/") + WEBHOOK_PATH,
+                secret_token=self.secret,
+                allowed_updates=self.allowed_updates(),
+                # Обновления, пришедшие пока экземпляр перезапускался, не теряем
+                drop_pending_updates=False,
+            )
+        else:
+            logger.warning("WEBHOOK_BASE_URL не задан: вебхук в Telegram не регистрируется (локальный режим)")
+
+        try:
+            await asyncio.Event().wait()
+        finally:
+            # Сначала перестаём принимать, затем дорабатываем уже принятые обновления
+            await site.stop()
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout=30)
+            except asyncio.TimeoutError:
+                logger.warning("Не все обновления обработаны до остановки: %s", self.queue.qsize())
+            for worker in self._workers:
+                worker.cancel()
+            await asyncio.gather(*self._workers, return_exceptions=True)
+            # Вебхук в Telegram не снимаем: за балансировщиком могут работать другие
+            # экземпляры, а Telegram придержит обновления до перезапуска.
+            # Переход на polling снимает вебхук при старте (см. run.py).
+            await self.dp.emit_shutdown(bot=self.bot)
+            await runner.cleanup()
+            print(f"ℹ️ Вебхук: {self.stats}")
@@ -1,29 +1,31 @@
-import os
 import sys
 import json
 import asyncio
 import aiohttp
-from config import YANDEX_API_KEY, YANDEX_MODEL_URI
+from config import YANDEX_API_KEY, YANDEX_MODEL_URI, YANDEX_MAX_TOKENS, YANDEX_API_URL
+from http_client import get_http_session, encode_json_body
+from providers import Provider, ProviderError, RETRYABLE_STATUSES, parse_retry_after
+from usage import record_usage
 
 sys.stdout.reconfigure(encoding="utf-8")
 
-# Базовая директория проекта (где лежит yandex.py и prompt.txt)
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-PROMPT_PATH = os.path.join(BASE_DIR, "prompt.txt")
-
-# URL для Yandex GPT API
-YANDEX_API_URL = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-
-# Загружаем базовый промпт при старте
-try:
-    with open(PROMPT_PATH, "r", encoding="utf-8") as file:
-        BASE_PROMPT = file.read().strip()
-except FileNotFoundError:
-    print(f"❌ Ошибка: файл prompt.txt не найден по пути: {PROMPT_PATH}")
-    BASE_PROMPT = ""
-except Exception as e:
-    print(f"❌ Ошибка при чтении prompt.txt ({PROMPT_PATH}): {e}")
-    BASE_PROMPT = ""
+# Тексты ошибок, общие для обычного и потокового режима
+NETWORK_ERROR_TEXT = (
+    "⚠️ <b>Ошибка сети</b>\n\n"
+    "🔴 Не удалось подключиться к серверу Yandex GPT.\n\n"
+    "<i>Проверьте подключение к интернету и попробуйте снова.</i>"
+)
+TIMEOUT_ERROR_TEXT = (
+    "⚠️ <b>Превышено время ожидания</b>\n\n"
+    "🔴 Сервер Yandex GPT не ответил вовремя.\n\n"
+    "<i>Попробуйте снова через несколько секунд.</i>"
+)
+EMPTY_RESPONSE_TEXT = "⚠️ Пустой ответ от Yandex GPT API."
+FORMAT_ERROR_TEXT = (
+    "⚠️ <b>Ошибка формата ответа</b>\n\n"
+    "🔴 Сервер Yandex GPT вернул некорректный ответ.\n\n"
+    "<i>Попробуйте снова через несколько секунд.</i>"
+)
 
 
 def convert_history_to_yandex_format(history: list, system_prompt: str) -> list:
@@ -55,102 +57,153 @@ def convert_history_to_yandex_format(history: list, system_prompt: str) -> list:
     return yandex_messages
 
 
-async def ai_generate(history: list):
-    """
-    Асинхронный запрос к Yandex GPT API.
+def build_completion_request(history: list, system_prompt: str, stream: bool) -> tuple:
+    """Собирает тело и заголовки запроса к completion. Возвращает (body, headers)."""
+    # Конвертируем историю в формат Yandex GPT
+    yandex_messages = convert_history_to_yandex_format(history, system_prompt)
     
-    Args:
-        history: Список сообщений в формате [{"role": "user"/"assistant", "content": "..."}]
+    # Формируем запрос к Yandex GPT API
+    request_data = {
+        "modelUri": YANDEX_MODEL_URI,
+        "completionOptions": {
+            "stream": stream,
+            "temperature": 0.6,
+            "maxTokens": str(YANDEX_MAX_TOKENS)
+        },
+        "messages": yandex_messages
+    }
     
-    Returns:
-        str: Сгенерированный текст ответа
-    """
-    try:
-        # На каждый вызов читаем актуальный prompt.txt,
-        # чтобы там уже был [CHARACTER] + базовый промпт.
+    body, headers = encode_json_body(request_data)
+    headers["Authorization"] = f"Api-Key {YANDEX_API_KEY}"
+    return body, headers
+
+
+class YandexProvider(Provider):
+    """Yandex GPT: completion API, обычный и потоковый режим."""
+
+    name = "yandex"
+
+    @property
+    def configured(self) -> bool:
+        return bool(YANDEX_API_KEY and YANDEX_MODEL_URI)
+
+    async def _raise_for_status(self, response) -> None:
+        error_text = await response.text()
+        error_message = f"HTTP {response.status}: {error_text}"
+        # Детальное логирование для отладки
+        print(f"⚠️ Ошибка Yandex GPT API:")
+        print(f"   Статус: {response.status}")
+        print(f"   Ответ: {error_text}")
+        print(f"   ModelUri: {YANDEX_MODEL_URI}")
+        print(f"   API Key (первые 10 символов): {YANDEX_API_KEY[:10]}...")
+        raise ProviderError(
+            error_message,
+            handle_yandex_error(response.status, error_message),
+            retryable=response.status in RETRYABLE_STATUSES,
+            retry_after=parse_retry_after(response.headers.get("Retry-After")),
+        )
+
+    async def complete(self, history: list, system_prompt: str, timeout: float) -> str:
+        """
+        Асинхронный запрос к Yandex GPT API.
+
+        Args:
+            history: Список сообщений в формате [{"role": "user"/"assistant", "content": "..."}]
+            system_prompt: Готовый системный промпт сессии (BASE_PROMPT + [CHARACTER])
+            timeout: Сколько секунд осталось до дедлайна запроса
+
+        Returns:
+            str: Сгенерированный текст ответа
+        """
         try:
-            with open(PROMPT_PATH, "r", encoding="utf-8") as f:
-                full_prompt = f.read().strip()
-        except Exception:
-            # Фоллбек — используем базовый промпт из момента запуска
-            full_prompt = BASE_PROMPT
-        
-        # Конвертируем историю в формат Yandex GPT
-        yandex_messages = convert_history_to_yandex_format(history, full_prompt)
-        
-        # Формируем запрос к Yandex GPT API
-        request_data = {
-            "modelUri": YANDEX_MODEL_URI,
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.6,
-                "maxTokens": "2000"
-            },
-            "messages": yandex_messages
-        }
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Api-Key {YANDEX_API_KEY}"
-        }
-        
-        # Выполняем асинхронный запрос
-        async with aiohttp.ClientSession() as session:
+            body, headers = build_completion_request(history, system_prompt, stream=False)
+
+            # Выполняем асинхронный запрос через общий пул соединений (keep-alive, DNS-кэш)
+            session = get_http_session()
+            async with session.post(
+                YANDEX_API_URL,
+                headers=headers,
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                if response.status != 200:
+                    await self._raise_for_status(response)
+                try:
+                    result = await response.json()
+                except (json.JSONDecodeError, aiohttp.ContentTypeError) as e:
+                    error_text = await response.text()
+                    print(f"⚠️ Ошибка парсинга JSON от Yandex GPT: {e}, ответ: {error_text}")
+                    raise ProviderError(str(e), FORMAT_ERROR_TEXT)
+                # Расход токенов: usage.inputTextTokens / completionTokens
+                usage = result.get("result", {}).get("usage") or {}
+                record_usage(self.name, usage.get("inputTextTokens"), usage.get("completionTokens"))
+                # Извлекаем текст ответа из структуры Yandex GPT
+                alternatives = result.get("result", {}).get("alternatives", [])
+                if not alternatives:
+                    raise ProviderError("empty alternatives", EMPTY_RESPONSE_TEXT)
+                return alternatives[0]["message"]["text"]
+
+        except aiohttp.ClientError as e:
+            print(f"⚠️ Ошибка сети при запросе к Yandex GPT: {e}")
+            raise ProviderError(str(e), NETWORK_ERROR_TEXT)
+        except asyncio.TimeoutError:
+            print("⚠️ Таймаут при запросе к Yandex GPT")
+            raise ProviderError("timeout", TIMEOUT_ERROR_TEXT)
+
+    async def stream(self, history: list, system_prompt: str, timeout: float):
+        """
+        Потоковый запрос к Yandex GPT API.
+
+        Yandex присылает ответ построчно: каждая строка — JSON с частичной альтернативой,
+        текст в которой накапливается (каждый следующий кусок содержит весь текст с начала).
+
+        Yields:
+            str: Текст ответа, накопленный к текущему моменту
+        """
+        try:
+            body, headers = build_completion_request(history, system_prompt, stream=True)
+
+            session = get_http_session()
             async with session.post(
                 YANDEX_API_URL,
                 headers=headers,
-                json=request_data,
-                timeout=aiohttp.ClientTimeout(total=60)
+                data=body,
+                timeout=aiohttp.ClientTimeout(total=timeout)
             ) as response:
-                if response.status == 200:
+                if response.status != 200:
+                    await self._raise_for_status(response)
+
+                text = ""
+                usage = {}
+                async for raw_line in response.content:
+                    line = raw_line.strip()
+                    if not line:
+                        continue
                     try:
-                        result = await response.json()
-                        # Извлекаем текст ответа из структуры Yandex GPT
-                        if "result" in result and "alternatives" in result["result"]:
-                            if len(result["result"]["alternatives"]) > 0:
-                                return result["result"]["alternatives"][0]["message"]["text"]
-                        return "⚠️ Пустой ответ от Yandex GPT API."
+                        chunk = json.loads(line)
                     except json.JSONDecodeError as e:
-                        error_text = await response.text()
-                        print(f"⚠️ Ошибка парсинга JSON от Yandex GPT: {e}, ответ: {error_text}")
-                        return (
-                            "⚠️ <b>Ошибка формата ответа</b>\n\n"
-                            "🔴 Сервер Yandex GPT вернул некорректный ответ.\n\n"
-                            "<i>Попробуйте снова через несколько секунд.</i>"
-                        )
-                else:
-                    error_text = await response.text()
-                    error_message = f"HTTP {response.status}: {error_text}"
-                    # Детальное логирование для отладки
-                    print(f"⚠️ Ошибка Yandex GPT API:")
-                    print(f"   Статус: {response.status}")
-                    print(f"   Ответ: {error_text}")
-                    print(f"   ModelUri: {YANDEX_MODEL_URI}")
-                    print(f"   API Key (первые 10 символов): {YANDEX_API_KEY[:10]}...")
-                    return handle_yandex_error(response.status, error_message)
-    
-    except aiohttp.ClientError as e:
-        error_message = str(e)
-        print(f"⚠️ Ошибка сети при запросе к Yandex GPT: {e}")
-        return (
-            "⚠️ <b>Ошибка сети</b>\n\n"
-            "🔴 Не удалось подключиться к серверу Yandex GPT.\n\n"
-            "<i>Проверьте подключение к интернету и попробуйте снова.</i>"
-        )
-    except asyncio.TimeoutError:
-        print("⚠️ Таймаут при запросе к Yandex GPT")
-        return (
-            "⚠️ <b>Превышено время ожидания</b>\n\n"
-            "🔴 Сервер Yandex GPT не ответил в течение 60 секунд.\n\n"
-            "<i>Попробуйте снова через несколько секунд.</i>"
-        )
-    except Exception as e:
-        print(f"⚠️ Неизвестная ошибка при запросе к Yandex GPT: {e}")
-        return (
-            "⚠️ <b>Внутренняя ошибка</b>\n\n"
-            f"Произошла непредвиденная ошибка: {str(e)}\n\n"
-            "<i>Попробуйте снова. Если проблема сохраняется, обратитесь к администратору.</i>"
-        )
+                        print(f"⚠️ Ошибка парсинга потока Yandex GPT: {e}, строка: {line[:200]!r}")
+                        continue
+                    # usage в каждом куске накопительный — достаточно последнего
+                    usage = chunk.get("result", {}).get("usage") or usage
+                    alternatives = chunk.get("result", {}).get("alternatives", [])
+                    if not alternatives:
+                        continue
+                    new_text = alternatives[0].get("message", {}).get("text", "")
+                    if new_text and new_text != text:
+                        text = new_text
+                        yield text
+
+                record_usage(self.name, usage.get("inputTextTokens"), usage.get("completionTokens"))
+                if not text:
+                    raise ProviderError("empty stream", EMPTY_RESPONSE_TEXT)
+
+        except aiohttp.ClientError as e:
+            print(f"⚠️ Ошибка сети при потоковом запросе к Yandex GPT: {e}")
+            raise ProviderError(str(e), NETWORK_ERROR_TEXT)
+        except asyncio.TimeoutError:
+            print("⚠️ Таймаут при потоковом запросе к Yandex GPT")
+            raise ProviderError("timeout", TIMEOUT_ERROR_TEXT)
 
 
 def handle_yandex_error(status_code: int, error_message: str) -> str: